@@ -0,0 +1,64 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+import argparse
+import os
+import shutil
+import tempfile
+import time
+import pkg_resources
+from singlecellmultiomics.barcodeFileParser.barcodeFileParser import BarcodeParser
+from singlecellmultiomics.fastqProcessing.fastqIterator import FastqRecord
+from singlecellmultiomics.modularDemultiplexer.demultiplexingStrategyLoader import DemultiplexingStrategyLoader
+
+"""
+Benchmark of the demultiplexer start up: the time from loading the barcode and
+index files to the first demultiplexed read pair.
+
+The barcode and index directories of the package are copied to a temporary
+directory, this way the first lazy run starts without cached hamming expansions.
+"""
+
+R1 = FastqRecord(
+    '@NS500414:628:H7YVNBGXC:1:11101:15963:1046 1:N:0:GTGAAA',
+    'ATCACACACTATAGTCATTCAGGAGCAGGTTCTTCAGGTTCCCTGTAGTTGTGTGGTTTTGAGTGAGTTTTTTAAT',
+    '+',
+    'AAAAA#EEEEEEEEEEEAEEEEEEEAEEEEEEEEEEEEEEEEEE/EEEEEEEEEEEE/EEEEEEEEEEEEEEEEEE')
+R2 = FastqRecord(
+    '@NS500414:628:H7YVNBGXC:1:11101:15963:1046 2:N:0:GTGAAA',
+    'ACCCCAGATCAACGTTGGACNTCNNCNTTNTNCTCNGCACCNNNNCNNNCTTATNCNNNANNNNNNNNNNTNNGN',
+    '+',
+    '6AAAAEEAEE/AEEEEEEEE#EE##<#6E#A#EEE#EAEEA####A###EE6EE#E###E##########E##A#')
+
+
+def time_to_first_read(barcode_dir, index_dir, hd, hdi, strategy, lazy, cache):
+    start = time.time()
+    dmx = DemultiplexingStrategyLoader(
+        barcodeParser=BarcodeParser(barcode_dir, hammingDistanceExpansion=hd, lazy=lazy, cache=cache),
+        indexParser=BarcodeParser(index_dir, hammingDistanceExpansion=hdi, lazy=lazy, cache=cache))
+    strategies = dmx.getSelectedStrategiesFromStringList([strategy], verbose=False)
+    for strategy in strategies:
+        strategy.demultiplex([R1, R2], library='benchmark')
+    return time.time() - start
+
+
+if __name__ == '__main__':
+    argparser = argparse.ArgumentParser(
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+        description='Benchmark the time to the first demultiplexed read pair')
+    argparser.add_argument('-hd', type=int, default=1, help='Hamming distance of the cell barcodes')
+    argparser.add_argument('-hdi', type=int, default=1, help='Hamming distance of the sequencing indices')
+    argparser.add_argument('-use', type=str, default='NLAIII384C8U3', help='Demultiplexing strategy')
+    args = argparser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        barcode_dir = os.path.join(tmp, 'barcodes')
+        index_dir = os.path.join(tmp, 'indices')
+        shutil.copytree(pkg_resources.resource_filename('singlecellmultiomics', 'modularDemultiplexer/barcodes/'), barcode_dir)
+        shutil.copytree(pkg_resources.resource_filename('singlecellmultiomics', 'modularDemultiplexer/indices/'), index_dir)
+
+        for name, lazy, cache in (
+                ('eager, no cache', False, False),
+                ('lazy, cold cache', True, True),
+                ('lazy, warm cache', True, True)):
+            duration = time_to_first_read(barcode_dir, index_dir, args.hd, args.hdi, args.use, lazy, cache)
+            print(f'{name}\t{duration:.3f}s')
@@ -0,0 +1,231 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+import argparse
+import time
+import numpy as np
+import pysam
+import pysamiterators
+import singlecellmultiomics.molecule
+import singlecellmultiomics.fragment
+from singlecellmultiomics.molecule import MoleculeIterator
+
+"""
+Benchmark of Molecule.get_base_calling_feature_matrix against the previous implementation,
+which visited every aligned base in Python. The outputs are checked to be identical.
+"""
+
+
+def legacy_base_calling_feature_matrix(
+        self,
+        return_ref_info=False,
+        start=None,
+        end=None,
+        reference=None,
+        NUC_RADIUS=1,
+        USE_RT=True,
+        select_read_groups=None):
+    """Previous, per base, implementation of Molecule.get_base_calling_feature_matrix"""
+    if start is None:
+        start = self.spanStart
+    if end is None:
+        end = self.spanEnd
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        BASE_COUNT = 5
+        RT_INDEX = 7 if USE_RT else None
+        STRAND_INDEX = 0
+        PHRED_INDEX = 1
+        RC_INDEX = 2
+        MATE_INDEX = 3
+        CYCLE_INDEX = 4
+        MQ_INDEX = 5
+        FS_INDEX = 6
+
+        COLUMN_OFFSET = 0
+        features_per_block = 8 - (not USE_RT)
+
+        origin_start = start
+        origin_end = end
+
+        end += NUC_RADIUS
+        start -= NUC_RADIUS
+
+        features = np.zeros(
+            (end - start + 1, (features_per_block * BASE_COUNT) + COLUMN_OFFSET))
+
+        if return_ref_info:
+            ref_bases = {}
+
+        for rt_id, fragments in self.get_rt_reactions().items():
+            # we need to keep track what positions where covered by this RT
+            # reaction
+            RT_reaction_coverage = set()  # (pos, base_call)
+            for fragment in fragments:
+                for read in fragment:
+                    if select_read_groups is not None:
+                        if not read.has_tag('RG'):
+                            raise ValueError(
+                                "Not all reads in the BAM file have a read group defined.")
+                        if not read.get_tag('RG') in select_read_groups:
+                            continue
+                    # Skip reads outside range
+                    if read is None or read.reference_start > (
+                            end + 1) or read.reference_end < start:
+                        continue
+                    for cycle, q_pos, ref_pos, ref_base in pysamiterators.ReadCycleIterator(
+                            read, matches_only=True, with_seq=True, reference=reference):
+
+                        row_index = ref_pos - start
+                        if row_index < 0 or row_index >= features.shape[0]:
+                            continue
+
+                        query_base = read.seq[q_pos]
+                        # Base index block:
+                        block_index = 'ACGTN'.index(query_base)
+
+                        # Update rt_reactions
+                        if USE_RT:
+                            if not (
+                                    ref_pos, query_base) in RT_reaction_coverage:
+                                features[row_index][RT_INDEX +
+                                                    COLUMN_OFFSET +
+                                                    features_per_block *
+                                                    block_index] += 1
+                            RT_reaction_coverage.add((ref_pos, query_base))
+
+                        # Update total phred score
+                        features[row_index][PHRED_INDEX +
+                                            COLUMN_OFFSET +
+                                            features_per_block *
+                                            block_index] += read.query_qualities[q_pos]
+
+                        # Update total reads
+
+                        features[row_index][RC_INDEX + COLUMN_OFFSET +
+                                            features_per_block * block_index] += 1
+
+                        # Update mate index
+                        features[row_index][MATE_INDEX +
+                                            COLUMN_OFFSET +
+                                            features_per_block *
+                                            block_index] += read.is_read2
+
+                        # Update fragment sizes:
+                        features[row_index][FS_INDEX +
+                                            COLUMN_OFFSET +
+                                            features_per_block *
+                                            block_index] += abs(fragment.span[1] -
+                                                                fragment.span[2])
+
+                        # Update cycle
+                        features[row_index][CYCLE_INDEX +
+                                            COLUMN_OFFSET +
+                                            features_per_block *
+                                            block_index] += cycle
+
+                        # Update MQ:
+                        features[row_index][MQ_INDEX +
+                                            COLUMN_OFFSET +
+                                            features_per_block *
+                                            block_index] += read.mapping_quality
+
+                        # update strand:
+                        features[row_index][STRAND_INDEX +
+                                            COLUMN_OFFSET +
+                                            features_per_block *
+                                            block_index] += read.is_reverse
+
+                        if return_ref_info:
+                            row_index_in_output = ref_pos - origin_start
+                            if row_index_in_output < 0 or row_index_in_output >= origin_end - origin_start + 1:
+                                continue
+
+                            ref_bases[ref_pos] = ref_base.upper()
+
+        # Normalize all and return
+
+        for block_index in range(BASE_COUNT):  # ACGTN
+            for index in (
+                    PHRED_INDEX,
+                    MATE_INDEX,
+                    CYCLE_INDEX,
+                    MQ_INDEX,
+                    FS_INDEX,
+                    STRAND_INDEX):
+                features[:, index +
+                         COLUMN_OFFSET +
+                         features_per_block *
+                         block_index] /= features[:, RC_INDEX +
+                                                  COLUMN_OFFSET +
+                                                  features_per_block *
+                                                  block_index]
+        #np.nan_to_num( features, nan=-1, copy=False )
+        features[np.isnan(features)] = -1
+
+        if NUC_RADIUS > 0:
+            # duplicate columns in shifted manner
+            x = features
+            features = np.zeros(
+                (x.shape[0] - NUC_RADIUS * 2, x.shape[1] * (1 + NUC_RADIUS * 2)))
+            for offset in range(0, NUC_RADIUS * 2 + 1):
+                slice_start = offset
+                slice_end = -(NUC_RADIUS * 2) + offset
+                if slice_end == 0:
+                    features[:, features_per_block *
+                             BASE_COUNT *
+                             offset:features_per_block *
+                             BASE_COUNT *
+                             (offset +
+                              1)] = x[slice_start:, :]
+                else:
+                    features[:, features_per_block *
+                             BASE_COUNT *
+                             offset:features_per_block *
+                             BASE_COUNT *
+                             (offset +
+                              1)] = x[slice_start:slice_end, :]
+
+        if return_ref_info:
+            ref_info = [
+                (self.chromosome, ref_pos, ref_bases.get(ref_pos, 'N'))
+                for ref_pos in range(origin_start, origin_end + 1)]
+            return features, ref_info
+        return features
+
+
+def time_feature_matrices(molecules, function, repeats, **feature_matrix_args):
+    time_start = time.time()
+    for _ in range(repeats):
+        results = [function(molecule, **feature_matrix_args) for molecule in molecules]
+    return (time.time() - time_start) / repeats, results
+
+
+if __name__ == '__main__':
+    argparser = argparse.ArgumentParser(
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+        description='Benchmark the base calling feature matrix of molecules')
+    argparser.add_argument('bamfile', type=str, nargs='?', default='./data/mini_nla_test.bam')
+    argparser.add_argument('-repeats', type=int, default=3)
+    argparser.add_argument('-NUC_RADIUS', type=int, default=1)
+    argparser.add_argument('--no_rt', action='store_true', help='Do not use RT reaction features')
+    args = argparser.parse_args()
+
+    with pysam.AlignmentFile(args.bamfile) as alignments:
+        molecules = list(MoleculeIterator(
+            alignments,
+            molecule_class=singlecellmultiomics.molecule.NlaIIIMolecule,
+            fragment_class=singlecellmultiomics.fragment.NlaIIIFragment))
+
+    feature_matrix_args = {'return_ref_info': True, 'NUC_RADIUS': args.NUC_RADIUS, 'USE_RT': not args.no_rt}
+    legacy_time, legacy_results = time_feature_matrices(
+        molecules, legacy_base_calling_feature_matrix, args.repeats, **feature_matrix_args)
+    current_time, current_results = time_feature_matrices(
+        molecules, singlecellmultiomics.molecule.Molecule.get_base_calling_feature_matrix, args.repeats,
+        **feature_matrix_args)
+
+    identical = all(
+        np.array_equal(legacy_X, current_X) and legacy_info == current_info
+        for (legacy_X, legacy_info), (current_X, current_info) in zip(legacy_results, current_results))
+
+    print('molecules\tlegacy_seconds\tcurrent_seconds\tspeedup\tidentical')
+    print(f'{len(molecules)}\t{legacy_time:.3f}\t{current_time:.3f}\t{legacy_time / current_time:.1f}\t{identical}')
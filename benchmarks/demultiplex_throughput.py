@@ -0,0 +1,246 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+import argparse
+import csv
+import multiprocessing
+import os
+import random
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+import pkg_resources
+from singlecellmultiomics.barcodeFileParser.barcodeFileParser import BarcodeParser
+from singlecellmultiomics.fastqProcessing.fastqHandle import FastqHandle
+from singlecellmultiomics.fastqProcessing.fastqIterator import FastqIterator
+from singlecellmultiomics.modularDemultiplexer.baseDemultiplexMethods import UmiBarcodeDemuxMethod
+from singlecellmultiomics.modularDemultiplexer.demultiplexingStrategyLoader import DemultiplexingStrategyLoader
+
+"""
+Throughput benchmark of DemultiplexingStrategyLoader.demultiplex.
+
+For every demultiplexing strategy a synthetic paired library is written, the
+cell barcode and UMI are placed at the location the strategy reads them from
+and a fraction of the barcodes (-error_rate) contains a single substitution.
+Sequences a strategy requires besides the barcode are placed as listed in REQUIRED_MOTIFS.
+A strategy which does not demultiplex any read pair of its library only measured the
+rejection of reads, it is reported as an error and the benchmark exits with status 1.
+Every strategy is benchmarked in a new process, the peak RSS is the peak of that process.
+
+The time is split in:
+    parse: reading the fastq files (FastqIterator)
+    strategy: demultiplexing the read pairs
+    write: formatting and writing the demultiplexed and rejected read pairs
+
+The library generation is seeded, results of different commits can be compared with -compare:
+    python benchmarks/demultiplex_throughput.py -o before.tsv
+    git checkout <branch>
+    python benchmarks/demultiplex_throughput.py -o after.tsv -compare before.tsv
+"""
+
+COLUMNS = ('strategy', 'read_pairs', 'yield_pct', 'seconds', 'read_pairs_per_s',
+           'parse_s', 'strategy_s', 'write_s', 'peak_rss_mb', 'commit')
+
+# {strategy: [(read index, position, sequence), ..]} sequences required by a strategy besides the barcode and UMI
+REQUIRED_MOTIFS = {
+    # Template switching oligo, the 6 bases in front of it are used as transcriptome UMI
+    'CHICTV': [(0, 30, 'AGACTCTTT')],
+}
+
+
+class TimedHandle():
+    # Measures the time spent writing records
+    def __init__(self, handle):
+        self.handle = handle
+        self.seconds = 0
+
+    def write(self, records):
+        start = time.perf_counter()
+        self.handle.write(records)
+        self.seconds += time.perf_counter() - start
+
+    def close(self):
+        start = time.perf_counter()
+        self.handle.close()
+        self.seconds += time.perf_counter() - start
+
+
+def get_loader(hd):
+    return DemultiplexingStrategyLoader(
+        barcodeParser=BarcodeParser(
+            pkg_resources.resource_filename('singlecellmultiomics', 'modularDemultiplexer/barcodes/'),
+            hammingDistanceExpansion=hd),
+        indexParser=BarcodeParser(
+            pkg_resources.resource_filename('singlecellmultiomics', 'modularDemultiplexer/indices/'),
+            hammingDistanceExpansion=1))
+
+
+def get_barcode_layout(strategy):
+    """Obtain the strategy which defines the barcode location, strategies combining
+    multiple strategies use the first one. Returns None when there is no cell barcode"""
+    if getattr(strategy, 'barcodeFileAlias', None) is not None:
+        return strategy
+    for value in vars(strategy).values():
+        if isinstance(value, UmiBarcodeDemuxMethod) and value.barcodeFileAlias is not None:
+            return value
+    return None
+
+
+def write_synthetic_library(paths, strategy, barcode_parser, n, error_rate, seed=42, read_length=75):
+    """Write a paired library for strategy to paths (R1, R2)
+
+    Args:
+        error_rate (float) : fraction of the read pairs with a substitution in the cell barcode
+    """
+    rng = random.Random(seed)
+    seq = lambda n: ''.join(rng.choices('ACGT', k=n))
+    layout = get_barcode_layout(strategy)
+    barcodes = [] if layout is None else sorted(barcode_parser.barcodes[layout.barcodeFileAlias])
+    with open(paths[0], 'w') as r1, open(paths[1], 'w') as r2:
+        for i in range(n):
+            reads = [seq(read_length), seq(read_length)]
+            if layout is not None:
+                barcode = rng.choice(barcodes)
+                if rng.random() < error_rate:
+                    position = rng.randrange(len(barcode))
+                    barcode = barcode[:position] + rng.choice(
+                        [base for base in 'ACGT' if base != barcode[position]]) + barcode[position + 1:]
+                read = reads[layout.barcodeRead]
+                start = layout.barcodeStart
+                # Restriction site after the UMI and barcode, required by the NLAIII strategies
+                read = read[:start] + barcode + read[start + len(barcode):]
+                end = max(start + len(barcode), layout.umiStart + layout.umiLength)
+                reads[layout.barcodeRead] = (read[:end] + 'CATG' + read[end + 4:])[:read_length]
+            for read_index, position, motif in REQUIRED_MOTIFS.get(strategy.shortName, []):
+                read = reads[read_index]
+                reads[read_index] = (read[:position] + motif + read[position + len(motif):])[:read_length]
+            for handle, mate, read in zip((r1, r2), (1, 2), reads):
+                handle.write(
+                    f'@NS500414:628:H7YVNBGXC:1:11101:{i}:1046 {mate}:N:0:GTGAAA\n{read}\n+\n{"E" * len(read)}\n')
+
+
+def benchmark_strategy(short_name, n, error_rate, hd, n_processes, seed):
+    """Benchmark a single strategy, returns a dictionary with the COLUMNS"""
+    dmx = get_loader(hd)
+    strategy, = dmx.getSelectedStrategiesFromStringList([short_name], verbose=False)
+    with tempfile.TemporaryDirectory() as tmp:
+        paths = [os.path.join(tmp, f'benchmark_R{i}.fastq') for i in (1, 2)]
+        write_synthetic_library(paths, strategy, dmx.barcodeParser, n, error_rate, seed=seed)
+
+        start = time.perf_counter()
+        for _ in FastqIterator(*paths):
+            pass
+        parse_seconds = time.perf_counter() - start
+
+        target = TimedHandle(FastqHandle(os.path.join(tmp, 'demultiplexed'), True))
+        rejects = TimedHandle(FastqHandle(os.path.join(tmp, 'rejects'), True))
+        start = time.perf_counter()
+        processed, yields = dmx.demultiplex(
+            paths, strategies=[strategy], library='benchmark',
+            targetFile=target, rejectHandle=rejects, n_processes=n_processes)
+        target.close()
+        rejects.close()
+        seconds = time.perf_counter() - start
+
+    write_seconds = target.seconds + rejects.seconds
+    return {
+        'strategy': short_name,
+        'read_pairs': processed,
+        'yield_pct': round(100 * yields[short_name] / processed, 2),
+        'seconds': round(seconds, 3),
+        'read_pairs_per_s': round(processed / seconds),
+        'parse_s': round(parse_seconds, 3),
+        'strategy_s': round(max(0, seconds - parse_seconds - write_seconds), 3),
+        'write_s': round(write_seconds, 3),
+        # ru_maxrss is in kilobytes on linux
+        'peak_rss_mb': round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+    }
+
+
+def _benchmark_worker(queue, args):
+    queue.put(benchmark_strategy(*args))
+
+
+def get_commit():
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', '--short', 'HEAD'],
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            stderr=subprocess.DEVNULL).decode().strip()
+    except (subprocess.CalledProcessError, OSError):
+        return 'unknown'
+
+
+def read_results(path):
+    with open(path) as f:
+        return {row['strategy']: row for row in csv.DictReader(f, delimiter='\t')}
+
+
+if __name__ == '__main__':
+    argparser = argparse.ArgumentParser(
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+        description='Benchmark the demultiplexing throughput of every demultiplexing strategy')
+    argparser.add_argument('-n', type=int, default=20_000, help='Amount of read pairs per strategy')
+    argparser.add_argument('-use', type=str, help='Comma separated strategies to benchmark, all strategies when not supplied')
+    argparser.add_argument('-error_rate', type=float, default=0.05, help='Fraction of the read pairs with a substitution in the cell barcode')
+    argparser.add_argument('-hd', type=int, default=1, help='Hamming distance barcode expansion')
+    argparser.add_argument('-t', type=int, default=1, help='Amount of demultiplexing processes, the time split is only accurate for one process')
+    argparser.add_argument('-seed', type=int, default=42)
+    argparser.add_argument('-o', type=str, help='Write the results to this tab separated file')
+    argparser.add_argument('-compare', type=str, help='Compare to the results in this tab separated file')
+    argparser.add_argument('-threshold', type=float, default=10, help='Report strategies which are this percentage slower than in -compare as regressions')
+    args = argparser.parse_args()
+
+    if args.use is None:
+        strategies = [strategy.shortName for strategy in get_loader(args.hd).demultiplexingStrategies]
+    else:
+        strategies = args.use.split(',')
+
+    commit = get_commit()
+    previous = None if args.compare is None else read_results(args.compare)
+    context = multiprocessing.get_context('spawn')
+    results = []
+    regressions = []
+    failed = []
+    print('\t'.join(COLUMNS) + ('' if previous is None else '\tslowdown_pct'))
+    for short_name in strategies:
+        # Every strategy runs in a new process to measure its peak memory usage
+        queue = context.Queue()
+        process = context.Process(
+            target=_benchmark_worker,
+            args=(queue, (short_name, args.n, args.error_rate, args.hd, args.t, args.seed)))
+        process.start()
+        result = queue.get()
+        process.join()
+        result['commit'] = commit
+        if result['yield_pct'] == 0:
+            # Only the rejection of read pairs was timed, the throughput is not comparable to other strategies
+            print(f'{short_name}\tERROR: no read pair of the synthetic library was demultiplexed', file=sys.stderr)
+            failed.append(short_name)
+            continue
+        results.append(result)
+
+        line = '\t'.join(str(result[column]) for column in COLUMNS)
+        if previous is not None and short_name in previous:
+            slowdown = 100 * (float(previous[short_name]['read_pairs_per_s']) / result['read_pairs_per_s'] - 1)
+            line += f'\t{slowdown:+.1f}'
+            if slowdown > args.threshold:
+                regressions.append(short_name)
+        print(line)
+
+    if args.o is not None:
+        with open(args.o, 'w') as f:
+            writer = csv.DictWriter(f, COLUMNS, delimiter='\t')
+            writer.writeheader()
+            writer.writerows(results)
+
+    if previous is not None:
+        if regressions:
+            print(f'Slower than {args.compare} by more than {args.threshold}%: {", ".join(regressions)}')
+        else:
+            print(f'No regressions compared to {args.compare}')
+
+    if failed:
+        sys.exit(f'The synthetic library of {", ".join(failed)} could not be demultiplexed, '
+                 'add the sequences these strategies require to REQUIRED_MOTIFS')
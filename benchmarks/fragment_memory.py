@@ -0,0 +1,82 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+import argparse
+import multiprocessing
+import resource
+import time
+import pysam
+import pysamiterators.iterators
+import singlecellmultiomics.fragment
+from singlecellmultiomics.universalBamTagger.universalBamTagger import QueryNameFlagger
+
+"""
+Benchmark of the memory used by buffered fragments.
+
+The read pairs of the supplied bam file are assigned to fragments over and over
+again, the fragments are kept in memory like the buffer of the MoleculeIterator.
+The reads are shared between the fragments, the peak RSS increase is caused by
+the fragments only. When the fragment class supports shared settings, all
+fragments use the settings of the first fragment, as in the MoleculeIterator.
+
+Every fragment class is benchmarked in a new process, the results of different
+commits can be compared by running the benchmark on both commits.
+"""
+
+FRAGMENT_CLASSES = ('Fragment', 'SingleEndTranscript', 'NlaIIIFragment', 'CHICFragment')
+
+
+def get_read_pairs(bam_path):
+    flagger = QueryNameFlagger()
+    read_pairs = []
+    with pysam.AlignmentFile(bam_path) as alignments:
+        for R1, R2 in pysamiterators.iterators.MatePairIterator(alignments, performProperPairCheck=False):
+            if R1 is None or R2 is None:
+                continue
+            flagger.digest([R1, R2])
+            read_pairs.append([R1, R2])
+    return read_pairs
+
+
+def benchmark_fragment_class(fragment_class_name, bam_path, n):
+    """Returns the peak RSS increase in MB per 1M buffered fragments and the time per fragment in us"""
+    fragment_class = getattr(singlecellmultiomics.fragment, fragment_class_name)
+    read_pairs = get_read_pairs(bam_path)
+    # ru_maxrss is in kilobytes on linux
+    rss_start = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+    fragments = []
+    settings = {}
+    start = time.perf_counter()
+    for i in range(n):
+        fragment = fragment_class(read_pairs[i % len(read_pairs)], **settings)
+        if hasattr(fragment, 'settings'):
+            settings = {'settings': fragment.settings}
+        fragments.append(fragment)
+    seconds = time.perf_counter() - start
+
+    rss_increase = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - rss_start
+    return rss_increase / 1024 * 1_000_000 / n, seconds / n * 1e6
+
+
+def _benchmark_worker(queue, args):
+    queue.put(benchmark_fragment_class(*args))
+
+
+if __name__ == '__main__':
+    argparser = argparse.ArgumentParser(
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+        description='Benchmark the peak memory of buffered fragments')
+    argparser.add_argument('-bam', type=str, default='./data/mini_nla_test.bam', help='Bam file to read the read pairs from')
+    argparser.add_argument('-n', type=int, default=200_000, help='Amount of fragments to buffer')
+    argparser.add_argument('-use', type=str, default=','.join(FRAGMENT_CLASSES), help='Comma separated fragment classes to benchmark')
+    args = argparser.parse_args()
+
+    context = multiprocessing.get_context('spawn')
+    for fragment_class_name in args.use.split(','):
+        # Every fragment class is benchmarked in a new process to measure its peak memory usage
+        queue = context.Queue()
+        process = context.Process(target=_benchmark_worker, args=(queue, (fragment_class_name, args.bam, args.n)))
+        process.start()
+        mb_per_million, us_per_fragment = queue.get()
+        process.join()
+        print(f'{fragment_class_name}\t{mb_per_million:.0f} MB peak RSS per 1M fragments\t{us_per_fragment:.1f}us per fragment')
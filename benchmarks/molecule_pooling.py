@@ -0,0 +1,95 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+import argparse
+import os
+import random
+import tempfile
+import time
+import pysam
+import singlecellmultiomics.molecule
+import singlecellmultiomics.fragment
+from singlecellmultiomics.molecule import MoleculeIterator
+
+"""
+Benchmark of the molecule pooling methods of the MoleculeIterator.
+
+The reads of the supplied bam file are copied multiple times with a random UMI
+and a small coordinate shift, this results in a synthetic library with many
+molecules per cell, the situation in which the linear scan of pooling_method=1 is slow.
+"""
+
+
+def create_scaled_bam(source_bam_path, target_bam_path, copies, shift=5, umi_length=6, seed=42):
+    """Write a scaled up, coordinate sorted and indexed copy of source_bam_path to target_bam_path
+
+    Args:
+        source_bam_path(str) : bam file to scale up
+
+        target_bam_path(str) : path to write scaled bam file to
+
+        copies(int) : amount of copies of every read (pair)
+
+        shift(int) : every copy is shifted by copy_index * shift bp
+
+        umi_length(int) : length of the random UMI assigned to every copy
+    """
+    rng = random.Random(seed)
+    unsorted_path = target_bam_path.replace('.bam', '.unsorted.bam')
+    with pysam.AlignmentFile(source_bam_path) as source, \
+            pysam.AlignmentFile(unsorted_path, 'wb', header=source.header) as target:
+        umis = {}
+        for read in source:
+            for copy in range(copies):
+                key = (read.query_name, copy)
+                if key not in umis:
+                    umis[key] = ''.join(rng.choice('ACGT') for _ in range(umi_length))
+                record = pysam.AlignedSegment.fromstring(read.to_string(), source.header)
+                record.query_name = f'{read.query_name}_{copy}'
+                if not record.is_unmapped:
+                    record.reference_start += copy * shift
+                if not record.mate_is_unmapped and record.next_reference_id >= 0:
+                    record.next_reference_start += copy * shift
+                record.set_tag('RX', umis[key])
+                target.write(record)
+    pysam.sort('-o', target_bam_path, unsorted_path)
+    pysam.index(target_bam_path)
+    os.remove(unsorted_path)
+
+
+def run_iterator(bam_path, pooling_method, molecule_class, fragment_class, check_eject_every):
+    molecules = []
+    start = time.perf_counter()
+    with pysam.AlignmentFile(bam_path) as alignments:
+        for molecule in MoleculeIterator(alignments,
+                                         molecule_class=molecule_class,
+                                         fragment_class=fragment_class,
+                                         pooling_method=pooling_method,
+                                         check_eject_every=check_eject_every):
+            molecules.append(tuple(read.query_name for read in molecule.iter_reads()))
+    return time.perf_counter() - start, molecules
+
+
+if __name__ == '__main__':
+    argparser = argparse.ArgumentParser(
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+        description='Benchmark MoleculeIterator pooling methods on a synthetically scaled up bam file')
+    argparser.add_argument('-bam', type=str, default='./data/mini_nla_test.bam')
+    argparser.add_argument('-copies', type=str, default='10,50,100', help='Comma separated scaling factors')
+    argparser.add_argument('-shift', type=int, default=5, help='Coordinate shift per copy')
+    argparser.add_argument('-check_eject_every', type=int, default=100_000)
+    args = argparser.parse_args()
+
+    setups = [
+        ('Fragment', singlecellmultiomics.molecule.Molecule, singlecellmultiomics.fragment.Fragment),
+        ('NlaIIIFragment', singlecellmultiomics.molecule.NlaIIIMolecule, singlecellmultiomics.fragment.NlaIIIFragment)
+    ]
+
+    print('copies\tfragment_class\tmolecules\tpooling_1_s\tpooling_2_s\tspeedup\tidentical')
+    with tempfile.TemporaryDirectory() as tmp:
+        for copies in map(int, args.copies.split(',')):
+            scaled_path = os.path.join(tmp, f'scaled_{copies}.bam')
+            create_scaled_bam(args.bam, scaled_path, copies, shift=args.shift)
+            for name, molecule_class, fragment_class in setups:
+                t_linear, linear = run_iterator(scaled_path, 1, molecule_class, fragment_class, args.check_eject_every)
+                t_indexed, indexed = run_iterator(scaled_path, 2, molecule_class, fragment_class, args.check_eject_every)
+                print(f'{copies}\t{name}\t{len(linear)}\t{t_linear:.2f}\t{t_indexed:.2f}\t{t_linear/t_indexed:.1f}x\t{linear==indexed}')
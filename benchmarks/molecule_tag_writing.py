@@ -0,0 +1,110 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+import argparse
+import os
+import tempfile
+import time
+import pysam
+import singlecellmultiomics.molecule
+import singlecellmultiomics.fragment
+from singlecellmultiomics.molecule import MoleculeIterator
+
+"""
+Benchmark of writing the tags of molecules: the reads of the supplied bam file
+are assigned to NLAIII molecules, the tags are written and the molecules are
+written to a bam file.
+
+Tags set using set_meta are kept in the fragment and written once to every read
+by write_pysam. This is compared to writing every tag to the reads as soon as
+it is set, the behaviour before deferred tag writing, which is implemented
+below by EagerNlaIIIFragment.
+"""
+
+set_tag_calls = {'eager': 0, 'deferred': 0}
+
+
+class EagerNlaIIIFragment(singlecellmultiomics.fragment.NlaIIIFragment):
+    # Writes the tag to the reads for every call to set_meta
+    def set_meta(self, key, value, as_set=False):
+        self.meta[key] = value
+        for read in self:
+            if read is not None:
+                set_tag_calls['eager'] += 1
+                if as_set and read.has_tag(key):
+                    data = set(read.get_tag(key).split(','))
+                    data.add(value)
+                    read.set_tag(key, ','.join(list(data)))
+                else:
+                    read.set_tag(key, value)
+
+
+class DeferredNlaIIIFragment(singlecellmultiomics.fragment.NlaIIIFragment):
+    # Counts the set_tag calls of flush_tags
+    def flush_tags(self):
+        set_tag_calls['deferred'] += \
+            (len(self.pending_tags) + len(self.pending_tag_sets or ())) * sum(read is not None for read in self.reads)
+        super().flush_tags()
+
+
+def write_molecules(bam_path, target_path, fragment_class):
+    """Write the tagged molecules of bam_path to target_path
+
+    Returns:
+        seconds (float) : total duration
+        write_seconds (float) : time spent in write_tags and write_pysam
+    """
+    write_seconds = 0
+    start = time.perf_counter()
+    with pysam.AlignmentFile(bam_path) as alignments, \
+            pysam.AlignmentFile(target_path, 'wb', header=alignments.header) as out:
+        for molecule in MoleculeIterator(
+                alignments,
+                molecule_class=singlecellmultiomics.molecule.NlaIIIMolecule,
+                fragment_class=fragment_class):
+            write_start = time.perf_counter()
+            molecule.write_tags()
+            molecule.write_pysam(out)
+            write_seconds += time.perf_counter() - write_start
+    return time.perf_counter() - start, write_seconds
+
+
+def get_written_tags(path):
+    written = []
+    with pysam.AlignmentFile(path) as f:
+        for read in f:
+            tags = dict(read.get_tags())
+            if 'RR' in tags:
+                tags['RR'] = sorted(tags['RR'].split(','))
+            written.append((read.query_name, read.flag, tags))
+    return written
+
+
+if __name__ == '__main__':
+    argparser = argparse.ArgumentParser(
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+        description='Benchmark writing the tags of NLAIII molecules')
+    argparser.add_argument('-bam', type=str, default='./data/mini_nla_test.bam', help='Bam file to read')
+    argparser.add_argument('-repeats', type=int, default=20, help='Amount of times the bam file is processed')
+    args = argparser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        durations = {}
+        write_durations = {}
+        written = {}
+        for name, fragment_class in (
+                ('eager', EagerNlaIIIFragment),
+                ('deferred', DeferredNlaIIIFragment)):
+            target_path = os.path.join(tmp, f'{name}.bam')
+            durations[name], write_durations[name] = map(min, zip(*(
+                write_molecules(args.bam, target_path, fragment_class) for _ in range(args.repeats))))
+            set_tag_calls[name] //= args.repeats
+            written[name] = get_written_tags(target_path)
+
+    for name in durations:
+        print(f'{name}\t{set_tag_calls[name]} set_tag calls\t'
+              f'{durations[name]:.3f}s total\t{write_durations[name]:.3f}s write_tags and write_pysam')
+    print(f'set_tag calls reduced by {100 * (1 - set_tag_calls["deferred"] / set_tag_calls["eager"]):.1f}%, '
+          f'total wall time reduced by {100 * (1 - durations["deferred"] / durations["eager"]):.1f}%, '
+          f'write_tags and write_pysam time reduced by {100 * (1 - write_durations["deferred"] / write_durations["eager"]):.1f}%')
+    if written['eager'] != written['deferred']:
+        raise ValueError('The written tags differ')
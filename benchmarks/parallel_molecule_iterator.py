@@ -0,0 +1,108 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+import argparse
+import collections
+import os
+import tempfile
+import time
+import pysam
+import singlecellmultiomics.molecule
+import singlecellmultiomics.fragment
+from singlecellmultiomics.molecule import MoleculeIterator, ParallelMoleculeIterator, get_molecule_summary
+
+"""
+Benchmark of the ParallelMoleculeIterator against the MoleculeIterator.
+
+The mapped reads of the supplied bam file are tiled along their contigs, every copy is
+shifted by copy_index * distance bp. This results in a synthetic library with the
+same molecules at many loci which is split over many bins. Reads of which the mate is
+mapped to another contig or is missing are skipped, the MoleculeIterator only
+completes these fragments when the mate is read or at the end of the file.
+
+Both iterators yield a MoleculeSummary for every molecule, the summaries are
+compared after sorting.
+"""
+
+
+def create_tiled_bam(source_bam_path, target_bam_path, copies, distance):
+    """Write a tiled, coordinate sorted and indexed copy of source_bam_path to target_bam_path
+
+    Args:
+        source_bam_path(str) : bam file to tile
+
+        target_bam_path(str) : path to write tiled bam file to
+
+        copies(int) : amount of copies of every read (pair)
+
+        distance(int) : every copy is shifted by copy_index * distance bp, the amount of copies is lowered when
+            copies would be located beyond the end of a contig
+    """
+    with pysam.AlignmentFile(source_bam_path) as source:
+        mapped_reads = collections.Counter(read.query_name for read in source if not read.is_unmapped)
+    # Only write copies of which both mates are located on their contig
+    with pysam.AlignmentFile(source_bam_path) as source:
+        copies = min([copies] + [
+            (source.get_reference_length(read.reference_name) - read.reference_end) // distance + 1
+            for read in source if not read.is_unmapped])
+
+    unsorted_path = target_bam_path.replace('.bam', '.unsorted.bam')
+    with pysam.AlignmentFile(source_bam_path) as source, \
+            pysam.AlignmentFile(unsorted_path, 'wb', header=source.header) as target:
+        for read in source:
+            if read.is_unmapped or not read.mate_is_unmapped and (
+                    read.next_reference_id != read.reference_id or mapped_reads[read.query_name] != 2):
+                continue
+            for copy in range(copies):
+                record = pysam.AlignedSegment.fromstring(read.to_string(), source.header)
+                record.query_name = f'{read.query_name}_{copy}'
+                record.reference_start += copy * distance
+                if not record.mate_is_unmapped:
+                    record.next_reference_start += copy * distance
+                target.write(record)
+    pysam.sort('-o', target_bam_path, unsorted_path)
+    pysam.index(target_bam_path)
+    os.remove(unsorted_path)
+
+
+def run_serial(bam_path, molecule_class, fragment_class):
+    start = time.perf_counter()
+    with pysam.AlignmentFile(bam_path) as alignments:
+        summaries = [get_molecule_summary(molecule) for molecule in MoleculeIterator(
+            alignments, molecule_class=molecule_class, fragment_class=fragment_class)]
+    return time.perf_counter() - start, summaries
+
+
+def run_parallel(bam_path, molecule_class, fragment_class, n_processes, bin_size):
+    start = time.perf_counter()
+    summaries = list(ParallelMoleculeIterator(
+        bam_path, molecule_class=molecule_class, fragment_class=fragment_class,
+        n_processes=n_processes, bin_size=bin_size))
+    return time.perf_counter() - start, summaries
+
+
+if __name__ == '__main__':
+    argparser = argparse.ArgumentParser(
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+        description='Benchmark the ParallelMoleculeIterator on a synthetically tiled bam file')
+    argparser.add_argument('-bam', type=str, default='./data/mini_nla_test.bam')
+    argparser.add_argument('-copies', type=int, default=200, help='Amount of copies of every read')
+    argparser.add_argument('-distance', type=int, default=100_000, help='Distance between the copies')
+    argparser.add_argument('-bin_size', type=int, default=1_000_000)
+    argparser.add_argument('-t', type=str, default='1,2,4', help='Comma separated amounts of processes')
+    args = argparser.parse_args()
+
+    molecule_class = singlecellmultiomics.molecule.NlaIIIMolecule
+    fragment_class = singlecellmultiomics.fragment.NlaIIIFragment
+
+    with tempfile.TemporaryDirectory() as tmp:
+        tiled_path = os.path.join(tmp, 'tiled.bam')
+        create_tiled_bam(args.bam, tiled_path, args.copies, args.distance)
+
+        t_serial, serial = run_serial(tiled_path, molecule_class, fragment_class)
+        print(f'CPUs available: {os.cpu_count()}')
+        print('processes\tmolecules\ttime_s\tspeedup\tidentical')
+        print(f'serial\t{len(serial)}\t{t_serial:.2f}\t1.0x\tTrue')
+        serial = sorted(serial)
+        for n_processes in map(int, args.t.split(',')):
+            t_parallel, parallel = run_parallel(tiled_path, molecule_class, fragment_class, n_processes, args.bin_size)
+            print(f'{n_processes}\t{len(parallel)}\t{t_parallel:.2f}\t{t_serial/t_parallel:.1f}x\t{sorted(parallel)==serial}')
@@ -0,0 +1,78 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+import argparse
+import random
+import time
+import pkg_resources
+import pysam
+from singlecellmultiomics.barcodeFileParser.barcodeFileParser import BarcodeParser
+from singlecellmultiomics.fastqProcessing.fastqIterator import FastqRecord
+from singlecellmultiomics.modularDemultiplexer.demultiplexingStrategyLoader import DemultiplexingStrategyLoader
+from singlecellmultiomics.universalBamTagger.universalBamTagger import QueryNameFlagger
+
+"""
+Per read benchmark of the QueryNameFlagger, which copies the tags encoded in
+the query name of a mapped read to the read.
+
+Read pairs of a synthetic NLAIII library are demultiplexed, the tagged query
+names are assigned to reads which are tagged by the cached fast path and by
+the TaggedRecord based path.
+"""
+
+
+class TaggedRecordQueryNameFlagger(QueryNameFlagger):
+    # Always uses TaggedRecord.tagPysamRead
+    def tag_read(self, read):
+        return False
+
+
+def get_query_names(n, cells, seed=42):
+    barcode_folder = pkg_resources.resource_filename('singlecellmultiomics', 'modularDemultiplexer/barcodes/')
+    dmx = DemultiplexingStrategyLoader(
+        barcodeParser=BarcodeParser(barcode_folder),
+        indexParser=BarcodeParser(pkg_resources.resource_filename('singlecellmultiomics', 'modularDemultiplexer/indices/')))
+    strategy, = dmx.getSelectedStrategiesFromStringList(['NLAIII384C8U3'], verbose=False)
+    with open(f'{barcode_folder}/maya_384NLA.bc') as f:
+        barcodes = [line.strip() for line in f][:cells]
+
+    rng = random.Random(seed)
+    seq = lambda n: ''.join(rng.choice('ACGT') for _ in range(n))
+    query_names = []
+    for i in range(n):
+        records = strategy.demultiplex([
+            FastqRecord(f'@NS500414:628:H7YVNBGXC:1:11101:{i}:1046 1:N:0:GTGAAA',
+                        f'{seq(3)}{rng.choice(barcodes)}CATG{seq(40)}', '+', 'E' * 55),
+            FastqRecord(f'@NS500414:628:H7YVNBGXC:1:11101:{i}:1046 2:N:0:GTGAAA',
+                        seq(50), '+', 'E' * 50)], library='benchmark')
+        query_names += [record.asFastq().split('\n')[0][1:] for record in records]
+    return query_names
+
+
+def time_per_read(flagger, query_names, header):
+    reads = []
+    for query_name in query_names:
+        read = pysam.AlignedSegment(header)
+        read.query_name = query_name
+        read.set_tag('NM', 1)
+        reads.append(read)
+    start = time.perf_counter()
+    for read in reads:
+        flagger.digest([read])
+    return (time.perf_counter() - start) / len(reads)
+
+
+if __name__ == '__main__':
+    argparser = argparse.ArgumentParser(
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+        description='Benchmark the per read cost of tagging reads using their query name')
+    argparser.add_argument('-n', type=int, default=20_000, help='Amount of read pairs')
+    argparser.add_argument('-cells', type=int, default=96, help='Amount of cells')
+    args = argparser.parse_args()
+
+    query_names = get_query_names(args.n, args.cells)
+    header = pysam.AlignmentHeader.from_dict({'HD': {'VN': '1.6'}})
+    for name, flagger in (
+            ('TaggedRecord', TaggedRecordQueryNameFlagger()),
+            ('cached fast path', QueryNameFlagger())):
+        duration = time_per_read(flagger, query_names, header)
+        print(f'{name}\t{duration * 1e6:.2f}us per read')
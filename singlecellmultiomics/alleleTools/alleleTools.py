@@ -2,10 +2,13 @@
 # -*- coding: utf-8 -*-
 import pysam
 import argparse
+import array
 import collections
 import functools
 import gzip
 import os
+import zipfile
+import numpy as np
 from singlecellmultiomics.utils import Prefetcher
 
 def get_allele_dict():
@@ -15,6 +18,200 @@ def nested_set_defaultdict():
 def set_defaultdict():
     return collections.defaultdict (set)
 
+
+def load_npz_memmap(path):
+    """Load the arrays of an uncompressed .npz file as read only memory maps
+
+    Args:
+        path (str) : path to .npz file written by numpy.savez
+
+    Returns:
+        arrays (dict) : name -> np.ndarray backed by a memory map
+    """
+    arrays = {}
+    with zipfile.ZipFile(path) as archive:
+        members = archive.infolist()
+    if any(member.compress_type != zipfile.ZIP_STORED for member in members):
+        with np.load(path) as npz:
+            return {name: npz[name] for name in npz.files}
+
+    with open(path, 'rb') as f:
+        for member in members:
+            # Skip the local file header, its name and extra field can differ
+            # from the central directory
+            f.seek(member.header_offset + 26)
+            name_length, extra_length = np.frombuffer(f.read(4), dtype='<u2')
+            f.seek(member.header_offset + 30 + int(name_length) + int(extra_length))
+            version = np.lib.format.read_magic(f)
+            if version == (1, 0):
+                shape, fortran_order, dtype = np.lib.format.read_array_header_1_0(f)
+            else:
+                shape, fortran_order, dtype = np.lib.format.read_array_header_2_0(f)
+            name = member.filename[:-4] if member.filename.endswith('.npy') else member.filename
+            if int(np.prod(shape)) == 0:
+                arrays[name] = np.empty(shape, dtype=dtype)
+            else:
+                # A plain ndarray view avoids the overhead of the memmap subclass on every access
+                arrays[name] = np.memmap(path, dtype=dtype, mode='r', offset=f.tell(),
+                                         shape=shape, order='F' if fortran_order else 'C').view(np.ndarray)
+    return arrays
+
+
+INT32_MAX = np.iinfo(np.int32).max
+
+
+class AlleleTable():
+    """Packed variant table of a single contig
+
+    Every row describes one base at a variant position. The rows are sorted by
+    position and base. The samples associated to a base are stored as an id
+    into a table of interned sample sets, as most variants share the same
+    small amount of sample combinations.
+
+    Args:
+        positions (np.ndarray) : int32, zero based position of every row
+        bases (np.ndarray) : uint8, ASCII code of the base of every row
+        set_ids (np.ndarray) : int32, index into sample_sets for every row
+        sample_sets (tuple) : tuple of frozensets of sample names
+    """
+    version = 1
+
+    def __init__(self, positions, bases, set_ids, sample_sets):
+        self.positions = positions
+        self.bases = bases
+        self.set_ids = set_ids
+        self.sample_sets = sample_sets
+
+    def __len__(self):
+        return len(self.positions)
+
+    def __repr__(self):
+        return f'AlleleTable with {len(self)} bases at {len(np.unique(self.positions))} positions'
+
+    @classmethod
+    def empty(cls):
+        return cls(np.zeros(0, dtype=np.int32), np.zeros(0, dtype=np.uint8),
+                   np.zeros(0, dtype=np.int32), tuple())
+
+    @classmethod
+    def from_dict(cls, position_to_alleles):
+        """Create table from a position -> base -> samples dictionary"""
+        builder = AlleleTableBuilder()
+        for position in sorted(position_to_alleles):
+            if position < 0:
+                continue
+            builder.add(position, position_to_alleles[position])
+        return builder.finish()
+
+    def get(self, position, base):
+        """Obtain the samples associated to base at position
+
+        Returns:
+            samples (frozenset) or None when the position or base is not present
+        """
+        if len(base) != 1 or position < 0 or position > INT32_MAX:
+            return None
+        # The key has to match the dtype of the array, otherwise the complete array is cast on every lookup
+        index = int(self.positions.searchsorted(np.int32(position)))
+        code = ord(base)
+        while index < len(self.positions) and self.positions[index] == position:
+            if self.bases[index] == code:
+                return self.sample_sets[self.set_ids[index]]
+            index += 1
+        return None
+
+    def slice(self, start=None, end=None):
+        """Obtain a table with the variants within start-end (inclusive), the arrays are views of this table"""
+        lower = 0 if start is None else int(self.positions.searchsorted(np.int32(min(max(start, 0), INT32_MAX)), side='left'))
+        upper = len(self) if end is None else int(self.positions.searchsorted(np.int32(min(max(end, -1), INT32_MAX)), side='right'))
+        return AlleleTable(self.positions[lower:upper], self.bases[lower:upper],
+                           self.set_ids[lower:upper], self.sample_sets)
+
+    def to_dict(self):
+        """Convert table to a position -> base -> samples dictionary"""
+        position_to_alleles = collections.defaultdict(dict)
+        for position, base, set_id in zip(self.positions.tolist(), self.bases.tolist(), self.set_ids.tolist()):
+            position_to_alleles[position][chr(base)] = set(self.sample_sets[set_id])
+        return position_to_alleles
+
+    def save(self, path):
+        """Write table to an uncompressed .npz file which can be memory mapped by AlleleTable.load"""
+        sample_names = sorted(set().union(*self.sample_sets))
+        sample_index = {sample: i for i, sample in enumerate(sample_names)}
+        set_offsets = np.cumsum([0] + [len(samples) for samples in self.sample_sets]).astype(np.int32)
+        set_members = np.array([sample_index[sample]
+                                for samples in self.sample_sets
+                                for sample in sorted(samples)], dtype=np.int32)
+        temp_path = f'{path}.{os.getpid()}.unfinished'
+        with open(temp_path, 'wb') as f:
+            np.savez(f,
+                     version=np.array([self.version]),
+                     positions=np.asarray(self.positions, dtype=np.int32),
+                     bases=np.asarray(self.bases, dtype=np.uint8),
+                     set_ids=np.asarray(self.set_ids, dtype=np.int32),
+                     sample_names=np.array(sample_names, dtype=np.str_),
+                     set_offsets=set_offsets,
+                     set_members=set_members)
+        os.replace(temp_path, path)
+
+    @classmethod
+    def load(cls, path, mmap=True):
+        """Load table written by AlleleTable.save
+
+        Raises:
+            ValueError : when the file was written by an incompatible version
+        """
+        arrays = load_npz_memmap(path) if mmap else dict(np.load(path))
+        if int(arrays['version'][0]) != cls.version:
+            raise ValueError(f'{path} was written by an incompatible version')
+        sample_names = arrays['sample_names'].tolist()
+        set_offsets = arrays['set_offsets'].tolist()
+        set_members = arrays['set_members'].tolist()
+        sample_sets = tuple(
+            frozenset(sample_names[member] for member in set_members[start:end])
+            for start, end in zip(set_offsets[:-1], set_offsets[1:]))
+        return cls(arrays['positions'], arrays['bases'], arrays['set_ids'], sample_sets)
+
+
+class AlleleTableBuilder():
+    """Accumulates variants, sorted by position, into an AlleleTable"""
+
+    def __init__(self):
+        self.positions = array.array('i')
+        self.bases = array.array('B')
+        self.set_ids = array.array('i')
+        self.sample_set_ids = {}  # frozenset -> id
+        self.last_position = None
+        self.last_position_row = 0
+
+    def add(self, position, bases_to_samples):
+        """Add variant, when the position was added before the previous bases are replaced"""
+        if position == self.last_position:
+            for column in (self.positions, self.bases, self.set_ids):
+                del column[self.last_position_row:]
+        else:
+            self.last_position = position
+            self.last_position_row = len(self.positions)
+
+        for base in sorted(bases_to_samples):
+            samples = frozenset(bases_to_samples[base])
+            set_id = self.sample_set_ids.get(samples)
+            if set_id is None:
+                set_id = self.sample_set_ids[samples] = len(self.sample_set_ids)
+            self.positions.append(position)
+            self.bases.append(ord(base))
+            self.set_ids.append(set_id)
+
+    def finish(self):
+        sample_sets = [None] * len(self.sample_set_ids)
+        for samples, set_id in self.sample_set_ids.items():
+            sample_sets[set_id] = samples
+        return AlleleTable(np.frombuffer(self.positions, dtype=np.int32).copy(),
+                           np.frombuffer(self.bases, dtype=np.uint8).copy(),
+                           np.frombuffer(self.set_ids, dtype=np.int32).copy(),
+                           tuple(sample_sets))
+
+
 class AlleleResolver(Prefetcher):
 
     def clean_vcf_name(self, vcffile):
@@ -58,7 +255,7 @@ class AlleleResolver(Prefetcher):
 
             select_samples (list) : Use only these samples from the VCF file
 
-            use_cache (bool) : When this flag is true a cache file is generated containing usable SNPs for every chromosome in gzipped format
+            use_cache (bool) : When this flag is true a cache file is generated containing usable SNPs for every chromosome as memory mappable AlleleTable
 
             ignore_conversions(set) : conversions to ignore {(ref, alt), ..} , for example set( ('C','T'), ('G','A') )
 
@@ -75,11 +272,14 @@ class AlleleResolver(Prefetcher):
         self.phased = phased
         self.verbose = verbose
         self.locationToAllele = get_allele_dict()  # chrom -> pos-> base -> sample(s)
+        self.allele_tables = {}  # chrom -> AlleleTable
         self.select_samples = select_samples
         self.region_start = region_start
         self.region_end = region_end
 
         self.lazyLoad = lazyLoad
+        self.uglyMode = uglyMode
+        self.vcffile = None
 
         if vcffile is None:
             return
@@ -104,6 +304,7 @@ class AlleleResolver(Prefetcher):
                 raise NotImplementedError(
                     "Sample selection is not implemented for non proper VCF")
             lazyLoad = False
+        self.uglyMode = uglyMode
 
         # collections.defaultdict(set) ) #(chrom, pos)-> base -> sample(s)
 
@@ -147,78 +348,76 @@ class AlleleResolver(Prefetcher):
 
             chrom (str):  contig/chromosome to write cache file for (every contig has it's own cache)
         """
-        temp_path = path + '.unfinished'
-        with gzip.open(temp_path, 'wt') as f:
-            for position in sorted(list(self.locationToAllele[chrom].keys())):
-                for base in self.locationToAllele[chrom][position]:
-                    f.write(
-                        f'{position}\t{base}\t{",".join(sorted(list(self.locationToAllele[chrom][position][base])))}\n')
-        os.rename(temp_path, path)
+        table = self.allele_tables.get(chrom)
+        if table is None:
+            table = AlleleTable.from_dict(self.locationToAllele[chrom])
+        table.save(path)
 
     def read_cached(self, path, chrom):
-        """Read cache file
+        """Read cache file, only the variants within region_start-region_end are selected
 
         Args:
             path (str):  path of the cache file
             chrom (str):  contig/chromosome
         """
-        with gzip.open(path, 'rt') as f:
-            for line in f:
-                position, base, samples = line.strip().split('\t', 3)
-                position = int(position)
-                if self.region_start is not None and position<self.region_start:
-                    continue
-                if self.region_end is not None and position>self.region_end:
-                    break
-
-                self.locationToAllele[chrom][position][base] = set(samples.split(','))
-
-
+        self.allele_tables[chrom] = AlleleTable.load(path).slice(self.region_start, self.region_end)
 
     def instance(self, arg_update):
         if 'self' in self.args:
             del self.args['self']
-        clone = AlleleResolver(**self.args)
+        args = dict(self.args)
+        args.update(arg_update)
+        clone = AlleleResolver(**args)
         return clone
 
 
     def prefetch(self, contig, start, end):
 
-        clone = self.instance({'region_start':start, 'region_end':end})
+        if self.uglyMode or self.vcffile is None:
+            # All variants are already loaded to memory
+            return self
+
+        clone = self.instance({'region_start':start, 'region_end':end, 'lazyLoad':True})
+        if contig in self.allele_tables:
+            clone.allele_tables[contig] = self.allele_tables[contig].slice(start, end)
+            return clone
 
         #print(f'Prefetching {contig}:{start}-{end}')
         try:
-            self.fetchChromosome(self.vcffile, contig, True)
+            clone.fetchChromosome(clone.vcffile, contig, True)
         except ValueError:
             # This means the chromosome is not available
-            pass
+            clone.allele_tables[contig] = AlleleTable.empty()
         return clone
 
+    def get_cache_path(self, vcffile, chrom):
+        """Obtain path of the cache file of chrom, or None when the contig should not be cached"""
+        if chrom is None or (chrom.startswith('KN') or chrom.startswith('KZ') or chrom.startswith(
+                'chrUn') or chrom.endswith('_random') or 'ERCC' in chrom):
+            return None
+
+        allele_dir = f'{os.path.abspath(vcffile)}_allele_cache/'
+        if not os.path.exists(allele_dir):
+            os.makedirs(allele_dir, exist_ok=True)
+        cache_file_name = f'{allele_dir}/{chrom}'
+        if self.select_samples is not None:
+            sample_list_id = '-'.join(sorted(list(self.select_samples)))
+            cache_file_name = cache_file_name + '_' + sample_list_id
+        return cache_file_name + '.npz'
+
     def fetchChromosome(self, vcffile, chrom, clear=False):
         if clear:
             self.locationToAllele = get_allele_dict()  # chrom -> pos-> base -> sample(s)
+            self.allele_tables = {}
 
         vcffile = self.clean_vcf_name(vcffile)
-        # allocate:
 
         # Decide if this is an allele we would may be cache?
-        write_cache_file_flag = False
+        cache_file_name = None
         if self.use_cache:
-            if (chrom.startswith('KN') or chrom.startswith('KZ') or chrom.startswith(
-                    'chrUn') or chrom.endswith('_random') or 'ERCC' in chrom):
-                write_cache_file_flag = False
-            else:
-                write_cache_file_flag = True
+            cache_file_name = self.get_cache_path(vcffile, chrom)
 
-        if self.use_cache and write_cache_file_flag:
-            allele_dir = f'{os.path.abspath(vcffile)}_allele_cache/'
-            if not os.path.exists(allele_dir):
-                os.makedirs(allele_dir)
-            cache_file_name = f'{allele_dir}/{chrom}'
-            if self.select_samples is not None:
-                sample_list_id = '-'.join(sorted(list(self.select_samples)))
-                cache_file_name = cache_file_name + '_' + sample_list_id
-            cache_file_name += '.tsv.gz'
+        if cache_file_name is not None:
             if os.path.exists(cache_file_name):
                 if self.verbose:
                     print(f"Cached file exists at {cache_file_name}")
@@ -228,15 +427,45 @@ class AlleleResolver(Prefetcher):
                 print(
                     f"Cache enabled, but file is not available, creating cache file at {cache_file_name}")
 
-        self.locationToAllele[chrom][-1]['N'].add('Nop')
+        # The cache file contains the complete contig, the region is selected afterwards
+        if cache_file_name is not None:
+            tables = self.read_variants(vcffile, chrom)
+        else:
+            tables = self.read_variants(vcffile, chrom, self.region_start, self.region_end)
+
+        if cache_file_name is not None:
+            if self.verbose:
+                print("writing cache file")
+            try:
+                tables.get(chrom, AlleleTable.empty()).save(cache_file_name)
+            except Exception as e:
+                if self.verbose:
+                    print(f"Exception writing cache: {e}")
+                pass  # @todo
+
+        if chrom is not None:
+            tables.setdefault(chrom, AlleleTable.empty())
+        for contig, table in tables.items():
+            self.allele_tables[contig] = table.slice(self.region_start, self.region_end)
+
+    def read_variants(self, vcffile, chrom, region_start=None, region_end=None):
+        """Read usable variants from the vcf file
+
+        Args:
+            vcffile (str) : path to vcf file
+
+            chrom (str) : contig to read variants for, None to read all contigs
 
-        unTrusted = []
+        Returns:
+            tables (dict) : contig -> AlleleTable
+        """
+        builders = collections.defaultdict(AlleleTableBuilder)
         added = 0
         if self.verbose:
             print(f'Reading variants for {chrom} ', end='')
         with pysam.VariantFile(vcffile) as v:
             try:
-                for rec in v.fetch(chrom, start=self.region_start, stop=self.region_end):
+                for rec in v.fetch(chrom, start=region_start, stop=region_end):
                     used = False
                     bad = False
                     bases_to_alleles = collections.defaultdict(
@@ -288,26 +517,13 @@ class AlleleResolver(Prefetcher):
                             ((rec.ref, base) in self.ignore_conversions for base in bases_to_alleles))
 
                     if used and not bad:
-                        self.locationToAllele[rec.chrom][rec.pos -
-                                                         1] = bases_to_alleles
+                        builders[rec.chrom].add(rec.pos - 1, bases_to_alleles)
                         added += 1
             except Exception as e:
                 raise
-        # for t in unTrusted:
-        #    if t in self.locationToAllele:
-        #        del self.locationToAllele[t[0]][t[1]]
-        #del unTrusted
         if self.verbose:
             print(f'{added} variants [OK]')
-        if self.use_cache and write_cache_file_flag:
-            if self.verbose:
-                print("writing cache file")
-            try:
-                self.write_cache(cache_file_name, chrom)
-            except Exception as e:
-                if self.verbose:
-                    print(f"Exception writing cache: {e}")
-                pass  # @todo
+        return {contig: builder.finish() for contig, builder in builders.items()}
 
     def getAllele(self, reads):
         alleles = set()
@@ -322,15 +538,22 @@ class AlleleResolver(Prefetcher):
                     alleles.update(c)
         return alleles
 
-    # @functools.lru_cache(maxsize=1000) not necessary anymore... complete data is already saved in dict
+    # @functools.lru_cache(maxsize=1000) not necessary anymore... complete data is already saved in the allele tables
 
     def getAllelesAt(self, chrom, pos, base):
-        if self.lazyLoad and chrom not in self.locationToAllele:
+        if self.lazyLoad and chrom not in self.allele_tables and chrom not in self.locationToAllele:
             try:
                 self.fetchChromosome(self.vcffile, chrom, clear=True)
             except Exception as e:
                 print(e)
-                pass
+                # Do not try to load the contig again
+                self.allele_tables[chrom] = AlleleTable.empty()
+
+        table = self.allele_tables.get(chrom)
+        if table is not None:
+            alleles = table.get(pos, base)
+            if alleles is not None:
+                return alleles
 
         if chrom not in self.locationToAllele or pos not in self.locationToAllele[chrom]:
             return None
@@ -2,6 +2,8 @@ import os
 import pysam
 import time
 import contextlib
+import heapq
+import itertools
 from shutil import which, move
 from singlecellmultiomics.utils import BlockZip, Prefetcher
 import uuid
@@ -58,6 +60,164 @@ def merge_bams( bams, output_path ):
             os.remove(o+'.bai')
     return output_path
 
+def _coordinate_sort_key(read):
+    # Unmapped reads without a mapped mate are placed at the end of a coordinate sorted file
+    return (read.reference_id if read.reference_id >= 0 else float('inf'), read.reference_start)
+
+
+class ReorderingBamWriter():
+    """Write almost coordinate sorted reads to coordinate sorted bam file(s) without sorting afterwards
+
+    Reads are kept in a reorder buffer of buffer_size reads, the read with the lowest coordinate
+    is written when the buffer is full. Reads which arrive too late to be written in order
+    are written to an overflow file, which is sorted when the writer is closed.
+    Every path in `paths` is a coordinate sorted bam file after closing the writer,
+    these can be combined using merge_sorted_bams
+
+    Example:
+        >>> with ReorderingBamWriter('out.bam', header=alignments.header) as out:
+        >>>     for molecule in molecule_iterator:
+        >>>         molecule.write_pysam(out)
+        >>> merge_sorted_bams(out.paths, 'merged.bam', header=alignments.header)
+    """
+
+    def __init__(self, write_path, header, buffer_size=100_000, mode='wb', **kwargs):
+        """
+        Args:
+            write_path (str) : path to write the sorted reads to
+
+            header (pysam.AlignmentHeader or dict) : header of the output file
+
+            buffer_size (int) : amount of reads to keep in the reorder buffer
+
+            mode (str) : Output mode, use wbu for uncompressed writing.
+
+            **kwargs : arguments to pass to the new pysam.AlignmentFile output handle
+        """
+        self.write_path = write_path
+        self.overflow_path = f'{write_path}.overflow.bam'
+        self.header = header
+        self.buffer_size = buffer_size
+        self.mode = mode
+        self.kwargs = kwargs
+
+        self.buffer = []
+        self.counter = itertools.count()
+        self.last_written = None
+        self.overflow = None
+        self.overflow_reads = 0
+        self.reads_written = 0
+        self.paths = [write_path]
+
+        # Create output folder if it does not exists
+        target_dir = os.path.dirname(write_path)
+        if len(target_dir) > 0:
+            os.makedirs(target_dir, exist_ok=True)
+        self.output = pysam.AlignmentFile(write_path, mode, header=header, **kwargs)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def write(self, read):
+        heapq.heappush(self.buffer, (_coordinate_sort_key(read), next(self.counter), read))
+        if len(self.buffer) > self.buffer_size:
+            self._write_sorted(*heapq.heappop(self.buffer))
+
+    def _write_sorted(self, key, _, read):
+        self.reads_written += 1
+        if self.last_written is not None and key < self.last_written:
+            if self.overflow is None:
+                self.overflow = pysam.AlignmentFile(f'{self.overflow_path}.unsorted', 'wbu', header=self.header)
+            self.overflow.write(read)
+            self.overflow_reads += 1
+        else:
+            self.output.write(read)
+            self.last_written = key
+
+    def close(self):
+        if self.output is None:
+            return
+        while len(self.buffer):
+            self._write_sorted(*heapq.heappop(self.buffer))
+        self.output.close()
+        self.output = None
+
+        if self.overflow is not None:
+            self.overflow.close()
+            pysam.sort('-o', self.overflow_path, '-T', f'{self.overflow_path}.tmp',
+                       '-l', '1', f'{self.overflow_path}.unsorted')
+            os.remove(f'{self.overflow_path}.unsorted')
+            self.paths.append(self.overflow_path)
+
+
+def merge_sorted_bams(bams, output_path, header, threads=4, remove_input=True):
+    """Merge coordinate sorted bam files into a single coordinate sorted and indexed bam file
+
+    The input files are opened in order of their first read, a file is only opened
+    when the merge reaches its first coordinate. Input files covering consecutive genomic regions,
+    like the outputs of tagging segments, are thereby effectively concatenated,
+    only reads at the boundaries of the files are interleaved.
+
+    Args:
+        bams : list or tuple containing paths to coordinate sorted bam files to merge
+
+        output_path (str) : target path
+
+        header (pysam.AlignmentHeader or dict) : header of the output file, the header should have the same references as the input files
+
+        threads (int) : amount of compression threads
+
+        remove_input (bool) : remove the input bam files after merging
+
+    Returns:
+        output_path (str)
+    """
+    # Obtain the first coordinate of every input file
+    pending = []
+    for i, path in enumerate(bams):
+        with pysam.AlignmentFile(path, check_sq=False) as f:
+            for read in f:
+                pending.append((_coordinate_sort_key(read), i, path))
+                break
+    pending.sort(reverse=True)
+
+    if not isinstance(header, dict):
+        header = header.to_dict()
+    header = {**header, 'HD': {**header.get('HD', {'VN': '1.6'}), 'SO': 'coordinate'}}
+
+    counter = itertools.count()
+    active = []  # heap of (key, counter, read, handle, iterator)
+    with pysam.AlignmentFile(output_path, 'wb', header=header, threads=threads) as out:
+        while len(active) or len(pending):
+            # Open the input files which start before the next read to write:
+            while len(pending) and (len(active) == 0 or pending[-1][0] <= active[0][0]):
+                _, _, path = pending.pop()
+                handle = pysam.AlignmentFile(path, check_sq=False)
+                iterator = iter(handle)
+                read = next(iterator)
+                heapq.heappush(active, (_coordinate_sort_key(read), next(counter), read, handle, iterator))
+
+            key, _, read, handle, iterator = active[0]
+            out.write(read)
+            read = next(iterator, None)
+            if read is None:
+                heapq.heappop(active)
+                handle.close()
+            else:
+                heapq.heapreplace(active, (_coordinate_sort_key(read), next(counter), read, handle, iterator))
+
+    pysam.index(output_path)
+    if remove_input:
+        for path in bams:
+            os.remove(path)
+            if os.path.exists(path + '.bai'):
+                os.remove(path + '.bai')
+    return output_path
+
+
 def verify_and_fix_bam(bam_path):
     """
     Check if the bam file is not truncated and indexed.
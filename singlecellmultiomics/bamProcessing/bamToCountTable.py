@@ -6,9 +6,12 @@ import sys
 import pysam
 import collections
 import argparse
+import array
 import pandas as pd
 import numpy as np
 import itertools
+import scipy.sparse
+from multiprocessing import Pool
 import singlecellmultiomics.modularDemultiplexer.baseDemultiplexMethods
 import gzip  # for loading blacklist bedfiles
 TagDefinitions = singlecellmultiomics.modularDemultiplexer.baseDemultiplexMethods.TagDefinitions
@@ -153,6 +156,208 @@ def read_should_be_counted(read, args, blacklist_dic = None):
     return True
 
 
+class SparseCountTableRow():
+    """Counts of a single sample of a SparseCountTable
+
+    Only supports the ``row[feature] += value`` idiom used by assignReads,
+    reading a count always returns 0 and assigning a value adds it to the table
+    """
+    __slots__ = ('table', 'sample_index')
+
+    def __init__(self, table, sample_index):
+        self.table = table
+        self.sample_index = sample_index
+
+    def __getitem__(self, feature):
+        return 0
+
+    def __setitem__(self, feature, value):
+        self.table.add(self.sample_index, feature, value)
+
+
+class SparseCountTable():
+    """Count table stored as coordinate (COO) arrays with interned sample and feature labels
+
+    Can be used instead of the defaultdict(Counter) count table in assignReads:
+    ``countTable[sample][feature] += value`` appends an observation.
+    Observations of the same sample and feature are summed when the table is
+    compacted or converted to a matrix.
+    """
+
+    def __init__(self, compact_size=5_000_000):
+        self.samples = {}  # sample label -> row index
+        self.features = {}  # feature label -> column index
+        self.rows = array.array('q')
+        self.columns = array.array('q')
+        self.values = array.array('d')
+        self.compact_size = compact_size
+        self.integer_counts = True  # False when a non integer value was added
+
+    def __getitem__(self, sample):
+        sample_index = self.samples.get(sample)
+        if sample_index is None:
+            sample_index = self.samples[sample] = len(self.samples)
+        return SparseCountTableRow(self, sample_index)
+
+    def __len__(self):
+        return len(self.values)
+
+    def add(self, sample_index, feature, value):
+        feature_index = self.features.get(feature)
+        if feature_index is None:
+            feature_index = self.features[feature] = len(self.features)
+        if self.integer_counts and type(value) is not int:
+            self.integer_counts = False
+        self.rows.append(sample_index)
+        self.columns.append(feature_index)
+        self.values.append(value)
+        if len(self.values) >= self.compact_size:
+            self.compact()
+
+    def compact(self):
+        """Sum the observations of the same sample and feature"""
+        matrix = self.to_matrix().tocoo()
+        self.rows = array.array('q', matrix.row.astype(np.int64).tobytes())
+        self.columns = array.array('q', matrix.col.astype(np.int64).tobytes())
+        self.values = array.array('d', matrix.data.astype(np.float64).tobytes())
+        # Grow the compaction size when most observations are unique
+        self.compact_size = max(self.compact_size, 2 * len(self.values))
+
+    def merge(self, other):
+        """Add the observations of another SparseCountTable to this table"""
+        sample_map = np.array([self[sample].sample_index for sample in other.samples], dtype=np.int64)
+        feature_map = np.zeros(len(other.features), dtype=np.int64)
+        for feature, feature_index in other.features.items():
+            if feature not in self.features:
+                self.features[feature] = len(self.features)
+            feature_map[feature_index] = self.features[feature]
+        if len(other.values):
+            self.rows.frombytes(sample_map[np.frombuffer(other.rows, dtype=np.int64)].tobytes())
+            self.columns.frombytes(feature_map[np.frombuffer(other.columns, dtype=np.int64)].tobytes())
+            self.values.frombytes(other.values.tobytes())
+        self.integer_counts = self.integer_counts and other.integer_counts
+        if len(self.values) >= self.compact_size:
+            self.compact()
+
+    @property
+    def sample_labels(self):
+        return list(self.samples)
+
+    @property
+    def feature_labels(self):
+        return list(self.features)
+
+    def to_matrix(self):
+        """Obtain scipy.sparse.csr_matrix with a row for every sample and a column for every feature
+
+        Observations which sum to zero are kept as explicit zeros
+        """
+        matrix = scipy.sparse.csr_matrix(
+            (np.frombuffer(self.values, dtype=np.float64),
+             (np.frombuffer(self.rows, dtype=np.int64), np.frombuffer(self.columns, dtype=np.int64))),
+            shape=(len(self.samples), len(self.features)))
+        matrix.sum_duplicates()
+        return matrix
+
+    def to_dict(self):
+        """Obtain dictionary sample->feature->count, equal to the dictionary count table"""
+        count_table = collections.defaultdict(dict)
+        samples = self.sample_labels
+        features = self.feature_labels
+        matrix = self.to_matrix().tocoo()
+        values = matrix.data.astype(np.int64) if self.integer_counts else matrix.data
+        for row, column, value in zip(matrix.row.tolist(), matrix.col.tolist(), values.tolist()):
+            count_table[samples[row]][features[column]] = value
+        return count_table
+
+
+def _label_levels(labels, prefix):
+    """Convert labels to a dictionary with an array for every level of the (tuple) labels"""
+    labels = [label if isinstance(label, tuple) else (label,) for label in labels]
+    n_levels = max((len(label) for label in labels), default=0)
+    return {f'{prefix}_level_{level}': np.array([label[level] if level < len(label) else ''
+                                                 for label in labels])
+            for level in range(n_levels)}
+
+
+def write_sparse_count_table(countTable, path, sample_names=None, feature_names=None):
+    """Write SparseCountTable to a .npz or .h5ad file
+
+    The .npz file can be read with scipy.sparse.load_npz, the labels of the
+    samples (rows) and features (columns) are stored in the same file
+    and are read by read_sparse_count_table.
+    Writing .h5ad files requires anndata to be installed.
+
+    Args:
+        countTable (SparseCountTable) : table to write
+
+        path (str) : path ending with .npz or .h5ad
+
+        sample_names (list) : names of the levels of the sample labels
+
+        feature_names (list) : names of the levels of the feature labels
+    """
+    matrix = countTable.to_matrix()
+    sample_levels = _label_levels(countTable.sample_labels, 'row')
+    feature_levels = _label_levels(countTable.feature_labels, 'column')
+    sample_names = list(sample_names) if sample_names is not None else []
+    feature_names = list(feature_names) if feature_names is not None else []
+
+    if path.endswith('.npz'):
+        np.savez_compressed(
+            path,
+            format=np.array('csr'),
+            shape=np.array(matrix.shape),
+            data=matrix.data,
+            indices=matrix.indices,
+            indptr=matrix.indptr,
+            row_names=np.array(sample_names, dtype=np.str_),
+            column_names=np.array(feature_names, dtype=np.str_),
+            **sample_levels,
+            **feature_levels)
+
+    elif path.endswith('.h5ad'):
+        try:
+            import anndata
+        except ImportError:
+            print("Please install anndata to write .h5ad files")
+            raise
+
+        def level_frame(levels, names):
+            frame = pd.DataFrame({
+                (names[i] if i < len(names) else f'level_{i}'): values
+                for i, values in enumerate(levels.values())})
+            frame.index = ['_'.join(map(str, label)) for label in zip(*levels.values())]
+            return frame
+
+        anndata.AnnData(
+            X=matrix,
+            obs=level_frame(sample_levels, sample_names),
+            var=level_frame(feature_levels, feature_names)).write_h5ad(path)
+    else:
+        raise ValueError('Sparse count tables can be written to .npz or .h5ad files')
+
+
+def read_sparse_count_table(path):
+    """Read count table written by write_sparse_count_table to a .npz file
+
+    Returns:
+        matrix (scipy.sparse.csr_matrix) : samples x features
+        sample_labels (pd.MultiIndex)
+        feature_labels (pd.MultiIndex)
+    """
+    matrix = scipy.sparse.load_npz(path)
+    with np.load(path) as npz:
+        def get_labels(prefix):
+            levels = [npz[f'{prefix}_level_{level}']
+                      for level in itertools.takewhile(
+                          lambda level: f'{prefix}_level_{level}' in npz.files, itertools.count())]
+            names = npz[f'{prefix}_names'].tolist()
+            return pd.MultiIndex.from_arrays(
+                levels, names=names if len(names) == len(levels) else None)
+        return matrix, get_labels('row'), get_labels('column')
+
+
 def tagToHumanName(tag, TagDefinitions):
     if tag not in TagDefinitions:
         return tag
@@ -434,8 +639,6 @@ def create_count_table(args, return_df=False):
             "No features supplied! Please supply -featureTags -joinedFeatureTags and or -binTag")
 
     sampleTags = args.sampleTags.split(',')
-    countTable = collections.defaultdict(
-        collections.Counter)  # cell->feature->count
 
     if args.blacklist is not None:
         # create blacklist dictionary {chromosome : [ (start1, end1), ..., (startN, endN) ]} 
@@ -455,95 +658,70 @@ def create_count_table(args, return_df=False):
     else:
         blacklist_dic = None
 
-    assigned = 0
-    for bamFile in args.alignmentfiles:
-
-        with pysam.AlignmentFile(bamFile) as f:
-            i = 0  # make sure i is defined
-            if args.bin:
-                # Obtain the reference sequence lengths
-                ref_lengths = {
-                    r: f.get_reference_length(r) for r in f.references}
-                args.ref_lengths = ref_lengths
-            if args.bedfile is None:
-                # for adding counts associated with a tag OR with binning
-                if args.contig is not None:
-                    pysam_iterator = f.fetch(args.contig)
-                else:
-                    pysam_iterator = f
-
-                for i, read in enumerate(pysam_iterator):
-                    if i % 1_000_000 == 0:
-                        print(
-                            f"{bamFile} Processed {i} reads, assigned {assigned}, completion:{100*(i/(0.001+f.mapped+f.unmapped+f.nocoordinate))}%")
-
-                    if args.head is not None and i > args.head:
-                        break
-
-                    assigned += assignReads(read,
-                                            countTable,
-                                            args,
-                                            joinFeatures,
-                                            featureTags,
-                                            sampleTags,
-                                            blacklist_dic = blacklist_dic)
-            else:  # args.bedfile is not None
-                # for adding counts associated with a bedfile
-                with open(args.bedfile, "r") as bfile:
-                    #breader = csv.reader(bfile, delimiter = "\t")
-                    for row in bfile:
-
-                        parts = row.strip().split()
-                        chromo, start, end, bname = parts[0], int(float(
-                            parts[1])), int(float(parts[2])), parts[3]
-                        if args.contig is not None and chromo != args.contig:
-                            continue
-                        for i, read in enumerate(f.fetch(chromo, start, end)):
-                            if i % 1_000_000 == 0:
-                                print(
-                                    f"{bamFile} Processed {i} reads, assigned {assigned}, completion:{100*(i/(0.001+f.mapped+f.unmapped+f.nocoordinate))}%")
-                            assigned += assignReads(read,
-                                                    countTable,
-                                                    args,
-                                                    joinFeatures,
-                                                    featureTags,
-                                                    sampleTags,
-                                                    more_args=[start,
-                                                               end,
-                                                               bname],
-                                                    blacklist_dic = blacklist_dic)
-
-                            if args.head is not None and i > args.head:
-                                break
+    n_processes = getattr(args, 't', 1) or 1
+    sparse_output = args.o is not None and (
+        args.o.endswith('.npz') or args.o.endswith('.h5ad'))
+
+    if n_processes > 1 and args.head is None:
+        # Count every contig in a separate process, the sparse count tables are merged
+        countTable = SparseCountTable()
+        tasks = [(args, bamFile, contig, joinFeatures, featureTags, sampleTags, blacklist_dic)
+                 for bamFile in args.alignmentfiles
+                 for contig in get_contigs_to_count(bamFile, args)]
+        assigned = 0
+        with Pool(n_processes) as workers:
+            for contig_table, contig_assigned in workers.imap(_count_reads_task, tasks):
+                countTable.merge(contig_table)
+                assigned += contig_assigned
+        print(f"Finished counting {len(tasks)} contigs, assigned {assigned}")
+    else:
+        if sparse_output:
+            countTable = SparseCountTable()
+        else:
+            countTable = collections.defaultdict(
+                collections.Counter)  # cell->feature->count
+        assigned = 0
+        for bamFile in args.alignmentfiles:
+            assigned += count_reads(bamFile, countTable, args, joinFeatures,
+                                    featureTags, sampleTags,
+                                    blacklist_dic=blacklist_dic,
+                                    contig=args.contig)
 
-            print(
-                f"Finished: {bamFile} Processed {i} reads, assigned {assigned}")
     print(f"Finished counting, now exporting to {args.o}")
+
+    column_names, index_names = None, None
+    if not args.noNames:
+        column_names = [tagToHumanName(t, TagDefinitions) for t in sampleTags]
+        if args.bin is not None:
+            index_names = [tagToHumanName(
+                t, TagDefinitions) for t in featureTags if t != args.binTag] + ['start', 'end']
+        elif args.bedfile is not None:
+            index_names = [tagToHumanName(
+                t, TagDefinitions) for t in featureTags if t != args.binTag] + ['start', 'end', 'bname']
+        elif joinFeatures:
+            index_names = [
+                tagToHumanName(
+                    t, TagDefinitions) for t in featureTags]
+        else:
+            index_names = ','.join(
+                [tagToHumanName(t, TagDefinitions) for t in featureTags])
+
+    if sparse_output and not return_df:
+        write_sparse_count_table(countTable, args.o,
+                                 sample_names=column_names,
+                                 feature_names=[index_names] if isinstance(index_names, str) else index_names)
+        print("Finished export.")
+        return args.o
+
+    if isinstance(countTable, SparseCountTable):
+        countTable = countTable.to_dict()
     df = pd.DataFrame.from_dict(countTable)
 
     # Set names of indices
     if not args.noNames:
-        df.columns.set_names([tagToHumanName(t, TagDefinitions)
-                              for t in sampleTags], inplace=True)
-
+        df.columns.set_names(column_names, inplace=True)
         try:
-            if args.bin is not None:
-                index_names = [tagToHumanName(
-                    t, TagDefinitions) for t in featureTags if t != args.binTag] + ['start', 'end']
-                df.index.set_names(index_names, inplace=True)
-            elif args.bedfile is not None:
-                index_names = [tagToHumanName(
-                    t, TagDefinitions) for t in featureTags if t != args.binTag] + ['start', 'end', 'bname']
-                df.index.set_names(index_names, inplace=True)
-            elif joinFeatures:
-                index_names = [
-                    tagToHumanName(
-                        t, TagDefinitions) for t in featureTags]
-                df.index.set_names(index_names, inplace=True)
-            else:
-                index_names = ','.join(
-                    [tagToHumanName(t, TagDefinitions) for t in featureTags])
-                df.index.set_names(index_names, inplace=True)
+            df.index.set_names(index_names, inplace=True)
         except Exception as e:
             pass
         print(index_names)
@@ -559,6 +737,103 @@ def create_count_table(args, return_df=False):
     print("Finished export.")
 
 
+def get_contigs_to_count(bamFile, args):
+    """Obtain the contigs of bamFile which contain reads which can be counted"""
+    with pysam.AlignmentFile(bamFile) as f:
+        contigs = [stat.contig for stat in f.get_index_statistics() if stat.mapped > 0]
+    if args.contig is not None:
+        contigs = [contig for contig in contigs if contig == args.contig]
+    return contigs
+
+
+def _count_reads_task(task):
+    args, bamFile, contig, joinFeatures, featureTags, sampleTags, blacklist_dic = task
+    countTable = SparseCountTable()
+    assigned = count_reads(bamFile, countTable, args, joinFeatures,
+                           featureTags, sampleTags,
+                           blacklist_dic=blacklist_dic,
+                           contig=contig)
+    countTable.compact()
+    return countTable, assigned
+
+
+def count_reads(bamFile, countTable, args, joinFeatures, featureTags, sampleTags, blacklist_dic=None, contig=None):
+    """Count the reads in bamFile
+
+    Args:
+        bamFile (str) : path to bam file
+
+        countTable (defaultdict(Counter) or SparseCountTable) : table to add the counts to
+
+        contig (str) : only count reads of this contig
+
+    Returns:
+        assigned (int) : amount of counted reads
+    """
+    assigned = 0
+    with pysam.AlignmentFile(bamFile) as f:
+        i = 0  # make sure i is defined
+        if args.bin:
+            # Obtain the reference sequence lengths
+            ref_lengths = {
+                r: f.get_reference_length(r) for r in f.references}
+            args.ref_lengths = ref_lengths
+        if args.bedfile is None:
+            # for adding counts associated with a tag OR with binning
+            if contig is not None:
+                pysam_iterator = f.fetch(contig)
+            else:
+                pysam_iterator = f
+
+            for i, read in enumerate(pysam_iterator):
+                if i % 1_000_000 == 0:
+                    print(
+                        f"{bamFile} Processed {i} reads, assigned {assigned}, completion:{100*(i/(0.001+f.mapped+f.unmapped+f.nocoordinate))}%")
+
+                if args.head is not None and i > args.head:
+                    break
+
+                assigned += assignReads(read,
+                                        countTable,
+                                        args,
+                                        joinFeatures,
+                                        featureTags,
+                                        sampleTags,
+                                        blacklist_dic = blacklist_dic)
+        else:  # args.bedfile is not None
+            # for adding counts associated with a bedfile
+            with open(args.bedfile, "r") as bfile:
+                #breader = csv.reader(bfile, delimiter = "\t")
+                for row in bfile:
+
+                    parts = row.strip().split()
+                    chromo, start, end, bname = parts[0], int(float(
+                        parts[1])), int(float(parts[2])), parts[3]
+                    if contig is not None and chromo != contig:
+                        continue
+                    for i, read in enumerate(f.fetch(chromo, start, end)):
+                        if i % 1_000_000 == 0:
+                            print(
+                                f"{bamFile} Processed {i} reads, assigned {assigned}, completion:{100*(i/(0.001+f.mapped+f.unmapped+f.nocoordinate))}%")
+                        assigned += assignReads(read,
+                                                countTable,
+                                                args,
+                                                joinFeatures,
+                                                featureTags,
+                                                sampleTags,
+                                                more_args=[start,
+                                                           end,
+                                                           bname],
+                                                blacklist_dic = blacklist_dic)
+
+                        if args.head is not None and i > args.head:
+                            break
+
+        print(
+            f"Finished: {bamFile} Processed {i} reads, assigned {assigned}")
+    return assigned
+
+
 if __name__ == '__main__':
     argparser = argparse.ArgumentParser(
         formatter_class=argparse.ArgumentDefaultsHelpFormatter,
@@ -566,8 +841,13 @@ if __name__ == '__main__':
     argparser.add_argument(
         '-o',
         type=str,
-        help="output csv path, or pandas dataframe if path ends with pickle.gz",
+        help="output csv path, or pandas dataframe if path ends with pickle.gz. When the path ends with .npz or .h5ad a sparse matrix (samples x features) is written",
         required=False)
+    argparser.add_argument(
+        '-t',
+        type=int,
+        default=1,
+        help="Amount of processes, the bam file(s) are counted per contig. Requires indexed bam files")
     argparser.add_argument(
         '-featureTags',
         type=str,
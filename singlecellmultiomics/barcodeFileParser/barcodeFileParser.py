@@ -7,7 +7,10 @@ from colorama import Back
 from colorama import Style
 import os
 import collections
+import hashlib
 import itertools
+import pickle
+import tempfile
 
 
 # http://codereview.stackexchange.com/questions/88912/create-a-list-of-all-strings-within-hamming-distance-of-a-reference-string-with
@@ -24,77 +27,178 @@ def hamming_circle(s, n, alphabet):
             yield ''.join(cousin)
 
 
+class LazyBarcodeTables(dict):
+    """alias -> barcode table, the barcode file belonging to an alias is loaded
+    by the BarcodeParser when the alias is accessed for the first time.
+    Aliases without barcode file behave like a defaultdict(dict)"""
+
+    def __init__(self, parser):
+        super().__init__()
+        self.parser = parser
+
+    def __missing__(self, alias):
+        if self.parser.load_alias(alias) and dict.__contains__(self, alias):
+            return dict.__getitem__(self, alias)
+        table = {}
+        dict.__setitem__(self, alias, table)
+        return table
+
+
 class BarcodeParser():
 
+    cache_version = 1
+
     def __init__(
             self,
             barcodeDirectory='barcodes',
             hammingDistanceExpansion=0,
-            spaceFill=False):
+            spaceFill=False,
+            lazy=True,
+            cache=True):
+        """
+        Args:
+            barcodeDirectory (str) : directory containing the barcode files, the file name without extension is used as alias
+
+            hammingDistanceExpansion (int) : expand the barcodes of every alias with this hamming distance
+
+            lazy (bool) : only load the barcode file of an alias when the alias is used
+
+            cache (bool) : store the hamming expanded barcodes in a .cache directory next to the barcode files
+        """
 
         barcodeDirectory = os.path.join(
             os.path.dirname(
                 os.path.realpath(__file__)),
             barcodeDirectory)
-        barcode_files = list(glob.glob(f'{barcodeDirectory}/*'))
 
         self.spaceFill = spaceFill
         self.hammingDistanceExpansion = hammingDistanceExpansion
-        self.barcodes = collections.defaultdict(
-            dict)  # alias -> barcode -> index
-        # alias -> barcode -> (index, hammingDistance)
-        self.extendedBarcodes = collections.defaultdict(dict)
-
-        for barcodeFile in barcode_files:
-            barcodeFileAlias = os.path.splitext(
-                os.path.basename(barcodeFile))[0]
-            logging.info(f"Parsing {barcodeFile}, alias {barcodeFileAlias}")
-
-            # Decide the file type (index first or name first)
-            indexNotFirst = False
-            with open(barcodeFile) as f:
-                for i, line in enumerate(f):
-                    parts = line.strip().split()
-                    if len(parts) == 1 and ' ' in line:
-                        parts = line.strip().split(' ')
-                    if len(parts) == 1:
-                        pass
-                    elif len(parts) == 2:
-                        indexFirst = not all((c in 'ATCGNX') for c in parts[0])
-                        if not indexFirst:
-                            indexNotFirst = True
-                        # print(parts[1],indexFirst)
-
-            with open(barcodeFile) as f:
-                for i, line in enumerate(f):
-                    parts = line.strip().split()
-                    if len(parts) == 1 and ' ' in line:
-                        parts = line.strip().split(' ')
-                    if len(parts) == 1:
-                        self.addBarcode(
-                            barcodeFileAlias, barcode=parts[0], index=i)
-                        #self.barcodes[barcodeFileAlias][parts[0]] = i
-                        logging.info(
-                            f"\t{parts[0]}:{i} (No index specified in file)")
-                    elif len(parts) == 2:
-                        if indexNotFirst:
-                            barcode, index = parts
-                        else:
-                            index, barcode = parts
-                        #self.barcodes[barcodeFileAlias][barcode] = index
-                        self.addBarcode(
-                            barcodeFileAlias, barcode=barcode, index=index)
-                        logging.info(
-                            f"\t{barcode}:{index} (index was specified in file, {'index' if indexFirst else 'barcode'} on first column)")
-                    else:
-                        e = f'The barcode file {barcodeFile} contains more than two columns. Failed to parse!'
-                        logging.error(e)
-                        raise ValueError(e)
+        self.cache = cache
+        # alias -> path
+        self.barcode_files = {
+            os.path.splitext(os.path.basename(barcodeFile))[0]: barcodeFile
+            for barcodeFile in sorted(glob.glob(f'{barcodeDirectory}/*'))
+            if os.path.isfile(barcodeFile)}
+        self.loaded_aliases = set()
+        self.barcodes = LazyBarcodeTables(self)  # alias -> barcode -> index
+        # alias -> barcode -> (index, originBarcode, hammingDistance)
+        self.extendedBarcodes = LazyBarcodeTables(self)
+
+        if not lazy:
+            self.load_all()
+
+    def load_all(self):
+        """Load the barcode files of all aliases"""
+        for alias in self.barcode_files:
+            self.load_alias(alias)
+
+    def load_alias(self, alias):
+        """Load the barcode file of alias, and expand it when hammingDistanceExpansion > 0
+
+        Returns:
+            loaded (bool) : True when the alias has a barcode file
+        """
+        if alias not in self.barcode_files:
+            return False
+        if alias in self.loaded_aliases:
+            return True
+        self.loaded_aliases.add(alias)
+
+        if self.hammingDistanceExpansion > 0 and self.cache and self.read_cached(alias):
+            return True
+
+        self.parse_barcode_file(alias)
+        if self.hammingDistanceExpansion > 0:
+            self.expand(self.hammingDistanceExpansion, alias=alias)
+            if self.cache:
+                self.write_cache(alias)
+        return True
+
+    def parse_barcode_file(self, barcodeFileAlias):
+        barcodeFile = self.barcode_files[barcodeFileAlias]
+        logging.info(f"Parsing {barcodeFile}, alias {barcodeFileAlias}")
+
+        rows = []
+        with open(barcodeFile) as f:
+            for line in f:
+                parts = line.strip().split()
+                if len(parts) == 1 and ' ' in line:
+                    parts = line.strip().split(' ')
+                rows.append(parts)
+
+        # Decide the file type (index first or name first)
+        indexNotFirst = False
+        for parts in rows:
+            if len(parts) == 2:
+                indexFirst = not all((c in 'ATCGNX') for c in parts[0])
+                if not indexFirst:
+                    indexNotFirst = True
+
+        for i, parts in enumerate(rows):
+            if len(parts) == 1:
+                self.addBarcode(
+                    barcodeFileAlias, barcode=parts[0], index=i)
+                logging.info(
+                    f"\t{parts[0]}:{i} (No index specified in file)")
+            elif len(parts) == 2:
+                if indexNotFirst:
+                    barcode, index = parts
+                else:
+                    index, barcode = parts
+                self.addBarcode(
+                    barcodeFileAlias, barcode=barcode, index=index)
+                logging.info(
+                    f"\t{barcode}:{index} (index was specified in file, {'index' if indexFirst else 'barcode'} on first column)")
+            else:
+                e = f'The barcode file {barcodeFile} contains more than two columns. Failed to parse!'
+                logging.error(e)
+                raise ValueError(e)
+
+    def get_cache_path(self, alias):
+        """Path to the cached expansion of alias, the path contains the hash of
+        the barcode file and the hamming distance"""
+        barcodeFile = self.barcode_files[alias]
+        with open(barcodeFile, 'rb') as f:
+            digest = hashlib.sha1(f.read()).hexdigest()
+        return os.path.join(
+            os.path.dirname(barcodeFile),
+            '.cache',
+            f'{alias}.{digest[:16]}.hd{self.hammingDistanceExpansion}.v{self.cache_version}.pickle')
+
+    def read_cached(self, alias):
+        """Load the barcodes of alias from the cache
+
+        Returns:
+            loaded (bool) : False when there is no (readable) cache
+        """
+        cache_path = self.get_cache_path(alias)
+        if not os.path.exists(cache_path):
+            return False
+        try:
+            with open(cache_path, 'rb') as f:
+                barcodes, extendedBarcodes = pickle.load(f)
+        except Exception as e:
+            logging.warning(f'Could not read barcode cache {cache_path}: {e}')
+            return False
+        dict.__setitem__(self.barcodes, alias, barcodes)
+        dict.__setitem__(self.extendedBarcodes, alias, extendedBarcodes)
+        return True
 
-        if hammingDistanceExpansion > 0:
-            for alias in list(self.barcodes.keys()):
-                # print(alias)
-                self.expand(hammingDistanceExpansion, alias=alias)
+    def write_cache(self, alias):
+        cache_path = self.get_cache_path(alias)
+        try:
+            os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+            handle, temp_path = tempfile.mkstemp(
+                dir=os.path.dirname(cache_path), suffix='.tmp')
+            with os.fdopen(handle, 'wb') as f:
+                pickle.dump((self.barcodes[alias], self.extendedBarcodes[alias]),
+                            f, protocol=pickle.HIGHEST_PROTOCOL)
+            # The cache can be shared with other users of the installation
+            os.chmod(temp_path, 0o644)
+            os.replace(temp_path, cache_path)
+        except OSError as e:
+            # The barcode directory is not writable, the expansion is not cached
+            logging.info(f'Could not write barcode cache {cache_path}: {e}')
 
     def getTargetCount(self, barcodeFileAlias):
         return(len(self.barcodes[barcodeFileAlias]), len(self.extendedBarcodes[barcodeFileAlias]))
@@ -278,6 +382,7 @@ class BarcodeParser():
         return (None, None, None)
 
     def list(self, showBarcodes=5):  # showBarcodes=None show all
+        self.load_all()
         for barcodeAlias, mapping in self.barcodes.items():
             print(
                 f'{len(mapping)} barcodes{Style.DIM} obtained from {Style.RESET_ALL}{barcodeAlias}')
@@ -295,4 +400,5 @@ class BarcodeParser():
                         (len(mapping) - showBarcodes))
 
     def getBarcodeMapping(self):
+        self.load_all()
         return self.barcodes
@@ -1,7 +1,8 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
-import gzip
+import pysam
 from singlecellmultiomics.pyutils.handlelimiter import HandleLimiter
+from singlecellmultiomics.pyutils.bufferedwriter import BufferedHandleLimiter, ParallelGzipWriter
 
 
 class FastqHandle:
@@ -10,27 +11,53 @@ class FastqHandle:
             path,
             pairedEnd=False,
             single_cell=False,
-            maxHandles=500):
+            maxHandles=500,
+            buffered=True,
+            tag_comments=False,
+            compressionLevel=1,
+            threads=2):
+        """
+        Args:
+            path (str) : prefix of the written files
+
+            pairedEnd (bool) : write R1 and R2 files
+
+            single_cell (bool) : write a separate file for every cell
+
+            buffered (bool) : buffer the records per cell and write them in large blocks
+
+            tag_comments (bool) : store the tags as SAM tags in the comment of the records
+                instead of in the read name, see TaggedRecord.asFastq
+
+            compressionLevel (int) : gzip compression level of all written files
+
+            threads (int) : amount of compression threads per file, when single_cell is False
+        """
         self.pe = pairedEnd
         self.sc = single_cell
         self.path = path
+        self.record_format = 'sam_tags' if tag_comments else 'illumina'
         if not self.sc:
-            if pairedEnd:
-                self.handles = [
-                    gzip.open(
-                        path +
-                        'R1.fastq.gz',
-                        'wt',compresslevel=1),
-                    gzip.open(
-                        path +
-                        'R2.fastq.gz',
-                        'wt',compresslevel=1)]
-            else:
-                self.handles = [gzip.open(path + 'reads.fastq.gz', 'wt')]
+            # The files are written as multiple gzip members, which are compressed in parallel
+            self.handles = [
+                ParallelGzipWriter(
+                    path + name,
+                    compressionLevel=compressionLevel,
+                    threads=threads)
+                for name in (('R1.fastq.gz', 'R2.fastq.gz') if pairedEnd else ('reads.fastq.gz',))]
+        elif buffered:
+            # Records are buffered per cell and written in large blocks
+            self.handles = BufferedHandleLimiter(
+                compressionLevel=compressionLevel, maxHandles=maxHandles)
         else:
 
             self.handles = HandleLimiter(
-                compressionLevel=1, maxHandles=maxHandles)
+                compressionLevel=compressionLevel, maxHandles=maxHandles)
+
+    def format_record(self, record):
+        if hasattr(record, 'asFastq'):
+            return record.asFastq(format=self.record_format)
+        return str(record)
 
     def write(self, records):
         if self.sc:
@@ -39,11 +66,11 @@ class FastqHandle:
                 cell = f"{record.tags.get('bi','no_cell_id')}.{record.tags.get('MX','unk')}"
                 self.handles.write(
                     f'{self.path}.{cell}.{readIdx}.fastq.gz',
-                    str(record),
+                    self.format_record(record),
                     method=1)
         else:
             for handle, record in zip(self.handles, records):
-                handle.write(str(record))
+                handle.write(self.format_record(record))
 
     def close(self):
         if self.sc:
@@ -51,3 +78,61 @@ class FastqHandle:
         else:
             for handle in self.handles:
                 handle.close()
+
+
+class UnalignedBamHandle:
+    """Writes demultiplexed records to an unaligned BAM file.
+
+    The tags are stored as BAM tags and the read name is the illumina header,
+    the tags do not need to be parsed from the read name after mapping.
+    The reads are identical to reads mapped from the fastq output after tagging.
+
+    Example:
+        >>> handle = UnalignedBamHandle('./demultiplexed', pairedEnd=True)
+        >>> handle.write([R1_record, R2_record])
+        >>> handle.close()
+    """
+    record_format = 'bam'
+
+    def __init__(self, path, pairedEnd=False, threads=1, compressionLevel=1):
+        """
+        Args:
+            path (str) : prefix of the written file, the records are written to {path}.bam
+
+            pairedEnd (bool) : the records are written as read pairs
+
+            threads (int) : amount of compression threads
+
+            compressionLevel (int) : BGZF compression level
+        """
+        self.pe = pairedEnd
+        self.path = path
+        self.handle = pysam.AlignmentFile(
+            f'{path}.bam',
+            'wb',
+            header={'HD': {'VN': '1.6', 'SO': 'unsorted'}},
+            threads=threads,
+            format_options=[f'level={compressionLevel}'.encode()])
+        if pairedEnd:
+            # Both mates are unmapped:
+            self.flags = (77, 141)
+        else:
+            self.flags = (4,)
+
+    def write(self, records):
+        for flag, record in zip(self.flags, records):
+            segment = pysam.AlignedSegment(self.handle.header)
+            segment.query_name = record.get_read_name()
+            segment.query_sequence = record.sequence
+            segment.query_qualities = pysam.qualitystring_to_array(record.qualities)
+            segment.flag = flag
+            segment.reference_id = -1
+            segment.reference_start = -1
+            segment.next_reference_id = -1
+            segment.next_reference_start = -1
+            for tag, value in record.get_pysam_tags():
+                segment.set_tag(tag, value)
+            self.handle.write(segment)
+
+    def close(self):
+        self.handle.close()
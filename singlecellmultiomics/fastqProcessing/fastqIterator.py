@@ -1,36 +1,230 @@
 # Fastq iterator class, Buys de Barbanson
 import collections
+import contextlib
+import functools
+import gc
 import gzip
 import os
+import queue
+import threading
 
 FastqRecord = collections.namedtuple(
     'FastqRecord', 'header sequence plus qual')
+# Creates a FastqRecord from a tuple of four strings without calling the python level __new__
+_make_fastq_record = functools.partial(tuple.__new__, FastqRecord)
+
+
+def open_fastq_binary(path):
+    """Open a (gzipped) fastq file for reading bytes"""
+    # Load as GZIP when the extension is .gz
+    if os.path.splitext(path)[1] == '.gz':
+        return gzip.open(path, 'rb')
+    return open(path, 'rb')
+
+
+class FastqBlockReader():
+    """Reads large decompressed blocks from a fastq file,
+    optionally in a background thread.
+
+    Example:
+        >>> for block in FastqBlockReader('./R1.fastq.gz'):
+        >>>     print(len(block))
+    """
+
+    def __init__(self, path, block_size=4_194_304, threaded=True, max_queued_blocks=4):
+        """
+        Args:
+            path (str) : path to (gzipped) fastq file
+
+            block_size (int) : amount of decompressed bytes read at once
+
+            threaded (bool) : decompress the blocks in a background thread
+
+            max_queued_blocks (int) : maximum amount of blocks read ahead by the background thread
+        """
+        self.path = path
+        self.block_size = block_size
+        self.threaded = threaded
+        self.handle = open_fastq_binary(path)
+        self.stopped = threading.Event()
+        self.queue = queue.Queue(max_queued_blocks)
+        self.thread = None
+
+    def read_block(self):
+        try:
+            return self.handle.read(self.block_size)
+        except EOFError as e:
+            raise EOFError(
+                f'{self.path} is truncated, the compressed file ended before the end-of-stream marker was reached') from e
+
+    def _put(self, item):
+        while not self.stopped.is_set():
+            try:
+                self.queue.put(item, timeout=0.1)
+                return
+            except queue.Full:
+                pass
+
+    def _run(self):
+        try:
+            while not self.stopped.is_set():
+                block = self.read_block()
+                self._put(block)
+                if not block:
+                    break
+        except Exception as e:
+            self._put(e)
+        finally:
+            self.handle.close()
+
+    def __iter__(self):
+        if not self.threaded:
+            try:
+                while True:
+                    block = self.read_block()
+                    if not block:
+                        return
+                    yield block
+            finally:
+                self.handle.close()
+
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+        try:
+            while True:
+                block = self.queue.get()
+                if isinstance(block, Exception):
+                    raise block
+                if not block:
+                    return
+                yield block
+        finally:
+            self.close()
+
+    def close(self):
+        self.stopped.set()
+        if self.thread is None:
+            self.handle.close()
+
+
+def iter_fastq_record_blocks(blocks, path=None):
+    """Split blocks of fastq bytes into FastqRecords
+
+    Args:
+        blocks (iterable) : bytes objects, consecutive parts of a fastq file
+
+        path (str) : path of the file, used in error messages
+
+    Yields:
+        records (list) : FastqRecord for every complete record in the block
+    """
+    remainder = b''
+    for block in blocks:
+        data = remainder + block
+        cut = data.rfind(b'\n') + 1
+        remainder = data[cut:]
+        lines = data[:cut].decode().split('\n')
+        lines.pop()
+        incomplete = len(lines) % 4
+        if incomplete:
+            remainder = ('\n'.join(lines[-incomplete:]) + '\n').encode() + remainder
+            del lines[-incomplete:]
+        if len(lines):
+            yield _lines_to_records(lines)
+
+    # The last line is not required to end with a newline
+    remainder = remainder.rstrip(b'\r\n')
+    if len(remainder):
+        lines = remainder.decode().split('\n')
+        if len(lines) % 4:
+            raise ValueError(
+                f'{path or "The fastq file"} ends with an incomplete record: {lines[0]}')
+        yield _lines_to_records(lines)
+
+
+@contextlib.contextmanager
+def _paused_gc():
+    # Records and read pairs can not contain reference cycles, the garbage
+    # collector is paused as it would be triggered many times while creating them
+    gc_enabled = gc.isenabled()
+    gc.disable()
+    try:
+        yield
+    finally:
+        if gc_enabled:
+            gc.enable()
+
+
+def _lines_to_records(lines):
+    if '\r' in lines[0]:
+        lines = [line.rstrip() for line in lines]
+    with _paused_gc():
+        return list(map(_make_fastq_record, zip(lines[0::4], lines[1::4], lines[2::4], lines[3::4])))
 
 
 class FastqIterator():
-    """FastqIterator, iterates over one or more fastq files."""
+    """FastqIterator, iterates over one or more fastq files.
 
-    def __init__(self, *args):
+    The files are read in large blocks which are split into records in bulk,
+    the records are available in batches using iter_batches or one read
+    pair at a time by iterating the FastqIterator.
+    """
+
+    def __init__(self, *args, block_size=4_194_304, threaded=True):
         """Initialise  FastqIterator.
 
         Argument(s):
         path to fastq file, path to fastq file 2 , ...
         example: for rec1, rec2 in FastqIterator('./R1.fastq', './R2.fastq'):
-        """
 
-        self.handles = tuple(
-            gzip.open(path, 'rt')
-            # Load as GZIP when the extension is .gz
-            if os.path.splitext(path)[1] == '.gz' else open(path, 'r')
+        block_size (int) : amount of decompressed bytes read at once per file
+
+        threaded (bool) : decompress the files in background threads
+        """
+        self.paths = args
+        self.readers = tuple(
+            FastqBlockReader(path, block_size=block_size, threaded=threaded)
             for path in args
         )
         self.readIndex = 0
+        self._batches = None
+        self._batch = []
+        self._batch_index = 0
 
-    def _readFastqRecord(self, handle):
-        # Read four lines and load them into a FastqRecord
-        return(
-            FastqRecord(*tuple(handle.readline().rstrip() for i in range(4)))
-        )
+    def iter_batches(self):
+        """Iterate over batches of read pairs
+
+        Yields:
+            batch (list) : tuples with a FastqRecord for every opened file
+
+        Raises:
+            ValueError : when the files contain a different amount of records
+        """
+        record_blocks = [
+            iter_fastq_record_blocks(reader, path)
+            for reader, path in zip(self.readers, self.paths)]
+        buffers = [[] for _ in record_blocks]
+        try:
+            while True:
+                for i, record_block in enumerate(record_blocks):
+                    if len(buffers[i]) == 0:
+                        buffers[i] = next(record_block, [])
+                batch_size = min(len(buffer) for buffer in buffers)
+                if batch_size == 0:
+                    if any(len(buffer) for buffer in buffers):
+                        raise ValueError(
+                            f'The fastq files {", ".join(self.paths)} contain a different amount of records')
+                    return
+                with _paused_gc():
+                    batch = list(zip(*(buffer[:batch_size] for buffer in buffers)))
+                buffers = [buffer[batch_size:] for buffer in buffers]
+                yield batch
+        finally:
+            self.close()
+
+    def close(self):
+        for reader in self.readers:
+            reader.close()
 
     def __iter__(self):
         """Exectuted upon generator initiation."""
@@ -38,10 +232,12 @@ class FastqIterator():
 
     def __next__(self):
         """Obtain the next fastq record for all opened files."""
+        if self._batch_index >= len(self._batch):
+            if self._batches is None:
+                self._batches = self.iter_batches()
+            self._batch = next(self._batches)
+            self._batch_index = 0
+        records = self._batch[self._batch_index]
+        self._batch_index += 1
         self.readIndex += 1  # Increment the current read counter
-        records = tuple(self._readFastqRecord(handle)
-                        for handle in self.handles)
-        # Stop when empty records are being returned; the file end is reached
-        if any((len(rec.header) == 0 for rec in records)):
-            raise StopIteration
         return(records)
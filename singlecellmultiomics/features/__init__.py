@@ -1 +1 @@
-from .features import FeatureContainer
+from .features import FeatureContainer, FeatureIndex, compile_GTF_index
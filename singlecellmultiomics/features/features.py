@@ -5,6 +5,9 @@ import gzip
 import itertools
 import re
 import functools
+import collections
+import os
+import pickle
 import pysam
 from singlecellmultiomics.utils import Prefetcher
 from copy import copy
@@ -76,8 +79,20 @@ class FeatureContainer(Prefetcher):
         return sum(len(f) for f in self.features.values())
 
 
-    def preload_GTF(self, **kwargs):
-        self.preload_list.append( {'gtf':kwargs} )
+    def preload_GTF(self, path, index_path=None, **kwargs):
+        """Register a GTF file to load when the container is prefetched, see loadGTF for the arguments
+
+        Args:
+            path (str) : path to the GTF file
+
+            index_path (str) : When supplied the GTF file is compiled into a FeatureIndex at this path (once),
+                prefetching will then slice the region from the index instead of parsing the GTF file.
+        """
+        if index_path is not None:
+            compile_GTF_index(path, index_path=index_path, remapKeys=self.remapKeys, **kwargs)
+            self.preload_list.append( {'index':{'index_path':index_path}} )
+        else:
+            self.preload_list.append( {'gtf':{'path':path, **kwargs}} )
 
 
     def instance(self, arg_update):
@@ -90,6 +105,8 @@ class FeatureContainer(Prefetcher):
                 kwargs_copy.update(arg_update)
                 if preload_type=='gtf':
                     clone.loadGTF(**kwargs_copy)
+                elif preload_type=='index':
+                    clone.loadGTFIndex(**kwargs_copy)
                 else:
                     raise ValueError()
         return clone
@@ -102,7 +119,7 @@ class FeatureContainer(Prefetcher):
     def loadGTF(self, path, thirdOnly=None, identifierFields=['gene_id'],
                 ignChr=False, select_feature_type=None, exon_select=None,
                 head=None, store_all=False, contig=None, offset=-1,
-                region_start=False, region_end=False):
+                region_start=None, region_end=None):
         """Load annotations from a GTF file.
         ignChr: ignore the chr part of the Annotation chromosome
         """
@@ -115,6 +132,32 @@ class FeatureContainer(Prefetcher):
         #prog = re.compile(pattern)
         if self.verbose:
             print("Loading %s" % path)
+        for chromosome, start, end, name, strand, data in self._parseGTF(
+                path, thirdOnly=thirdOnly, identifierFields=identifierFields, ignChr=ignChr,
+                select_feature_type=select_feature_type, exon_select=exon_select, head=head,
+                store_all=store_all, contig=contig, offset=offset,
+                region_start=region_start, region_end=region_end):
+            self.addFeature(chromosome, start, end, strand=strand, name=name, data=data)
+
+        if self.verbose:
+            print("Loaded %s features, now sorting" %
+                  sum([len(self.features[c]) for c in self.features]))
+        self.sort()
+        if self.verbose:
+            print("done sorting")
+        if self.verbose:
+            print("The following chromosomes are available:")
+            print(', '.join(sorted(list(self.startCoordinates.keys()))))
+
+    def _parseGTF(self, path, thirdOnly=None, identifierFields=['gene_id'],
+                ignChr=False, select_feature_type=None, exon_select=None,
+                head=None, store_all=False, contig=None, offset=-1,
+                region_start=None, region_end=None):
+        """Parse features from a GTF file, see loadGTF
+
+        Yields:
+            chromosome, start, end, name, strand, data
+        """
         added = 0
         with (gzip.open(path, 'rt') if path.endswith('.gz') else open(path, 'r')) as f:
             for line_id, line in enumerate(f):
@@ -188,34 +231,36 @@ class FeatureContainer(Prefetcher):
                     start = int( parts[3] ) + offset
                     end = int( parts[4] ) + offset
 
-                    if region_end is not None and end<region_start or start>region_end:
+                    if region_start is not None and region_end is not None and (end<region_start or start>region_end):
                         continue
 
                     if store_all:
                         keyValues['type'] = parts[2]
-                        self.addFeature(
-                            self.remapKeys.get(
-                                chromosome, chromosome),start,end, strand=parts[6], name=featureName, data=tuple(
-                                keyValues.items()))
+                        yield (self.remapKeys.get(chromosome, chromosome), start, end,
+                               featureName, parts[6], tuple(keyValues.items()))
 
                     else:
-                        self.addFeature(
-                            self.remapKeys.get(
-                                chromosome, chromosome), start,end, strand=parts[6], name=featureName, data=','.join(
+                        yield (self.remapKeys.get(chromosome, chromosome), start, end,
+                               featureName, parts[6], ','.join(
                                 (':'.join(
                                     ('type', parts[2])), ':'.join(
                                     ('gene_id', keyValues['gene_id'])))))
                     added += 1
 
-            if self.verbose:
-                print("Loaded %s features, now sorting" %
-                      sum([len(self.features[c]) for c in self.features]))
-            self.sort()
-            if self.verbose:
-                print("done sorting")
-        if self.verbose:
-            print("The following chromosomes are available:")
-            print(', '.join(sorted(list(self.startCoordinates.keys()))))
+    def loadGTFIndex(self, index_path, contig=None, region_start=None, region_end=None, **kwargs):
+        """Load annotations from a FeatureIndex compiled using compile_GTF_index
+
+        Args:
+            index_path (str) : path to the index
+            contig (str) : only load features of this contig
+            region_start (int) : only load features overlapping region_start-region_end of the contig
+            region_end (int) : see region_start
+        """
+        index = FeatureIndex.open(index_path)
+        for chromosome in (index.contigs if contig is None else [contig]):
+            for start, end, name, strand, data in index.fetch(chromosome, region_start, region_end):
+                self.addFeature(chromosome, start, end, strand=strand, name=name, data=data)
+        self.sort()
 
     def annotateUTRs(self, utrs=['three_prime_utr', 'five_prime_utr']):
         """flag the exons that contain a utr"""
@@ -781,6 +826,147 @@ class FeatureContainer(Prefetcher):
         self.addFeature(chromosome, start, end, name=name, data=('SNP', value))
 
 
+class FeatureIndex():
+    """Memory mapped, per contig columnar index of features, compiled from a GTF file using compile_GTF_index
+
+    For every contig the start, end and strand of the features are stored in a (start sorted) NumPy array,
+    together with an index into the interned name and data tables. Selecting the features of a region
+    does not require parsing the GTF file.
+
+    Example:
+        >>> compile_GTF_index('exons.gtf.gz', 'exons.index', select_feature_type=['exon'], store_all=True)
+        >>> index = FeatureIndex.open('exons.index')
+        >>> list(index.fetch('chr1', 14_000, 15_000))
+        [(14403, 14500, 'ENSE00001948541,ENSG00000227232', '-', (('gene_id', 'ENSG00000227232'), ...)), ...]
+    """
+
+    version = 1
+    strands = {1: '+', -1: '-', 0: None}
+    _opened = {}  # Indices opened by this process, index_path -> FeatureIndex
+
+    def __init__(self, index_path):
+        self.index_path = index_path
+        with open(f'{index_path}/meta.pickle', 'rb') as f:
+            self.meta = pickle.load(f)
+        if self.meta.get('version') != self.version:
+            raise ValueError(f'{index_path} was compiled using a different version, please remove and recompile it')
+        self.contig_features = {
+            contig: np.load(f'{index_path}/contig_{i}.npy', mmap_mode='r')
+            for contig, i in self.meta['contigs'].items()}
+        self.name_offsets, self.name_blob, self.data_offsets, self.data_blob = (
+            np.load(f'{index_path}/{table}.npy', mmap_mode='r')
+            for table in ('name_offsets', 'name_blob', 'data_offsets', 'data_blob'))
+
+    @classmethod
+    def open(cls, index_path):
+        """Open the index at index_path, the index is opened only once per process"""
+        if index_path not in cls._opened:
+            cls._opened[index_path] = cls(index_path)
+        return cls._opened[index_path]
+
+    @property
+    def contigs(self):
+        return list(self.contig_features.keys())
+
+    def get_name(self, i):
+        return self.name_blob[self.name_offsets[i]:self.name_offsets[i + 1]].tobytes().decode()
+
+    def get_data(self, i):
+        return pickle.loads(self.data_blob[self.data_offsets[i]:self.data_offsets[i + 1]].tobytes())
+
+    def fetch(self, contig, start=None, end=None):
+        """Obtain the features overlapping the region start-end (inclusive) of contig
+
+        Yields:
+            start, end, name, strand, data
+        """
+        features = self.contig_features.get(contig)
+        if features is None:
+            return
+        if start is not None and end is not None:
+            # Features starting max_feature_size before the region can overlap the region
+            lower = np.searchsorted(features['start'], start - self.meta['max_feature_size'][contig], 'left')
+            upper = np.searchsorted(features['start'], end, 'right')
+            selected = features[lower:upper]
+            selected = selected[selected['end'] >= start]
+        else:
+            selected = features
+        for feature_start, feature_end, strand, name, data in selected.tolist():
+            yield feature_start, feature_end, self.get_name(name), self.strands[strand], self.get_data(data)
+
+
+def _intern_table(values):
+    """Create an offset array and blob of the (already encoded) values"""
+    offsets = np.zeros(len(values) + 1, dtype=np.int64)
+    offsets[1:] = np.cumsum([len(value) for value in values])
+    blob = np.frombuffer(b''.join(values), dtype=np.uint8)
+    return offsets, blob
+
+
+def compile_GTF_index(path, index_path, remapKeys=None, **kwargs):
+    """Compile a GTF file into a FeatureIndex
+
+    The index is only (re)compiled when it does not exist or was compiled from a different
+    GTF file or using different arguments.
+
+    Args:
+        path (str) : path to the GTF file (can be gzipped)
+        index_path (str) : folder to write the index to
+        remapKeys (dict) : contig name conversion, see FeatureContainer.remapKeys
+        **kwargs : arguments to pass to FeatureContainer.loadGTF, selecting a contig or region is not possible
+
+    Returns:
+        index_path (str)
+    """
+    for region_arg in ('contig', 'region_start', 'region_end'):
+        kwargs.pop(region_arg, None)
+    source = (os.path.abspath(path), os.path.getsize(path), os.path.getmtime(path))
+    arguments = (sorted(kwargs.items()), sorted((remapKeys or {}).items()))
+
+    if os.path.exists(f'{index_path}/meta.pickle'):
+        with open(f'{index_path}/meta.pickle', 'rb') as f:
+            meta = pickle.load(f)
+        if meta.get('version') == FeatureIndex.version and meta.get('source') == source and meta.get('arguments') == arguments:
+            return index_path
+        os.remove(f'{index_path}/meta.pickle')
+
+    parser = FeatureContainer()
+    if remapKeys is not None:
+        parser.remapKeys = remapKeys
+    features = collections.defaultdict(list)
+    for chromosome, start, end, name, strand, data in parser._parseGTF(path, **kwargs):
+        if strand not in ('+', '-'):
+            raise ValueError('Invalid strand specified: %s' % strand)
+        features[chromosome].append((start, end, name, strand, data))
+
+    names, data_values = {}, {}
+    feature_dtype = [('start', np.int64), ('end', np.int64), ('strand', np.int8), ('name', np.int32), ('data', np.int32)]
+    os.makedirs(index_path, exist_ok=True)
+    meta = {'version': FeatureIndex.version, 'source': source, 'arguments': arguments,
+            'contigs': {}, 'max_feature_size': {}}
+    for i, (chromosome, contig_features) in enumerate(features.items()):
+        contig_features.sort()
+        np.save(f'{index_path}/contig_{i}.npy', np.array([
+            (start, end, 1 if strand == '+' else -1,
+             names.setdefault(name, len(names)),
+             data_values.setdefault(data, len(data_values)))
+            for start, end, name, strand, data in contig_features], dtype=feature_dtype))
+        meta['contigs'][chromosome] = i
+        meta['max_feature_size'][chromosome] = max(end - start for start, end, *_ in contig_features)
+
+    for table, values in (('name', [name.encode() for name in names]),
+                          ('data', [pickle.dumps(data) for data in data_values])):
+        offsets, blob = _intern_table(values)
+        np.save(f'{index_path}/{table}_offsets.npy', offsets)
+        np.save(f'{index_path}/{table}_blob.npy', blob)
+
+    # The meta file is written last, an index without meta file is incomplete
+    with open(f'{index_path}/meta.pickle', 'wb') as f:
+        pickle.dump(meta, f)
+    FeatureIndex._opened.pop(index_path, None)
+    return index_path
+
+
 def massIdConvert(
         baseIds,
         pathToIdMapping='/media/sf_data/references/human/HUMAN_9606_idmapping_selected.tab.gz',
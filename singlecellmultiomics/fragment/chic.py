@@ -1,8 +1,17 @@
-from singlecellmultiomics.fragment import Fragment
+from singlecellmultiomics.fragment import Fragment, FragmentSettings, shared_setting
 from singlecellmultiomics.utils.sequtils import hamming_distance
 
 
 class CHICFragment(Fragment):
+
+    # The cut site is part of the match_hash, the span is not compared
+    span_match_required = False
+
+    __slots__ = ('ligation_motif', 'site_location', 'cut_site_strand')
+
+    invert_strand = shared_setting('invert_strand')
+    no_umi_cigar_processing = shared_setting('no_umi_cigar_processing')
+
     def __init__(self,
                  reads,
                  R1_primer_length=4,
@@ -11,9 +20,13 @@ class CHICFragment(Fragment):
                  umi_hamming_distance=1,
                  invert_strand=True,
                  no_umi_cigar_processing=False,
+                 settings=None,
                  **kwargs
                  ):
-        self.invert_strand = invert_strand
+        if settings is None:
+            settings = FragmentSettings(
+                invert_strand=invert_strand,
+                no_umi_cigar_processing=no_umi_cigar_processing)
         Fragment.__init__(self,
                           reads,
                           assignment_radius=assignment_radius,
@@ -21,12 +34,12 @@ class CHICFragment(Fragment):
                           R2_primer_length=R2_primer_length,
                           umi_hamming_distance=umi_hamming_distance,
                           max_NUC_stretch = 18,
+                          settings=settings,
                           **kwargs
 
                 )
 
         # set CHIC cut site given reads
-        self.no_umi_cigar_processing = no_umi_cigar_processing
         self.strand = None
         self.ligation_motif = None
         self.site_location = None
@@ -1,4 +1,6 @@
 import itertools
+import operator
+import sys
 from singlecellmultiomics.utils.sequtils import hamming_distance
 import pysamiterators.iterators
 import singlecellmultiomics.modularDemultiplexer.baseDemultiplexMethods
@@ -7,6 +9,29 @@ from singlecellmultiomics.bamProcessing import get_read_group_from_read
 complement = str.maketrans('ATCGN', 'TAGCN')
 
 
+class FragmentSettings():
+    """Settings of fragments, shared by all fragments created with the same arguments.
+
+    The MoleculeIterator creates the first fragment without settings object,
+    all next fragments are supplied the settings of the first fragment.
+    The settings are accessible as attributes of the fragment, see shared_setting.
+    """
+
+    def __init__(self, **settings):
+        # Set to True when the Fragment settings have been added
+        self.complete = False
+        self.__dict__.update(settings)
+
+    def __repr__(self):
+        return 'FragmentSettings(' + ', '.join(
+            f'{key}={value!r}' for key, value in self.__dict__.items() if key != 'complete') + ')'
+
+
+def shared_setting(name):
+    """Read only fragment attribute which obtains its value from the fragment settings"""
+    return property(operator.attrgetter(f'settings.{name}'))
+
+
 class Fragment():
     """
     This class holds 1 or more reads which are derived from the same cluster
@@ -43,6 +68,26 @@ class Fragment():
 
     """
 
+    # Criteria checked by __eq__, these are used by the MoleculeIterator
+    # (pooling_method=2) to select the molecules a fragment is compared to
+    umi_match_required = True
+    span_match_required = True
+
+    # Millions of fragments can be buffered by the MoleculeIterator,
+    # the attributes are stored in slots instead of a dictionary per fragment
+    __slots__ = ('settings', 'reads', 'R1_primer_length', 'R2_primer_length', 'strand', 'meta',
+                 'pending_tags', 'pending_tag_sets', 'is_mapped', 'is_multimapped', 'mapping_quality',
+                 'match_hash', 'safe_span', 'unsafe_trimmed', 'random_primer_sequence', 'qcfail',
+                 'span', 'umi', 'sample', 'base_mapper')
+
+    tag_definitions = shared_setting('tag_definitions')
+    assignment_radius = shared_setting('assignment_radius')
+    umi_hamming_distance = shared_setting('umi_hamming_distance')
+    mapping_dir = shared_setting('mapping_dir')
+    max_fragment_size = shared_setting('max_fragment_size')
+    read_group_format = shared_setting('read_group_format')
+    max_NUC_stretch = shared_setting('max_NUC_stretch')
+
     def __init__(self, reads, assignment_radius=3, umi_hamming_distance=1,
                  R1_primer_length=0,
                  R2_primer_length=6,
@@ -50,7 +95,8 @@ class Fragment():
                  max_fragment_size = None,
                  mapping_dir=(False, True),
                  max_NUC_stretch = None,
-                 read_group_format=0  # R1 forward, R2 reverse
+                 read_group_format=0,  # R1 forward, R2 reverse
+                 settings=None
                  ):
         """
         Initialise Fragment
@@ -82,20 +128,36 @@ class Fragment():
                     True for reverse, False for forward. This parameter is used in dovetail detection
 
                 read_group_format(int) : see get_read_group()
+
+                settings(FragmentSettings) : settings shared with other fragments, when supplied
+                    the assignment_radius, umi_hamming_distance, tag_definitions, max_fragment_size,
+                    mapping_dir, max_NUC_stretch and read_group_format arguments are not used
             Returns:
                 html(string) : html representation of the fragment
         """
+        if settings is None:
+            settings = FragmentSettings()
+        if not settings.complete:
+            if tag_definitions is None:
+                tag_definitions = singlecellmultiomics.modularDemultiplexer.baseDemultiplexMethods.TagDefinitions
+            settings.tag_definitions = tag_definitions
+            settings.assignment_radius = assignment_radius
+            settings.umi_hamming_distance = umi_hamming_distance
+            settings.mapping_dir = mapping_dir
+            settings.max_fragment_size = max_fragment_size
+            settings.read_group_format = read_group_format
+            settings.max_NUC_stretch = max_NUC_stretch
+            settings.complete = True
+        self.settings = settings
+        # The primer lengths are stored per fragment, R2_primer_length is set to 0 when the primer has been trimmed
         self.R1_primer_length = R1_primer_length
         self.R2_primer_length = R2_primer_length
-        if tag_definitions is None:
-            tag_definitions = singlecellmultiomics.modularDemultiplexer.baseDemultiplexMethods.TagDefinitions
-        self.tag_definitions = tag_definitions
-        self.assignment_radius = assignment_radius
-        self.umi_hamming_distance = umi_hamming_distance
-        self.mapping_dir = mapping_dir
         self.reads = reads
         self.strand = None
         self.meta = {}  # dictionary of meta data
+        # Tags which are not yet written to the reads, see flush_tags
+        self.pending_tags = []  # tags, the values are stored in meta
+        self.pending_tag_sets = None  # tag -> (set of values, merge with the value already in the read)
         self.is_mapped = None
         # Check for multimapping
         self.is_multimapped = True
@@ -104,9 +166,6 @@ class Fragment():
         self.safe_span = None  # wether the span of the fragment could be determined
         self.unsafe_trimmed = False  # wether primers have been trimmed off
         self.random_primer_sequence = None
-        self.max_fragment_size = max_fragment_size
-        self.read_group_format = read_group_format
-        self.max_NUC_stretch = max_NUC_stretch
         self.qcfail = False
 
         # Span:\
@@ -358,6 +417,7 @@ class Fragment():
             target_file (pysam.AlignmentFile) : Target file
         """
         self.write_tags()
+        self.flush_tags()
         for read in self:
             if read is not None:
                 pysam_handle.write(read)
@@ -411,17 +471,53 @@ class Fragment():
         raise ValueError()
 
     def set_meta(self, key, value, as_set=False):
+        """Set meta information, the value is written as a tag to the reads of
+        the fragment when the fragment is written (see flush_tags)
+
+        Args:
+            key (str) : 2 letter tag
+
+            value : value to set
+
+            as_set (bool) : add the value to a comma separated set of values instead of replacing the value
+        """
+        if not as_set:
+            if key not in self.pending_tags:
+                self.pending_tags.append(key)
+            if self.pending_tag_sets is not None:
+                self.pending_tag_sets.pop(key, None)
+        else:
+            if self.pending_tag_sets is None:
+                self.pending_tag_sets = {}
+            if key in self.pending_tag_sets:
+                self.pending_tag_sets[key][0].add(value)
+            elif key in self.pending_tags:
+                self.pending_tags.remove(key)
+                data = set(str(self.meta[key]).split(','))
+                data.add(value)
+                self.pending_tag_sets[key] = (data, False)
+            else:
+                self.pending_tag_sets[key] = ({value}, True)
         self.meta[key] = value
-        for read in self:
-            if read is not None:
-                if as_set and read.has_tag(key):
 
-                    data = set(read.get_tag(key).split(','))
-                    data.add(value)
+    def flush_tags(self):
+        """Write the tags set using set_meta to the reads of the fragment.
+        Every pending tag is written once to every read, this is called by write_pysam
+        """
+        if not self.pending_tags and not self.pending_tag_sets:
+            return
+        for read in self.reads:
+            if read is None:
+                continue
+            for key in self.pending_tags:
+                read.set_tag(key, self.meta[key])
+            if self.pending_tag_sets:
+                for key, (data, merge) in self.pending_tag_sets.items():
+                    if merge and read.has_tag(key):
+                        data = data.union(read.get_tag(key).split(','))
                     read.set_tag(key, ','.join(list(data)))
-
-                else:
-                    read.set_tag(key, value)
+        self.pending_tags = []
+        self.pending_tag_sets = None
 
     def get_R1(self):
         """
@@ -486,7 +582,7 @@ class Fragment():
         for read in self.reads:
             if read is not None and not read.is_unmapped:
                 if contig is None:
-                    contig = read.reference_name
+                    contig = sys.intern(read.reference_name)
                 if contig == read.reference_name:
 
                     if start is None:
@@ -525,7 +621,8 @@ class Fragment():
         else:
             for read in self.reads:
                 if read is not None and read.has_tag('SM'):
-                    self.sample = read.get_tag('SM')
+                    # Interned, all fragments of a sample share the same string
+                    self.sample = sys.intern(read.get_tag('SM'))
                     break
 
     def get_sample(self):
@@ -567,7 +664,7 @@ class Fragment():
         """
         for read in self.reads:
             if read is not None and read.has_tag('RX'):
-                self.umi = read.get_tag('RX')
+                self.umi = sys.intern(read.get_tag('RX'))
 
     def get_umi(self):
         """
@@ -847,10 +944,12 @@ class Fragment():
                     read.is_qcfail = True
 
     def set_recognized_sequence(self, seq):
-        self.set_meta('RZ', seq)
+        self.set_meta('RZ', sys.intern(seq))
 
 
 class SingleEndTranscript(Fragment):
+    __slots__ = ()
+
     def __init__(self, reads, **kwargs):
         Fragment.__init__(self, reads, **kwargs)
 
@@ -872,6 +971,10 @@ class FeatureCountsSingleEndFragment(Fragment):
 
     """
 
+    span_match_required = False
+
+    __slots__ = ('gene', 'valid')
+
     def __init__(self,
                  reads,
                  R1_primer_length=4,
@@ -929,6 +1032,10 @@ class FeatureCountsFullLengthFragment(FeatureCountsSingleEndFragment):
 
     """
 
+    span_match_required = True
+
+    __slots__ = ()
+
     def __init__(self,
                  reads,
                  R1_primer_length=4,
@@ -967,6 +1074,8 @@ class FeatureCountsFullLengthFragment(FeatureCountsSingleEndFragment):
 
 class FragmentWithoutPosition(Fragment):
     """ Fragment without a specific location on a contig"""
+    __slots__ = ()
+
     def get_site_location(self):
         if self.has_valid_span():
             return self.span[0], 0
@@ -975,6 +1084,8 @@ class FragmentWithoutPosition(Fragment):
 
 class FragmentStartPosition(Fragment):
     """ Fragment without a specific location on a contig"""
+    __slots__ = ()
+
     def get_site_location(self):
         for read in self:
             if read is not None and not read.is_unmapped:
@@ -988,6 +1099,10 @@ class FragmentWithoutUMI(Fragment):
     Use this class when no UMI information is available
     """
 
+    umi_match_required = False
+
+    __slots__ = ()
+
     def __init__(self, reads, **kwargs):
         Fragment.__init__(self, reads, **kwargs)
 
@@ -1,8 +1,20 @@
-from singlecellmultiomics.fragment import Fragment
+from singlecellmultiomics.fragment import Fragment, FragmentSettings, shared_setting
 from singlecellmultiomics.utils.sequtils import hamming_distance
 
 
 class NlaIIIFragment(Fragment):
+
+    # The cut site is part of the match_hash, the span is not compared
+    span_match_required = False
+
+    __slots__ = ('site_location', 'cut_site_strand')
+
+    invert_strand = shared_setting('invert_strand')
+    no_overhang = shared_setting('no_overhang')
+    reference = shared_setting('reference')
+    allow_cycle_shift = shared_setting('allow_cycle_shift')
+    no_umi_cigar_processing = shared_setting('no_umi_cigar_processing')
+
     def __init__(self,
                  reads,
                  R1_primer_length=4,
@@ -13,22 +25,26 @@ class NlaIIIFragment(Fragment):
                  no_overhang =False, # CATG is present OUTSIDE the fragment
                  reference=None, #Reference is required when no_overhang=True
                  allow_cycle_shift=False,
-                 no_umi_cigar_processing=False, **kwargs
+                 no_umi_cigar_processing=False,
+                 settings=None, **kwargs
                  ):
-        self.invert_strand = invert_strand
-        self.no_overhang = no_overhang
-        self.reference = reference
-        self.allow_cycle_shift = allow_cycle_shift
-        self.no_umi_cigar_processing= no_umi_cigar_processing
-        if self.no_overhang and reference  is None:
-            raise ValueError('Supply a reference handle when no_overhang=True')
+        if settings is None:
+            if no_overhang and reference  is None:
+                raise ValueError('Supply a reference handle when no_overhang=True')
+            settings = FragmentSettings(
+                invert_strand=invert_strand,
+                no_overhang=no_overhang,
+                reference=reference,
+                allow_cycle_shift=allow_cycle_shift,
+                no_umi_cigar_processing=no_umi_cigar_processing)
 
         Fragment.__init__(self,
                           reads,
                           assignment_radius=assignment_radius,
                           R1_primer_length=R1_primer_length,
                           R2_primer_length=R2_primer_length,
-                          umi_hamming_distance=umi_hamming_distance, **kwargs)
+                          umi_hamming_distance=umi_hamming_distance,
+                          settings=settings, **kwargs)
         # set NLAIII cut site given reads
         self.strand = None
         self.site_location = None
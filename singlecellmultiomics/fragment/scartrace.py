@@ -6,6 +6,10 @@ class ScarTraceFragment(Fragment):
     Fragment definition for ScarTrace
     """
 
+    umi_match_required = False
+
+    __slots__ = ('scartrace_r1_primers',)
+
     def __init__(self, reads,scartrace_r1_primers=None, **kwargs):
         Fragment.__init__(self, reads,  **kwargs)
         self.scartrace_r1_primers = scartrace_r1_primers
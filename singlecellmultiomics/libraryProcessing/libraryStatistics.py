@@ -19,7 +19,6 @@ from singlecellmultiomics.tagtools import tagtools
 import pysamiterators.iterators as pysamIterators
 import gzip
 import pickle
-import subprocess
 from glob import glob
 
 import matplotlib
@@ -77,6 +76,10 @@ if __name__ == '__main__':
         help="only make tables")
 
     argparser.add_argument('-head', type=int)
+    argparser.add_argument('-threads', type=int, default=4,
+                           help='Amount of decompression threads used to read the tagged bam file')
+    argparser.add_argument('-processes', type=int, default=1,
+                           help='Split the tagged bam file by contig over this amount of processes, requires an indexed bam file')
     argparser.add_argument(
         '-tagged_bam',
         type=str,
@@ -229,57 +232,32 @@ if __name__ == '__main__':
             if rejectedReads is not None:
                 rc.setRawReadCount(rejectedReads + demuxReads, paired=True)
 
+        # STAR reports multi-mapping reads multiple times, for these files
+        # the unique read names are counted
+        unique_read_names = None
+        if os.path.exists(
+                f'{library}/tagged/STAR_mappedAligned.sortedByCoord.out.featureCounts.bam'):
+            unique_read_names = UniqueReadNameCount(args)
+
         if bamFile is not None and os.path.exists(bamFile):
             print(f'\tTagged > {bamFile}')
-            with pysam.AlignmentFile(bamFile) as f:
-                for i, read in enumerate(f):
-                    for statistic in statistics:
-                        statistic.processRead(read)
-                    if args.head is not None and i >= (args.head - 1):
-                        break
+            engine = StatisticEngine(
+                statistics + ([unique_read_names] if unique_read_names is not None else []))
+            engine.process_file(bamFile,
+                                head=args.head,
+                                threads=args.threads,
+                                n_processes=args.processes)
         else:
             print(f'Did not find a bam file at {bamFile}')
 
         statDict = {}
 
-        if os.path.exists(
-                f'{library}/tagged/STAR_mappedAligned.sortedByCoord.out.featureCounts.bam'):
-            cmd = f'samtools view {bamFile} -F 4 -f 64 | cut -f 1 | sort | uniq | wc -l'
-            out = subprocess.Popen(cmd,
-                                   stdout=subprocess.PIPE,
-                                   stderr=subprocess.STDOUT,
-                                   shell=True
-                                   ).communicate()[0]
-            read1mapped = int(out.partition(b' ')[0])
-            cmd = f'samtools view {bamFile} -F 4 -f 128 | cut -f 1 | sort | uniq | wc -l'
-            out = subprocess.Popen(cmd,
-                                   stdout=subprocess.PIPE,
-                                   stderr=subprocess.STDOUT,
-                                   shell=True
-                                   ).communicate()[0]
-            read2mapped = int(out.partition(b' ')[0])
-
-            rc.totalMappedReads['R1'] = read1mapped
-            rc.totalMappedReads['R2'] = read2mapped
-            # Deduplicated reads have RC:i:1 set, -f 64 selects for R2
-            cmd = f'samtools view {bamFile} -F 4 -f 64 | grep RC:i:1 | cut -f 1 | sort | uniq | wc -l'
-            out = subprocess.Popen(cmd,
-                                   stdout=subprocess.PIPE,
-                                   stderr=subprocess.STDOUT,
-                                   shell=True
-                                   ).communicate()[0]
-            read1mappeddedup = int(out.partition(b' ')[0])
-            # Deduplicated reads have RC:i:1 set, -f 128 selects for R2
-            cmd = f'samtools view {bamFile} -F 4 -f 128 | grep RC:i:1 |  cut -f 1 | sort | uniq | wc -l'
-            out = subprocess.Popen(cmd,
-                                   stdout=subprocess.PIPE,
-                                   stderr=subprocess.STDOUT,
-                                   shell=True
-                                   ).communicate()[0]
-            read2mappeddedup = int(out.partition(b' ')[0])
-
-            rc.totalDedupReads['R1'] = read1mappeddedup
-            rc.totalDedupReads['R2'] = read2mappeddedup
+        if unique_read_names is not None:
+            rc.totalMappedReads['R1'] = unique_read_names.get_count('mapped', 'R1')
+            rc.totalMappedReads['R2'] = unique_read_names.get_count('mapped', 'R2')
+            # Deduplicated reads have RC:i:1 set
+            rc.totalDedupReads['R1'] = unique_read_names.get_count('dedup', 'R1')
+            rc.totalDedupReads['R2'] = unique_read_names.get_count('dedup', 'R2')
 
         for statistic in statistics:
             try:
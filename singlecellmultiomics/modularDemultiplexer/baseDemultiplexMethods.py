@@ -1,5 +1,6 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
+import copy
 import re
 import singlecellmultiomics.fastqProcessing.fastqIterator as fastqIterator
 import string
@@ -51,6 +52,113 @@ def fqSafe(string):
 illuminaHeaderSplitRegex = re.compile(':| ', re.UNICODE)
 
 
+# Parsed illumina headers, (header, indexFileAlias, indexFileParser) -> tags or NonMultiplexable
+_illumina_header_cache = {}
+_illumina_header_cache_size = 64
+
+
+def parse_illumina_header(header, indexFileParser=None, indexFileAlias=None):
+    """Obtain the tags encoded in an illumina fastq header
+
+    The results of recently parsed headers are cached, when multiple
+    demultiplexing strategies are tried on the same read pair every header is
+    parsed and its index resolved only once.
+
+    Args:
+        header (str) : fastq header
+
+        indexFileParser (BarcodeParser) : parser used to resolve the sequencing index
+
+        indexFileAlias (str) : alias of the sequencing indices
+
+    Returns:
+        tags (dict) : tag -> value, should not be modified
+
+    Raises:
+        NonMultiplexable : when the sequencing index can not be resolved
+    """
+    key = (header, indexFileAlias, indexFileParser)
+    cached = _illumina_header_cache.get(key)
+    if cached is None:
+        try:
+            cached = _parse_illumina_header(header, indexFileParser, indexFileAlias)
+        except NonMultiplexable as e:
+            cached = e
+        if len(_illumina_header_cache) >= _illumina_header_cache_size:
+            _illumina_header_cache.clear()
+        _illumina_header_cache[key] = cached
+    if isinstance(cached, NonMultiplexable):
+        raise NonMultiplexable(*cached.args)
+    return cached
+
+
+def _parse_illumina_header(header, indexFileParser=None, indexFileAlias=None):
+    global illuminaHeaderSplitRegex
+    try:
+        instrument, runNumber, flowCellId, lane, tile, clusterXpos, clusterYpos, readPairNumber, isFiltered, controlNumber, indexSequence = illuminaHeaderSplitRegex.split(
+            header.strip())
+    except BaseException:
+        try:
+            instrument, runNumber, flowCellId, lane, tile, clusterXpos, clusterYpos, readPairNumber, isFiltered, controlNumber = illuminaHeaderSplitRegex.split(
+                header.strip().replace('::', ''))
+            indexSequence = "N"
+        except BaseException:
+            instrument = 'UNK'
+            runNumber = 'UNK'
+            flowCellId = 'UNK'
+            indexSequence = 'N'
+            lane = 'UNK'
+            tile = 'UNK'
+            clusterXpos = '-1'
+            clusterYpos = '-1'
+            readPairNumber = '0'
+            isFiltered = '0'
+            controlNumber = '0'
+
+            # 3-DEC: @Cluster_s_1_1101_2
+            if header.count('_') == 4:
+                _cluster_, _s_, lane, tile, readPairNumber = header.split(
+                    '_')
+                # check  that this s thingy is at the right place
+                assert(_s_ == 's')
+            else:
+                raise
+
+        # NS500413:32:H14TKBGXX:2:11101:16448:1664 1:N:0::
+    tags = {
+        'Is': instrument,
+        'RN': runNumber,
+        'Fc': flowCellId,
+        'La': lane,
+        'Ti': tile,
+        'CX': clusterXpos,
+        'CY': clusterYpos,
+        'RP': readPairNumber,
+        'Fi': isFiltered,
+        'CN': controlNumber
+    }
+
+    if indexFileParser is not None and indexFileAlias is not None:
+        # Check if the index is an integer:
+        try:
+            indexInteger = int(indexSequence)
+            indexIdentifier, correctedIndex, hammingDistance = indexSequence, indexSequence, 0
+        except Exception:
+            indexIdentifier, correctedIndex, hammingDistance = indexFileParser.getIndexCorrectedBarcodeAndHammingDistance(
+                alias=indexFileAlias, barcode=indexSequence)
+
+        tags['aa'] = fqSafe(indexSequence)
+        if correctedIndex is not None:
+            tags.update({'aA': correctedIndex, 'aI': indexIdentifier})
+        else:
+            raise NonMultiplexable(
+                'Could not obtain index for %s  %s %s' %
+                (indexSequence, correctedIndex, indexIdentifier))
+    else:
+        tags['aa'] = indexSequence
+    return tags
+
+
 class TaggedRecord():
     def __init__(
             self,
@@ -76,6 +184,18 @@ class TaggedRecord():
             self.qualities = rawRecord.qual
             self.plus = rawRecord.plus
 
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        # The default tag definitions are not copied when sending records to another process
+        if state.get('tagDefinitions') is TagDefinitions:
+            state['tagDefinitions'] = None
+        return state
+
+    def __setstate__(self, state):
+        if state.get('tagDefinitions') is None:
+            state['tagDefinitions'] = TagDefinitions
+        self.__dict__.update(state)
+
     def addTagByTag(
             self,
             tagName,
@@ -115,6 +235,14 @@ class TaggedRecord():
             dirAtt=None,
             baseQualities=None,
             format='illumina'):
+        """Obtain fastq representation of the record
+
+        Args:
+            format (str) : 'illumina' : the tags are encoded in the read name,
+                'sam_tags' : the read name is the illumina header and the tags are stored
+                in the comment as tab separated SAM tags. Aligners which copy the
+                comment (bwa mem -C) write the tags to the alignments.
+        """
         if sequence is None:
             if self.sequence is None:
                 raise ValueError()
@@ -128,6 +256,15 @@ class TaggedRecord():
                 raise ValueError()
             baseQualities = self.qualities
 
+        if format == 'sam_tags':
+            return "@%s\t%s\n%s\n%s\n%s\n" % (
+                self.get_read_name(),
+                '\t'.join(format_sam_tag(tag, value) for tag, value in self.get_pysam_tags()),
+                sequence,
+                dirAtt,
+                baseQualities
+            )
+
         header = ";".join([f"{attribute}:{value}" for attribute, value in self.tags.items(
         ) if not self.tagDefinitions[attribute].doNotWrite])
         if len(header) > 255:  # the header length is stored as uint_8 and includes a null character. The maximum length is thus 255
@@ -151,94 +288,33 @@ class TaggedRecord():
             fastqRecord,
             indexFileParser=None,
             indexFileAlias=None):
-        global illuminaHeaderSplitRegex
-        try:
-            instrument, runNumber, flowCellId, lane, tile, clusterXpos, clusterYpos, readPairNumber, isFiltered, controlNumber, indexSequence = illuminaHeaderSplitRegex.split(
-                fastqRecord.header.strip())
-        except BaseException:
-            try:
-                instrument, runNumber, flowCellId, lane, tile, clusterXpos, clusterYpos, readPairNumber, isFiltered, controlNumber = illuminaHeaderSplitRegex.split(
-                    fastqRecord.header.strip().replace('::', ''))
-                indexSequence = "N"
-            except BaseException:
-                instrument = 'UNK'
-                runNumber = 'UNK'
-                flowCellId = 'UNK'
-                indexSequence = 'N'
-                lane = 'UNK'
-                tile = 'UNK'
-                clusterXpos = '-1'
-                clusterYpos = '-1'
-                readPairNumber = '0'
-                isFiltered = '0'
-                controlNumber = '0'
-
-                # 3-DEC: @Cluster_s_1_1101_2
-                if fastqRecord.header.count('_') == 4:
-                    _cluster_, _s_, lane, tile, readPairNumber = fastqRecord.header.split(
-                        '_')
-                    # check  that this s thingy is at the right place
-                    assert(_s_ == 's')
-                else:
-                    raise
-
-            # NS500413:32:H14TKBGXX:2:11101:16448:1664 1:N:0::
-        """ This is the nice and safe way:
-        self.addTagByTag( 'Is',instrument, isPhred=False)
-        self.addTagByTag('RN',runNumber, isPhred=False)
-        self.addTagByTag('Fc',flowCellId, isPhred=False)
-        self.addTagByTag('La',lane, isPhred=False)
-        self.addTagByTag('Ti',tile, isPhred=False)
-        self.addTagByTag('CX',clusterXpos, isPhred=False)
-        self.addTagByTag('CY',clusterYpos, isPhred=False)
-        self.addTagByTag('RP',readPairNumber, isPhred=False)
-        self.addTagByTag('Fi',isFiltered, isPhred=False)
-        self.addTagByTag('CN',controlNumber, isPhred=False)
-        """
-        self.tags.update({
-            'Is': instrument,
-            'RN': runNumber,
-            'Fc': flowCellId,
-            'La': lane,
-            'Ti': tile,
-            'CX': clusterXpos,
-            'CY': clusterYpos,
-            'RP': readPairNumber,
-            'Fi': isFiltered,
-            'CN': controlNumber
-        })
+        self.tags.update(parse_illumina_header(
+            fastqRecord.header, indexFileParser, indexFileAlias))
 
+    def tagPysamRead(self, read):
+        for tag, value in self._finalise_tags():
+            read.set_tag(tag, value)
 
+    def get_pysam_tags(self):
+        """Obtain the tags which tagPysamRead writes to a read, the record is not modified.
+        Tags which are not written to the fastq header (doNotWrite) are skipped and
+        the values are converted to strings as when they are read from the read name,
+        the tags are thus identical to the tags obtained by tagging a read mapped from asFastq()
 
+        Returns:
+            tags (list) : [(tag, value), ...]
+        """
+        record = copy.copy(self)
+        record.tags = {tag: fqSafe(str(value)) for tag, value in self.tags.items()
+                       if not self.tagDefinitions[tag].doNotWrite}
+        return record._finalise_tags()
 
-        if indexFileParser is not None and indexFileAlias is not None:
-            # Check if the index is an integer:
-            try:
-                indexInteger = int(indexSequence)
-                indexIdentifier, correctedIndex, hammingDistance = indexSequence, indexSequence, 0
-            except Exception:
-                indexIdentifier, correctedIndex, hammingDistance = indexFileParser.getIndexCorrectedBarcodeAndHammingDistance(
-                    alias=indexFileAlias, barcode=indexSequence)
-
-            self.addTagByTag('aa', indexSequence, isPhred=False)
-            if correctedIndex is not None:
-                #
-                #self.addTagByTag('aA',correctedIndex, isPhred=False)
-                #self.addTagByTag('aI',indexIdentifier, isPhred=False)
-                self.tags.update({'aA': correctedIndex, 'aI': indexIdentifier})
-            else:
-                raise NonMultiplexable(
-                    'Could not obtain index for %s  %s %s' %
-                    (indexSequence, correctedIndex, indexIdentifier))
-                # self.addTagByTag('aA',"None")
-                # self.addTagByTag('aI',-1)
-                # self.addTagByTag('ah',hammingDistance)
+    def get_read_name(self):
+        """Obtain the read name which tagging a read mapped from asFastq() results in"""
+        return ':'.join(fqSafe(str(self.tags[tag])) for tag in ('Is', 'RN', 'Fc', 'La', 'Ti', 'CX', 'CY'))
 
-        else:
-            #self.addTagByTag('aA',indexSequence, isPhred=False)
-            self.tags['aa'] = indexSequence
-
-    def tagPysamRead(self, read):
+    def _finalise_tags(self):
+        # Adds the molecule identifier and sample tags, returns the tags to write to a read
 
         moleculeIdentifier = ""
         moleculeQuality = ""
@@ -310,18 +386,19 @@ class TaggedRecord():
 
 
 
-        # Now we defined the desired values of the tags. Write them to the
-        # record:
+        # Now we defined the desired values of the tags:
+        tags = []
         for tag, value in self.tags.items():
             # print(tag,value)
             if self.tagDefinitions[tag].isPhred:
                 value = fastqHeaderSafeQualitiesToPhred(value, method=3)
-            read.set_tag(tag, value)
+            tags.append((tag, value))
 
-        if not QT_missing and read.has_tag('QM') and len(
-                read.get_tag('QM')) != len(
-                read.get_tag('MI')):
+        if not QT_missing and 'QM' in self.tags and len(
+                self.tags['QM']) != len(
+                self.tags['MI']):
             raise ValueError('QM and MI tag length not matching')
+        return tags
 
     def fromTaggedFastq(self, fastqRecord):
         for keyValue in fastqRecord.header.replace('@', '').strip().split(';'):
@@ -334,11 +411,26 @@ class TaggedRecord():
             self.addTagByTag(key, value, isPhred=False)
 
 
+def format_sam_tag(tag, value):
+    """Format a tag as in a SAM file, for example RX:Z:ACG"""
+    if isinstance(value, (bool, int)):
+        return f'{tag}:i:{int(value)}'
+    if isinstance(value, float):
+        return f'{tag}:f:{value}'
+    return f'{tag}:Z:{value}'
+
+
 def reverseComplement(seq):
     global complement
     return("".join(complement.get(base, base) for base in reversed(seq)))
 
 
+# Translation of ASCII encoded phred scores to letters, used by phredToFastqHeaderSafeQualities method 3
+_max_header_safe_phred = chr(33 + len(string.ascii_letters))
+_header_safe_phred_table = str.maketrans({
+    chr(i): string.ascii_letters[max(0, i - 33)] for i in range(33 + len(string.ascii_letters))})
+
+
 def phredToFastqHeaderSafeQualities(asciiEncodedPhredScores, method=3):
     """ Convert ASCII encoded pred string to fastq safe string.
     numeric encoded string (method 0),
@@ -348,12 +440,23 @@ def phredToFastqHeaderSafeQualities(asciiEncodedPhredScores, method=3):
     elif method == 1:
         return("".join([chr(ord(phred) + 32) for phred in asciiEncodedPhredScores]))
     else:
-        return("".join([string.ascii_letters[min(max(0, ord(phred) - 33), len(string.ascii_letters))] for phred in asciiEncodedPhredScores]))
+        if len(asciiEncodedPhredScores) and max(asciiEncodedPhredScores) >= _max_header_safe_phred:
+            # Not representable, raises an IndexError
+            return("".join([string.ascii_letters[min(max(0, ord(phred) - 33), len(string.ascii_letters))] for phred in asciiEncodedPhredScores]))
+        return asciiEncodedPhredScores.translate(_header_safe_phred_table)
+
+
+# Translation of header safe qualities back to ASCII encoded phred scores
+_header_safe_qualities_regex = re.compile('[a-zA-Z]*')
+_header_safe_to_phred_table = str.maketrans(
+    string.ascii_letters, ''.join(chr(i + 33) for i in range(len(string.ascii_letters))))
 
 
 def fastqHeaderSafeQualitiesToPhred(phred, method=3):
-    # print(phred)
-    return "".join((chr(string.ascii_letters.index(v) + 33) for v in phred))
+    if _header_safe_qualities_regex.fullmatch(phred) is None:
+        # Not a header safe string, raises a ValueError
+        return "".join((chr(string.ascii_letters.index(v) + 33) for v in phred))
+    return phred.translate(_header_safe_to_phred_table)
 
 
 class NonMultiplexable(Exception):
@@ -524,13 +627,6 @@ class UmiBarcodeDemuxMethod(IlluminaBaseDemultiplexer):
         if len(records) != 2:
             raise NonMultiplexable('Not mate pair')
 
-        # Perform first pass demultiplexing of the illumina fragments:
-        try:
-            taggedRecords = IlluminaBaseDemultiplexer.demultiplex(
-                self, records, inherited=True, **kwargs)
-        except NonMultiplexable:
-            raise
-
         rawBarcode = records[self.barcodeRead].sequence[self.barcodeStart:
                                                         self.barcodeStart + self.barcodeLength]
         barcodeQual = records[self.barcodeRead].qual[self.barcodeStart:
@@ -540,9 +636,21 @@ class UmiBarcodeDemuxMethod(IlluminaBaseDemultiplexer):
             alias=self.barcodeFileAlias, barcode=rawBarcode)
         #print(self.barcodeFileParser,self.barcodeFileAlias,rawBarcode,barcodeIdentifier, barcode, hammingDistance)
         if barcodeIdentifier is None:
+            # The records are not tagged when the barcode does not match,
+            # an unresolvable sequencing index is still reported first
+            for record in records:
+                parse_illumina_header(
+                    record.header, self.indexFileParser, self.illuminaIndicesAlias)
             raise NonMultiplexable(
                 f'bc:{rawBarcode}_not_matching_{self.barcodeFileAlias}')
 
+        # Perform first pass demultiplexing of the illumina fragments:
+        try:
+            taggedRecords = IlluminaBaseDemultiplexer.demultiplex(
+                self, records, inherited=True, **kwargs)
+        except NonMultiplexable:
+            raise
+
         random_primer = None
         if self.random_primer_read is not None:
             random_primer = records[self.random_primer_read].sequence[self.random_primer_slice]
@@ -9,13 +9,188 @@ from colorama import Back
 from colorama import Style
 import importlib
 import inspect
+import itertools
+import math
 import traceback
+import multiprocessing
+import threading
 import singlecellmultiomics.modularDemultiplexer.demultiplexModules as dm
 import singlecellmultiomics.fastqProcessing.fastqIterator as fastqIterator
 from singlecellmultiomics.modularDemultiplexer.baseDemultiplexMethods import NonMultiplexable, IlluminaBaseDemultiplexer
 import logging
 
 
+class FormattedRecord():
+    """Demultiplexed record converted to fastq text
+
+    Used to send demultiplexed records from a worker process to the writing
+    process, only the tags required by FastqHandle are kept.
+    """
+    __slots__ = ('text', 'tags')
+
+    def __init__(self, record, record_format='illumina'):
+        self.text = record.asFastq(format=record_format) if hasattr(
+            record, 'asFastq') else str(record)
+        tags = getattr(record, 'tags', None)
+        self.tags = {} if tags is None else {
+            tag: tags[tag] for tag in ('bi', 'MX') if tag in tags}
+
+    def __str__(self):
+        return self.text
+
+    def asFastq(self, format=None):
+        return self.text
+
+
+def _format_records(records, record_format):
+    if record_format == 'bam':
+        # Unaligned BAM records are created by the writing process
+        return records
+    return [FormattedRecord(record, record_format) for record in records]
+
+
+def demultiplex_read_pair(
+        reads,
+        strategies,
+        baseDemux,
+        library=None,
+        probe=None,
+        rejects=True):
+    """Demultiplex a single read pair using all supplied strategies
+
+    Args:
+        reads (tuple) : FastqRecord for every read of the pair
+
+        strategies (list) : demultiplexing strategies to apply
+
+        baseDemux (IlluminaBaseDemultiplexer) : used to format rejected reads
+
+        rejects (bool) : format rejected read pairs
+
+    Returns:
+        events (list) : ('target', records), ('reject', records) or ('error', strategy long name) in order of occurence
+        yielded (list) : short names of the strategies which yielded the read pair
+    """
+    events = []
+    yielded = []
+    for strategy in strategies:
+        try:
+            events.append(('target', strategy.demultiplex(
+                reads, library=library, probe=probe)))
+
+        except NonMultiplexable as reason:
+            if rejects:
+                try:
+                    events.append(('reject', baseDemux.demultiplex(
+                        reads, library=library, reason=reason)))
+
+                except NonMultiplexable as e:
+                    # we cannot read the header of the read..
+                    events.append(('reject', [
+                        '\n'.join(
+                            (read.header +
+                             f';RR:{reason};Rr:{e}',
+                             read.sequence,
+                             read.plus,
+                             read.qual)) for read in reads]))
+            continue
+        except Exception as e:
+            print(traceback.format_exc())
+            print(
+                f'{Fore.RED}Fatal error. While demultiplexing strategy {strategy.longName} yielded an error, the error message was: {e}')
+            print('The read(s) causing the error looked like this:')
+            for read in reads:
+                print(str(read))
+            print(Style.RESET_ALL)
+            events.append(('error', strategy.longName))
+        yielded.append(strategy.shortName)
+    return events, yielded
+
+
+def _write_demultiplex_events(events, targetFile, rejectHandle, log_handle):
+    for destination, value in events:
+        if destination == 'target':
+            if targetFile is not None:
+                targetFile.write(value)
+        elif destination == 'reject':
+            rejectHandle.write(value)
+        elif log_handle is not None:
+            log_handle.write(f"Error occured using {value}\n")
+
+
+def _read_pair_chunks(fastqfiles, chunk_size, maxReadPairs=None):
+    chunk = []
+    for p, reads in enumerate(fastqIterator.FastqIterator(*fastqfiles)):
+        if maxReadPairs is not None and p >= maxReadPairs:
+            break
+        chunk.append(reads)
+        if len(chunk) >= chunk_size:
+            yield chunk
+            chunk = []
+    if len(chunk):
+        yield chunk
+
+
+def _limit_in_flight(chunks, in_flight):
+    # The pool consumes the task iterator as fast as it can, the semaphore
+    # limits the amount of chunks which are read but not yet written
+    for chunk in chunks:
+        in_flight.acquire()
+        yield chunk
+
+
+_demultiplex_worker_state = None
+
+
+def _init_demultiplex_worker(strategies, baseDemux, library, probe, rejects, record_formats):
+    global _demultiplex_worker_state
+    _demultiplex_worker_state = (strategies, baseDemux, library, probe, rejects, record_formats)
+
+
+def _demultiplex_chunk(chunk):
+    strategies, baseDemux, library, probe, rejects, record_formats = _demultiplex_worker_state
+    chunk_events = []
+    chunk_yields = collections.Counter()
+    for reads in chunk:
+        events, yielded = demultiplex_read_pair(
+            reads, strategies, baseDemux, library=library, probe=probe, rejects=rejects)
+        chunk_events.append([
+            (destination, value if destination == 'error' else _format_records(value, record_formats[destination]))
+            for destination, value in events])
+        chunk_yields.update(yielded)
+    return len(chunk), chunk_events, chunk_yields
+
+
+def yield_confidence_interval(strategyYield, processedReadPairs, z=2.576):
+    """Wilson score interval of the yield of a demultiplexing strategy
+
+    Returns:
+        lower, upper (float) : yield percentages
+    """
+    if processedReadPairs == 0:
+        return 0.0, 100.0
+    n = processedReadPairs
+    p = strategyYield / n
+    denominator = 1 + z * z / n
+    centre = (p + z * z / (2 * n)) / denominator
+    margin = z * math.sqrt(p * (1 - p) / n + z * z / (4 * n * n)) / denominator
+    return max(0.0, centre - margin) * 100.0, min(1.0, centre + margin) * 100.0
+
+
+_detect_worker_state = None
+
+
+def _init_detect_worker(loader, detect_args):
+    global _detect_worker_state
+    _detect_worker_state = (loader, detect_args)
+
+
+def _detect_library_yields(task):
+    loader, detect_args = _detect_worker_state
+    lib, files = task
+    return loader.detectLibraryYields(files, *detect_args)
+
+
 class DemultiplexingStrategyLoader:
     def __init__(
             self,
@@ -148,7 +323,19 @@ class DemultiplexingStrategyLoader:
             targetFile=None,
             rejectHandle=None,
             log_handle=None,
-            probe=None):
+            probe=None,
+            n_processes=1,
+            chunk_size=5000):
+        """Demultiplex read pairs from fastq files
+
+        When n_processes is larger than 1 the read pairs are read in chunks of
+        chunk_size read pairs, the chunks are demultiplexed by a pool of
+        worker processes and written in the original order. The output,
+        yields and log are identical to the output of a single process.
+
+        Returns:
+            processedReadPairs (int), strategyYields (collections.Counter)
+        """
 
         useStrategies = strategies if strategies is not None else self.getAutodetectStrategies()
         strategyYields = collections.Counter()
@@ -158,55 +345,39 @@ class DemultiplexingStrategyLoader:
             barcodeParser=self.barcodeParser,
             probe=probe)
 
-        for p, reads in enumerate(
-                fastqIterator.FastqIterator(*fastqfiles)):
-            processedReadPairs = p+1
-
-            for strategy in useStrategies:
-                try:
-                    recodedRecords = strategy.demultiplex(
-                        reads, library=library, probe=probe)
-
-                    if targetFile is not None:
-                        targetFile.write(recodedRecords)
-
-                except NonMultiplexable as reason:
-                    # print('NonMultiplexable')
-                    if rejectHandle is not None:
-
-                        try:
-                            to_write = baseDemux.demultiplex(
-                                reads, library=library, reason=reason)
-                            rejectHandle.write(to_write)
-
-                        except NonMultiplexable as e:
-                            # we cannot read the header of the read..
-                            reads = [
-                                '\n'.join(
-                                    (read.header +
-                                     f';RR:{reason};Rr:{e}',
-                                     read.sequence,
-                                     read.plus,
-                                     read.qual)) for read in reads]
-                            rejectHandle.write(reads)
-
-                    continue
-                except Exception as e:
-                    print(traceback.format_exc())
-                    print(
-                        f'{Fore.RED}Fatal error. While demultiplexing strategy {strategy.longName} yielded an error, the error message was: {e}')
-                    print('The read(s) causing the error looked like this:')
-                    for read in reads:
-                        print(str(read))
-                    print(Style.RESET_ALL)
-                    if log_handle is not None:
-                        log_handle.write(
-                            f"Error occured using {strategy.longName}\n")
-                # print(recodedRecord)
-                strategyYields[strategy.shortName] += 1
-            if (maxReadPairs is not None and (
-                    processedReadPairs) >= maxReadPairs):
-                break
+        if n_processes > 1:
+            # The records are formatted by the workers in the format of the output handles
+            record_formats = {
+                'target': getattr(targetFile, 'record_format', 'illumina'),
+                'reject': getattr(rejectHandle, 'record_format', 'illumina')}
+            read_pair_chunks = _read_pair_chunks(
+                fastqfiles, chunk_size, maxReadPairs)
+            in_flight = threading.BoundedSemaphore(n_processes * 4)
+            with multiprocessing.Pool(
+                    n_processes,
+                    initializer=_init_demultiplex_worker,
+                    initargs=(useStrategies, baseDemux, library, probe, rejectHandle is not None, record_formats)) as workers:
+                for chunk_read_pairs, chunk_events, chunk_yields in workers.imap(
+                        _demultiplex_chunk,
+                        _limit_in_flight(read_pair_chunks, in_flight)):
+                    for events in chunk_events:
+                        _write_demultiplex_events(
+                            events, targetFile, rejectHandle, log_handle)
+                    strategyYields.update(chunk_yields)
+                    processedReadPairs += chunk_read_pairs
+                    in_flight.release()
+        else:
+            for p, reads in enumerate(
+                    fastqIterator.FastqIterator(*fastqfiles)):
+                processedReadPairs = p+1
+                events, yielded = demultiplex_read_pair(
+                    reads, useStrategies, baseDemux, library=library, probe=probe, rejects=rejectHandle is not None)
+                _write_demultiplex_events(
+                    events, targetFile, rejectHandle, log_handle)
+                strategyYields.update(yielded)
+                if (maxReadPairs is not None and (
+                        processedReadPairs) >= maxReadPairs):
+                    break
         # write yields to log file if applicable:
         if log_handle is not None:
             log_handle.write(f'processed {processedReadPairs+1} read pairs\n')
@@ -223,42 +394,183 @@ class DemultiplexingStrategyLoader:
             testReads=100000,
             maxAutoDetectMethods=1,
             minAutoDetectPct=5,
-            verbose=False):
-        libYields = dict()
+            verbose=False,
+            sequential=False,
+            round_size=500,
+            z=2.576,
+            n_processes=1):
+        """Determine the yield of the demultiplexing strategies for every library
+
+        Args:
+            libraries (dict) : library -> lane -> R1/R2 -> [paths]
+
+            testReads (int) : maximum amount of read pairs to test per library
+
+            sequential (bool) : test the reads in rounds of round_size read pairs,
+                strategies which yield clearly less than minAutoDetectPct are not tested anymore,
+                testing stops when the best maxAutoDetectMethods strategies are separated from the rest
 
+            z (float) : z-score of the yield confidence intervals, 2.576 is a 99% interval
+
+            n_processes (int) : amount of libraries tested in parallel
+
+        Returns:
+            processedReadPairs (int) : read pairs tested for the last library
+            libYields (dict) : library -> {'processedReadPairs', 'strategyYields', 'confidenceIntervals'}
+        """
+        useStrategies = strategies if strategies is not None else self.getAutodetectStrategies()
+        tasks = []
         for lib, lanes in libraries.items():
+            # Only the first lane is used:
             for lane, readPairs in lanes.items():
+                if len(readPairs) == 1:
+                    files = [readPairs['R1'][0]]
+                elif len(readPairs) == 2:
+                    files = (readPairs['R1'][0], readPairs['R2'][0])
+                else:
+                    raise ValueError('Error: %s' % readPairs.keys())
+                tasks.append((lib, files))
+                break
 
-                for readPair in readPairs:
-                    if len(readPairs) == 1:
-                        processedReadPairs, strategyYields = self.demultiplex(
-                            [readPairs['R1'][0]], maxReadPairs=testReads, strategies=strategies, probe=True)
-                    elif len(readPairs) == 2:
-                        processedReadPairs, strategyYields = self.demultiplex(
-                            (readPairs['R1'][0], readPairs['R2'][0]), maxReadPairs=testReads, strategies=strategies, probe=True)
-                    else:
-                        raise ValueError('Error: %s' % readPairs.keys())
+        detect_args = (useStrategies, testReads, maxAutoDetectMethods,
+                       minAutoDetectPct, sequential, round_size, z)
+        if n_processes > 1 and len(tasks) > 1:
+            workers = multiprocessing.Pool(
+                min(n_processes, len(tasks)),
+                initializer=_init_detect_worker,
+                initargs=(self, detect_args))
+            results = workers.imap(_detect_library_yields, tasks)
+        else:
+            workers = None
+            results = (self.detectLibraryYields(files, *detect_args)
+                       for lib, files in tasks)
 
+        libYields = dict()
+        processedReadPairs = 0
+        try:
+            for (lib, files), (processedReadPairs, strategyYields, confidenceIntervals) in zip(tasks, results):
                 if verbose:
                     print(f'Report for {lib}:')
                     self.strategyYieldsToFormattedReport(
                         processedReadPairs,
                         strategyYields,
                         maxAutoDetectMethods=maxAutoDetectMethods,
-                        minAutoDetectPct=minAutoDetectPct)
+                        minAutoDetectPct=minAutoDetectPct,
+                        confidenceIntervals=confidenceIntervals)
                 libYields[lib] = {
                     'processedReadPairs': processedReadPairs,
-                    'strategyYields': strategyYields}
-                break
+                    'strategyYields': strategyYields,
+                    'confidenceIntervals': confidenceIntervals}
+        finally:
+            if workers is not None:
+                workers.close()
+                workers.join()
         return processedReadPairs, libYields
 
+    def detectLibraryYields(
+            self,
+            fastqfiles,
+            strategies,
+            testReads=100000,
+            maxAutoDetectMethods=1,
+            minAutoDetectPct=5,
+            sequential=False,
+            round_size=500,
+            z=2.576):
+        """Determine the yield of the demultiplexing strategies for one library,
+        see detectLibYields
+
+        Returns:
+            processedReadPairs (int)
+            strategyYields (collections.Counter) : strategy short name -> yield, for strategies which
+                were not tested on all reads the yield is extrapolated
+            confidenceIntervals (dict) : strategy short name -> (lower, upper) yield percentage
+        """
+        if not sequential:
+            processedReadPairs, strategyYields = self.demultiplex(
+                fastqfiles, maxReadPairs=testReads, strategies=strategies, probe=True)
+            confidenceIntervals = {
+                strategy.shortName: yield_confidence_interval(
+                    strategyYields[strategy.shortName], processedReadPairs, z)
+                for strategy in strategies}
+            return processedReadPairs, strategyYields, confidenceIntervals
+
+        baseDemux = IlluminaBaseDemultiplexer(
+            indexFileParser=self.indexParser,
+            barcodeParser=self.barcodeParser,
+            probe=True)
+        active = list(strategies)
+        yields = collections.Counter()
+        tested = collections.Counter()
+        confidenceIntervals = {}
+        processedReadPairs = 0
+        reads_iterator = fastqIterator.FastqIterator(*fastqfiles)
+        try:
+            while processedReadPairs < testReads and len(active):
+                round_reads = list(itertools.islice(
+                    reads_iterator, min(round_size, testReads - processedReadPairs)))
+                if len(round_reads) == 0:
+                    break
+                for reads in round_reads:
+                    _, yielded = demultiplex_read_pair(
+                        reads, active, baseDemux, probe=True, rejects=False)
+                    yields.update(yielded)
+                processedReadPairs += len(round_reads)
+                for strategy in active:
+                    tested[strategy.shortName] += len(round_reads)
+                    confidenceIntervals[strategy.shortName] = yield_confidence_interval(
+                        yields[strategy.shortName], tested[strategy.shortName], z)
+
+                # Stop testing strategies which clearly do not reach the minimum yield
+                active = [strategy for strategy in active
+                          if confidenceIntervals[strategy.shortName][1] >= minAutoDetectPct]
+                if self._autodetectSeparated(
+                        active, yields, tested, confidenceIntervals,
+                        maxAutoDetectMethods, minAutoDetectPct):
+                    break
+        finally:
+            reads_iterator.close()
+
+        strategyYields = collections.Counter()
+        for shortName, strategyYield in yields.items():
+            if tested[shortName] == processedReadPairs:
+                strategyYields[shortName] = strategyYield
+            else:
+                strategyYields[shortName] = round(
+                    strategyYield / tested[shortName] * processedReadPairs)
+        return processedReadPairs, strategyYields, confidenceIntervals
+
+    def _autodetectSeparated(
+            self,
+            active,
+            yields,
+            tested,
+            confidenceIntervals,
+            maxAutoDetectMethods,
+            minAutoDetectPct):
+        """Returns True when the best maxAutoDetectMethods strategies reach the
+        minimum yield and their yield is higher than the yield of the other strategies"""
+        ranked = sorted(
+            active,
+            key=lambda strategy: yields[strategy.shortName] / tested[strategy.shortName],
+            reverse=True)
+        top = [confidenceIntervals[strategy.shortName]
+               for strategy in ranked[:maxAutoDetectMethods]]
+        rest = [confidenceIntervals[strategy.shortName]
+                for strategy in ranked[maxAutoDetectMethods:]]
+        if any(lower < minAutoDetectPct for lower, upper in top):
+            return False
+        return len(rest) == 0 or min(
+            lower for lower, upper in top) > max(upper for lower, upper in rest)
+
     def strategyYieldsToFormattedReport(
             self,
             processedReadPairs,
             strategyYields,
             selectedStrategies=None,
             maxAutoDetectMethods=1,
-            minAutoDetectPct=5):
+            minAutoDetectPct=5,
+            confidenceIntervals=None):
         print(
             f'Analysed {Style.BRIGHT}{processedReadPairs}{Style.RESET_ALL} read pairs')
 
@@ -268,6 +580,9 @@ class DemultiplexingStrategyLoader:
         for i, (strategy, strategyYield) in enumerate(
                 strategyYields.most_common()):
             yieldRatio = strategyYield / (0.001 + processedReadPairs)
+            confidence = ''
+            if confidenceIntervals is not None and strategy in confidenceIntervals:
+                confidence = ' [%.2f%%-%.2f%%]' % confidenceIntervals[strategy]
             print(
                 (
                     Style.BRIGHT +
@@ -275,9 +590,7 @@ class DemultiplexingStrategyLoader:
                         (strategy in selectedStrategies) or i < maxAutoDetectMethods) else (
                         Fore.YELLOW if yieldRatio *
                         100 >= minAutoDetectPct else Style.DIM)) +
-                f'\t {strategy}:%.2f%%{Style.RESET_ALL}' %
-                (100.0 *
-                 yieldRatio))
+                f'\t {strategy}:{100.0 * yieldRatio:.2f}%{confidence}{Style.RESET_ALL}')
 
     def selectedStrategiesBasedOnYield(
             self,
@@ -7,7 +7,7 @@ from colorama import init
 from singlecellmultiomics.modularDemultiplexer.demultiplexingStrategyLoader import DemultiplexingStrategyLoader
 import singlecellmultiomics.libraryDetection.sequencingLibraryListing as sequencingLibraryListing
 import singlecellmultiomics.barcodeFileParser.barcodeFileParser as barcodeFileParser
-from singlecellmultiomics.fastqProcessing.fastqHandle import FastqHandle
+from singlecellmultiomics.fastqProcessing.fastqHandle import FastqHandle, UnalignedBamHandle
 import argparse
 from colorama import Style
 from colorama import Fore
@@ -106,6 +106,22 @@ if __name__ == '__main__':
         '--scsepf',
         help="Every cell gets a separate FQ file",
         action='store_true')
+    outputArgs.add_argument(
+        '-of',
+        help="Output format. fastq: the tags are stored in the read names, fastq_tags: the tags are stored as SAM tags in the read comments, use an aligner which copies the comments to the alignments (bwa mem -C). bam: unaligned BAM file with the tags stored as BAM tags. For fastq_tags and bam the tags do not need to be parsed from the read names after mapping and are not limited in length",
+        choices=['fastq', 'fastq_tags', 'bam'],
+        default='fastq')
+    outputArgs.add_argument(
+        '-zl',
+        help="Compression level of the written files, 1 is fastest, 9 results in the smallest files",
+        type=int,
+        choices=range(0, 10),
+        default=1)
+    outputArgs.add_argument(
+        '-zt',
+        help="Amount of compression threads per output file",
+        type=int,
+        default=2)
     outputArgs.add_argument(
         '-nextcmd',
         help="Execute this command when the demultiplexing is finished. When cluster submission is used this command is executed after all jobs are finished",
@@ -172,11 +188,30 @@ if __name__ == '__main__':
         help="When demultiplexing to mutliple cell files in multiple threads, the amount of opened files can exceed the limit imposed by your operating system. The amount of open handles per thread is kept below this parameter to prevent this from happening.",
         default=500,
         type=int)
+    techArgs.add_argument(
+        '-t',
+        help="Amount of demultiplexing processes, the reads are demultiplexed in chunks of -chunksize read pairs. During barcode type detection this amount of libraries is tested in parallel",
+        default=1,
+        type=int)
+    techArgs.add_argument(
+        '-chunksize',
+        help="Amount of read pairs demultiplexed at once by a process, only used when -t is larger than 1",
+        default=5000,
+        type=int)
     techArgs.add_argument(
         '-dsize',
         help="Amount of reads used to determine barcode type",
         type=int,
         default=2000)
+    techArgs.add_argument(
+        '--seqdetect',
+        help="Sequential barcode type detection: test the reads in rounds of -dround read pairs, stop testing strategies which clearly yield less than -minAutoDetectPct and stop when the best -maxAutoDetectMethods strategies are separated from the others. At most -dsize read pairs are tested",
+        action='store_true')
+    techArgs.add_argument(
+        '-dround',
+        help="Amount of read pairs per round of sequential barcode type detection",
+        type=int,
+        default=500)
     techArgs.add_argument(
         '--nochunk',
         help="Do not run lanes in separate jobs",
@@ -211,6 +246,9 @@ if __name__ == '__main__':
     if any(('*' in fq_file for fq_file in args.fastqfiles)):
         raise ValueError(
             "One or more of the fastq file paths contain a '*', these files cannot be interpreted, review your input files")
+    if args.of == 'bam' and args.scsepf:
+        raise ValueError(
+            "Writing a separate file for every cell (--scsepf) is only supported for fastq output")
 
     if len(set(args.fastqfiles)) != len(args.fastqfiles):
         print(f'{Fore.RED}{Style.BRIGHT}Some fastq files are supplied multiple times! Pruning those!{Style.RESET_ALL}')
@@ -291,7 +329,8 @@ if __name__ == '__main__':
             f"\n{Style.BRIGHT}Demultiplexing method Autodetect results{Style.RESET_ALL}")
         # Run autodetect
         processedReadPairs, strategyYieldsForAllLibraries = dmx.detectLibYields(
-            libraries, testReads=args.dsize, maxAutoDetectMethods=args.maxAutoDetectMethods, minAutoDetectPct=args.minAutoDetectPct, verbose=True)
+            libraries, testReads=args.dsize, maxAutoDetectMethods=args.maxAutoDetectMethods, minAutoDetectPct=args.minAutoDetectPct, verbose=True,
+            sequential=args.seqdetect, round_size=args.dround, n_processes=args.t)
 
     print(f"\n{Style.BRIGHT}Demultiplexing:{Style.RESET_ALL}")
     for library in libraries:
@@ -339,7 +378,7 @@ if __name__ == '__main__':
 
                     print(
                         'submission.py' +
-                        f' -y -sched auto --py36 -time 50 -t 1 -m 8 -N {job_name} "%s  -g {group_id} -use {",".join([x.shortName for x in selectedStrategies])}"\n' %
+                        f' -y -sched auto --py36 -time 50 -t {args.t} -m 8 -N {job_name} "%s  -g {group_id} -use {",".join([x.shortName for x in selectedStrategies])}"\n' %
                         ('%s %s' %
                          (arguments,
                           " ".join(files_to_submit))))
@@ -350,7 +389,7 @@ if __name__ == '__main__':
                 job_name = f'DMX_{library}'
                 print(
                     'submission.py' +
-                    f' -y --py36 -time 50 -t 1 -m 8 -sched auto -N {job_name} "%s -use {",".join([x.shortName for x in selectedStrategies])}"\n' %
+                    f' -y --py36 -time 50 -t {args.t} -m 8 -sched auto -N {job_name} "%s -use {",".join([x.shortName for x in selectedStrategies])}"\n' %
                     ('%s %s' %
                      (arguments,
                       " ".join(filesForLib))))
@@ -359,10 +398,15 @@ if __name__ == '__main__':
                 # we need a job which glues everything back together
                 # f'{args.o}/{library}/{prefix}demultiplexed
                 # f'{args.o}/{library}/{prefix}rejects
-                cmds = [
-                    f'cat {args.o}/{library}/*_TEMP_demultiplexedR1.fastq.gz  > {args.o}/{library}/demultiplexedR1.fastq.gz && rm {args.o}/{library}/*_TEMP_demultiplexedR1.fastq.gz',
-                    f'cat {args.o}/{library}/*_TEMP_demultiplexedR2.fastq.gz  > {args.o}/{library}/demultiplexedR2.fastq.gz && rm {args.o}/{library}/*_TEMP_demultiplexedR2.fastq.gz',
-                    f'cat {args.o}/{library}/*_TEMP_demultiplexing.log  > {args.o}/{library}/demultiplexing.log && rm {args.o}/{library}/*_TEMP_demultiplexing.log']
+                if args.of == 'bam':
+                    cmds = [
+                        f'samtools cat -o {args.o}/{library}/demultiplexed.bam {args.o}/{library}/*_TEMP_demultiplexed.bam && rm {args.o}/{library}/*_TEMP_demultiplexed.bam']
+                else:
+                    cmds = [
+                        f'cat {args.o}/{library}/*_TEMP_demultiplexedR1.fastq.gz  > {args.o}/{library}/demultiplexedR1.fastq.gz && rm {args.o}/{library}/*_TEMP_demultiplexedR1.fastq.gz',
+                        f'cat {args.o}/{library}/*_TEMP_demultiplexedR2.fastq.gz  > {args.o}/{library}/demultiplexedR2.fastq.gz && rm {args.o}/{library}/*_TEMP_demultiplexedR2.fastq.gz']
+                cmds.append(
+                    f'cat {args.o}/{library}/*_TEMP_demultiplexing.log  > {args.o}/{library}/demultiplexing.log && rm {args.o}/{library}/*_TEMP_demultiplexing.log')
                 if not args.norejects:
                     cmds += [
                         f'cat {args.o}/{library}/*_TEMP_rejectsR1.fastq.gz  > {args.o}/{library}/rejectsR1.fastq.gz && rm {args.o}/{library}/*_TEMP_rejectsR1.fastq.gz',
@@ -392,16 +436,29 @@ if __name__ == '__main__':
                     continue
 
             prefix = '' if args.g is None else f'{args.g}_TEMP_'
-            handle = FastqHandle(
-                f'{args.o}/{library}/{prefix}demultiplexed',
-                True,
-                single_cell=args.scsepf,
-                maxHandles=args.fh)
+            if args.of == 'bam':
+                handle = UnalignedBamHandle(
+                    f'{args.o}/{library}/{prefix}demultiplexed',
+                    True,
+                    threads=args.zt,
+                    compressionLevel=args.zl)
+            else:
+                handle = FastqHandle(
+                    f'{args.o}/{library}/{prefix}demultiplexed',
+                    True,
+                    single_cell=args.scsepf,
+                    maxHandles=args.fh,
+                    tag_comments=args.of == 'fastq_tags',
+                    compressionLevel=args.zl,
+                    threads=args.zt)
             if args.norejects:
                 rejectHandle = None
             else:
                 rejectHandle = FastqHandle(
-                    f'{args.o}/{library}/{prefix}rejects', True)
+                    f'{args.o}/{library}/{prefix}rejects',
+                    True,
+                    compressionLevel=args.zl,
+                    threads=args.zt)
             """Set up statistic file"""
 
             log_location = os.path.abspath(
@@ -429,6 +486,8 @@ if __name__ == '__main__':
                                                                          rejectHandle=rejectHandle,
                                                                          log_handle=log_handle,
                                                                          library=library,
+                                                                         n_processes=args.t,
+                                                                         chunk_size=args.chunksize,
                                                                          maxReadPairs=None if args.n is None else (args.n - processedReadPairsForThisLib))
                     processedReadPairsForThisLib += processedReadPairs
                     log_handle.write(
@@ -437,6 +496,9 @@ if __name__ == '__main__':
                     if args.n and processedReadPairsForThisLib >= args.n:
                         break
             handle.close()
+            if args.scsepf and hasattr(handle.handles, 'get_statistics'):
+                log_handle.write('Cell file output:\t' + ', '.join(
+                    f'{key}: {value}' for key, value in handle.handles.get_statistics().items()) + '\n')
             if not args.norejects:
                 rejectHandle.close()
             log_handle.write(f'Demultiplexing finished\n')
@@ -19,21 +19,108 @@ def calculate_consensus(molecule, consensus_model, molecular_identifier, out, **
         **model_kwargs : arguments passed to the consensus model
 
     """
-    try:
-        consensus_reads = molecule.deduplicate_to_single_CIGAR_spaced(
-            out,
-            f'c_{molecule.get_a_reference_id()}_{molecular_identifier}',
-            consensus_model,
-            NUC_RADIUS=model_kwargs['consensus_k_rad']
-            )
-        for consensus_read in consensus_reads:
-            consensus_read.set_tag('RG', molecule[0].get_read_group())
-            consensus_read.set_tag('mi', molecular_identifier)
-            out.write(consensus_read)
-    except Exception as e:
-
-        molecule.set_rejection_reason('CONSENSUS_FAILED',set_qcfail=True)
-        molecule.write_pysam(out)
+    with BatchedConsensusWriter(consensus_model, out, batch_size=1, write_source_reads=False, **model_kwargs) as writer:
+        writer.add(molecule, molecular_identifier)
+
+
+class BatchedConsensusWriter():
+    """
+    Create consensus reads for multiple molecules using a single predict_proba call
+
+    The feature matrices of batch_size molecules are collected, stacked and classified at once.
+    The consensus reads (and optionally the source reads of the molecules) are then written
+    in the order the molecules were added.
+
+    Example:
+        >>> with BatchedConsensusWriter(consensus_model, out, consensus_k_rad=3) as writer:
+        >>>     for i, molecule in enumerate(molecule_iterator):
+        >>>         molecule.write_tags()
+        >>>         writer.add(molecule, i)
+    """
+
+    def __init__(self, consensus_model, out, batch_size=100, write_source_reads=True, **model_kwargs):
+        """
+        Args:
+            consensus_model : classifier with a predict_proba method
+
+            out(pysam.AlingmentFile) : target bam file
+
+            batch_size (int) : amount of molecules to classify at once
+
+            write_source_reads (bool) : write the reads of the molecules after the consensus reads
+
+            **model_kwargs : arguments passed to the consensus model
+        """
+        self.consensus_model = consensus_model
+        self.out = out
+        self.batch_size = batch_size
+        self.write_source_reads = write_source_reads
+        self.model_kwargs = model_kwargs
+        self.pending = []  # (molecule, molecular_identifier, feature matrix result or None)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.flush()
+
+    def add(self, molecule, molecular_identifier):
+        try:
+            spaced_features = molecule.get_base_calling_feature_matrix_spaced(
+                True, NUC_RADIUS=self.model_kwargs['consensus_k_rad'])
+            if spaced_features[0] is None:
+                spaced_features = None
+        except Exception as e:
+            spaced_features = None
+        self.pending.append((molecule, molecular_identifier, spaced_features))
+        if len(self.pending) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        if len(self.pending) == 0:
+            return
+
+        # Classify the bases of all molecules at once:
+        feature_matrices = [spaced_features[0] for _, _, spaced_features in self.pending if spaced_features is not None]
+        base_calling_probs = None
+        if len(feature_matrices):
+            try:
+                base_calling_probs = self.consensus_model.predict_proba(np.concatenate(feature_matrices))
+            except Exception as e:
+                base_calling_probs = None
+
+        offset = 0
+        for molecule, molecular_identifier, spaced_features in self.pending:
+            consensus_reads = None
+            if spaced_features is not None and base_calling_probs is not None:
+                features, reference_bases, CIGAR, alignment_start, alignment_end = spaced_features
+                try:
+                    consensus_reads = molecule.deduplicate_to_single_CIGAR_spaced_from_probabilities(
+                        self.out,
+                        f'c_{molecule.get_a_reference_id()}_{molecular_identifier}',
+                        base_calling_probs[offset:offset + len(features)],
+                        reference_bases,
+                        CIGAR,
+                        alignment_start)
+                except Exception as e:
+                    consensus_reads = None
+                offset += len(features)
+
+            if consensus_reads is None:
+                # The source reads of the molecule are always written when no consensus can be created
+                molecule.set_rejection_reason('CONSENSUS_FAILED', set_qcfail=True)
+                molecule.write_pysam(self.out)
+                continue
+
+            for consensus_read in consensus_reads:
+                consensus_read.set_tag('RG', molecule[0].get_read_group())
+                consensus_read.set_tag('mi', molecular_identifier)
+                self.out.write(consensus_read)
+            if self.write_source_reads:
+                molecule.write_pysam(self.out)
+        self.pending = []
+
 
 def base_calling_matrix_to_df(
         x,
@@ -198,7 +285,7 @@ def train_consensus_model(
     X = np.array(X)[y != 'N']
     y = y[y != 'N']
     classifier.fit(X, y)
-    if isinstance(classifier, sklearn.ensemble.forest.RandomForestClassifier):
+    if isinstance(classifier, sklearn.ensemble.RandomForestClassifier):
         print(f"Model out of bag accuracy: {classifier.oob_score_}")
     classifier.n_jobs = 1  # fix amount of jobs to one, otherwise apply will be very slow
     return classifier
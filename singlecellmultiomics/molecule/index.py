@@ -0,0 +1,258 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+import bisect
+import collections
+import itertools
+
+
+def umi_neighbourhood_keys(umi, hamming_distance=1):
+    """Obtain the lookup keys of the hamming neighbourhood of a UMI
+
+    Every UMI is stored under its exact sequence and, for hamming distance 1,
+    under every variant in which one of the bases is masked. Two UMIs of the
+    same length have a hamming distance <= 1 when they share at least one key.
+
+    Args:
+        umi (str) : UMI sequence
+
+        hamming_distance (int) : 0 or 1
+
+    Returns:
+        keys (list)
+    """
+    keys = [umi]
+    if hamming_distance > 0:
+        keys += [(i, umi[:i] + umi[i + 1:]) for i in range(len(umi))]
+    return keys
+
+
+class MoleculeIndexGroup():
+    """Molecules sharing the same match_hash, sample and strand
+
+    The UMI and span index of the group is only built when the group contains
+    more molecules than the index_size_threshold of the MoleculeIndex,
+    a small group is cheaper to scan than to index.
+    """
+    __slots__ = ('molecules', 'umi_keys', 'umi_wildcards', 'umi_lengths',
+                 'starts', 'ends', 'unplaced')
+
+    def __init__(self):
+        self.molecules = {}  # creation index -> molecule
+        self.umi_keys = None  # umi key -> {creation index}
+        self.umi_wildcards = None  # molecules with an UMI which cannot be indexed
+        self.umi_lengths = None  # umi length -> amount of molecules
+        self.starts = None  # sorted [(spanStart, creation index)]
+        self.ends = None  # sorted [(spanEnd, creation index)]
+        self.unplaced = None  # molecules without a defined span
+
+    def __len__(self):
+        return len(self.molecules)
+
+    def is_indexed(self):
+        return self.umi_keys is not None
+
+    def build_index(self):
+        self.umi_keys = collections.defaultdict(set)
+        self.umi_wildcards = set()
+        self.umi_lengths = collections.Counter()
+        self.starts = []
+        self.ends = []
+        self.unplaced = set()
+
+
+class MoleculeIndex():
+    """Index of buffered molecules, used by the MoleculeIterator (pooling_method=2)
+    to only compare a fragment to molecules it can possibly be assigned to.
+
+    Molecules are grouped by (match_hash, sample, strand). Within a group a
+    UMI neighbourhood index (exact UMI and UMIs with one masked base) and
+    sorted start and end coordinates of the molecule spans are kept.
+    A fragment is only compared to molecules with a UMI within the hamming
+    distance of the fragment and a span within the assignment_radius.
+    Which criteria are used depends on the umi_match_required and
+    span_match_required attributes of the fragment class.
+
+    The candidates are returned in the order the molecules were created, this
+    guarantees the same assignment as a linear scan over the molecules.
+    """
+
+    def __init__(self, index_size_threshold=16):
+        """
+        Args:
+            index_size_threshold (int) : groups with more molecules than this value are indexed
+        """
+        self.index_size_threshold = index_size_threshold
+        self.groups = {}  # (match_hash, sample, strand) -> MoleculeIndexGroup
+        self.entries = {}  # id(molecule) -> (key, creation index, placement)
+        self.creation_counter = itertools.count()
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __contains__(self, molecule):
+        return id(molecule) in self.entries
+
+    @staticmethod
+    def supports(fragment_class):
+        """Check if the criteria of the __eq__ method of the fragment class are known.
+
+        The umi_match_required and span_match_required attributes have to be declared
+        by the class which defines __eq__, otherwise they describe the __eq__ method of
+        a parent class. Molecules are also grouped by sample and strand, which is only
+        valid when the overriding __eq__ declares these attributes.
+
+        Args:
+            fragment_class (class) : class of the fragments
+
+        Returns:
+            supported (bool)
+        """
+        for cls in fragment_class.__mro__:
+            if '__eq__' in vars(cls):
+                return 'umi_match_required' in vars(cls) or 'span_match_required' in vars(cls)
+        return False
+
+    @staticmethod
+    def get_key(obj):
+        return (obj.match_hash, getattr(obj, 'sample', None), obj.strand)
+
+    @staticmethod
+    def _umi_is_indexable(umi):
+        return isinstance(umi, str) and 'N' not in umi
+
+    def add(self, molecule):
+        """Add a molecule to the index"""
+        index = next(self.creation_counter)
+        key = self.get_key(molecule)
+        group = self.groups.get(key)
+        if group is None:
+            group = self.groups[key] = MoleculeIndexGroup()
+        group.molecules[index] = molecule
+        if group.is_indexed():
+            self.entries[id(molecule)] = (key, index, self._place(molecule, group, index))
+        else:
+            self.entries[id(molecule)] = (key, index, None)
+            if len(group) > self.index_size_threshold:
+                group.build_index()
+                for other_index, other in group.molecules.items():
+                    self.entries[id(other)] = (key, other_index, self._place(other, group, other_index))
+
+    def remove(self, molecule):
+        """Remove a molecule from the index"""
+        key, index, placement = self.entries.pop(id(molecule))
+        group = self.groups[key]
+        if placement is not None:
+            self._unplace(placement, group, index)
+        del group.molecules[index]
+        if len(group) == 0:
+            del self.groups[key]
+
+    def update(self, molecule):
+        """Update the index after a fragment has been added to the molecule,
+        this changes the span and possibly the UMI of the molecule"""
+        key, index, placement = self.entries[id(molecule)]
+        if placement is None:
+            return
+        umi_keys, start, end = placement
+        if molecule.umi == umi_keys[0] and molecule.spanStart == start and molecule.spanEnd == end:
+            return
+        group = self.groups[key]
+        self._unplace(placement, group, index)
+        self.entries[id(molecule)] = (key, index, self._place(molecule, group, index))
+
+    def _place(self, molecule, group, index):
+        umi = molecule.umi
+        if self._umi_is_indexable(umi):
+            umi_keys = umi_neighbourhood_keys(umi, 1)
+            for umi_key in umi_keys:
+                group.umi_keys[umi_key].add(index)
+            group.umi_lengths[len(umi)] += 1
+        else:
+            umi_keys = [umi]
+            group.umi_wildcards.add(index)
+
+        start, end = molecule.spanStart, molecule.spanEnd
+        if start is None or end is None:
+            group.unplaced.add(index)
+        else:
+            bisect.insort(group.starts, (start, index))
+            bisect.insort(group.ends, (end, index))
+        return (umi_keys, start, end)
+
+    def _unplace(self, placement, group, index):
+        umi_keys, start, end = placement
+        if index in group.umi_wildcards:
+            group.umi_wildcards.discard(index)
+        else:
+            for umi_key in umi_keys:
+                bucket = group.umi_keys[umi_key]
+                bucket.discard(index)
+                if len(bucket) == 0:
+                    del group.umi_keys[umi_key]
+            umi_length = len(umi_keys[0])
+            group.umi_lengths[umi_length] -= 1
+            if group.umi_lengths[umi_length] == 0:
+                del group.umi_lengths[umi_length]
+
+        if index in group.unplaced:
+            group.unplaced.discard(index)
+        else:
+            del group.starts[bisect.bisect_left(group.starts, (start, index))]
+            del group.ends[bisect.bisect_left(group.ends, (end, index))]
+
+    def _umi_candidates(self, fragment, group):
+        """Returns set of creation indices or None when the UMI can not be used to select candidates"""
+        umi = fragment.umi
+        hd = fragment.umi_hamming_distance
+        if not self._umi_is_indexable(umi) or hd is None or hd > 1:
+            return None
+        # Hamming distances are calculated on the overlapping part of the UMI,
+        # when lengths differ the neighbourhood keys do not apply
+        if len(group.umi_lengths) > 1 or (len(group.umi_lengths) == 1 and len(umi) not in group.umi_lengths):
+            return None
+        candidates = set(group.umi_wildcards)
+        for umi_key in umi_neighbourhood_keys(umi, hd):
+            candidates.update(group.umi_keys.get(umi_key, ()))
+        return candidates
+
+    def _span_candidates(self, fragment, group):
+        """Returns set of creation indices or None when the span can not be used to select candidates"""
+        _, start, end = fragment.span
+        radius = fragment.assignment_radius
+        if start is None or end is None or radius is None:
+            return None
+        candidates = set(group.unplaced)
+        for coordinates, position in ((group.starts, start), (group.ends, end)):
+            lower = bisect.bisect_left(coordinates, (position - radius, -1))
+            upper = bisect.bisect_right(coordinates, (position + radius, float('inf')))
+            candidates.update(index for _, index in coordinates[lower:upper])
+        return candidates
+
+    def get_candidates(self, fragment):
+        """Obtain molecules which can possibly be associated to the fragment
+
+        Args:
+            fragment (singlecellmultiomics.fragment.Fragment) : fragment to find molecules for
+
+        Returns:
+            molecules (list) : molecules in order of creation
+        """
+        group = self.groups.get(self.get_key(fragment))
+        if group is None:
+            return []
+        if not group.is_indexed():
+            return list(group.molecules.values())
+
+        candidates = None
+        if getattr(fragment, 'umi_match_required', False):
+            candidates = self._umi_candidates(fragment, group)
+        if getattr(fragment, 'span_match_required', False):
+            span_candidates = self._span_candidates(fragment, group)
+            if candidates is None:
+                candidates = span_candidates
+            elif span_candidates is not None:
+                candidates.intersection_update(span_candidates)
+
+        if candidates is None:
+            return list(group.molecules.values())
+        return [group.molecules[index] for index in sorted(candidates)]
@@ -2,10 +2,20 @@
 # -*- coding: utf-8 -*-
 from singlecellmultiomics.molecule import Molecule
 from singlecellmultiomics.fragment import Fragment
+from singlecellmultiomics.molecule.index import MoleculeIndex
 from singlecellmultiomics.utils.prefetch import initialise_dict, initialise
 from singlecellmultiomics.universalBamTagger import QueryNameFlagger
+from singlecellmultiomics.bamProcessing.bamFunctions import get_contigs_with_reads
+from singlecellmultiomics.bamProcessing.bamBinCounts import blacklisted_binning_contigs
 import pysamiterators.iterators
 import collections
+import inspect
+import itertools
+import heapq
+import multiprocessing
+import pickle
+import tempfile
+import threading
 import pysam
 
 
@@ -18,6 +28,28 @@ class ReadIterator(pysamiterators.iterators.MatePairIterator):
         except StopIteration:
             raise
 
+
+class SpilledMolecule():
+    """Placeholder of a molecule which has been written to disk by the MoleculeIterator,
+    holds the attributes required to decide when the molecule can be yielded"""
+
+    __slots__ = ('chromosome', 'spanStart', 'spanEnd', 'cache_size', 'fragment_count', 'offset', 'length')
+
+    can_be_yielded = Molecule.can_be_yielded
+
+    def __init__(self, molecule, offset, length):
+        self.chromosome = molecule.chromosome
+        self.spanStart = molecule.spanStart
+        self.spanEnd = molecule.spanEnd
+        self.cache_size = molecule.cache_size
+        self.fragment_count = len(molecule)
+        self.offset = offset
+        self.length = length
+
+    def __len__(self):
+        return self.fragment_count
+
+
 class MoleculeIterator():
     """Iterate over molecules in pysam.AlignmentFile or reads from a generator or list
 
@@ -144,9 +176,8 @@ class MoleculeIterator():
 
     def __init__(self, alignments, molecule_class=Molecule,
                  fragment_class=Fragment,
-                 check_eject_every=10_000,  # bigger sizes are very speed benificial
-                 molecule_class_args={},  # because the relative amount of molecules
-                 # which can be ejected will be much higher
+                 check_eject_every=10_000,
+                 molecule_class_args={},
                  fragment_class_args={},
                  perform_qflag=True,
                  pooling_method=1,
@@ -156,7 +187,9 @@ class MoleculeIterator():
                  every_fragment_as_molecule=False,
                  yield_secondary =  False,
                  yield_supplementary= False,
-                 max_buffer_size=None,  #Limit the amount of stored reads, when this value is exceeded, a MemoryError is thrown
+                 max_buffer_size=None,  #Limit the amount of fragments stored in memory, see spill_to_disk
+                 spill_to_disk=True,
+                 spill_dir=None,
                  iterator_class = pysamiterators.iterators.MatePairIterator,
                  skip_contigs=None,
                  progress_callback_function=None,
@@ -172,16 +205,19 @@ class MoleculeIterator():
 
             fragment_class (pysam.FastaFile): Class to use for fragments.
 
-            check_eject_every (int): Check for yielding every N reads. When None is supplied, all reads are kept into memory making coordinate sorted data not required.
+            check_eject_every (int): When not None, molecules are yielded as soon as the incoming fragments are far enough away from them (see Molecule.can_be_yielded). The molecules waiting to be yielded are kept in a heap ordered by the coordinate at which they can be yielded, so the value does not need to be tuned anymore. When None is supplied, all reads are kept into memory making coordinate sorted data not required.
 
             molecule_class_args (dict): arguments to pass to molecule_class.
 
-            fragment_class_args (dict): arguments to pass to fragment_class.
+            fragment_class_args (dict): arguments to pass to fragment_class. All fragments share the settings (fragment.settings) of the first fragment.
 
             perform_qflag (bool):  Make sure the sample/umi etc tags are copied
                 from the read name into bam tags
 
-            pooling_method(int) : 0: no  pooling, 1: only compare molecules with the same sample id and hash
+            pooling_method(int) : 0: no  pooling, 1: only compare molecules with the same sample id and hash,
+                2: like 1, but only compare with molecules which have a UMI and span close enough to the fragment, using an index.
+                Yields the same molecules as 1 and is much faster when many molecules are buffered.
+                Fragment classes overriding __eq__ without declaring umi_match_required or span_match_required use 1.
 
             yield_invalid (bool) : When true all fragments which are invalid will be yielded as a molecule
 
@@ -199,6 +235,13 @@ class MoleculeIterator():
 
             min_mapping_qual(int) : Dont process reads with a mapping quality lower than this value. These reads are not yielded as molecules!
 
+            max_buffer_size(int) : Maximum amount of fragments kept in memory. When exceeded the largest groups of molecules sharing a match_hash are written to disk (spill_to_disk=True) or a MemoryError is thrown (spill_to_disk=False).
+
+            spill_to_disk(bool) : Write molecules to a temporary file when max_buffer_size is exceeded. The molecules are read back when a fragment with the same match_hash is encountered or when they can be yielded, the yielded molecules are identical to the molecules yielded without a max_buffer_size. Not available for pooling_method=0, the reads need to have a header.
+                The group of molecules with the match_hash of the current fragment is never written to disk, a single group is not bounded by max_buffer_size. When spilling could not free enough memory, spilling is only tried again when the amount of waiting fragments has doubled.
+
+            spill_dir(str) : Directory to write the temporary file to, the default temporary directory when not supplied
+
             **kwargs: arguments to pass to the pysam.AlignmentFile.fetch function
 
         Yields:
@@ -217,6 +260,10 @@ class MoleculeIterator():
         self.perform_qflag = perform_qflag
         self.pysamArgs = pysamArgs
         self.matePairIterator = None
+        if pooling_method == 2 and not MoleculeIndex.supports(fragment_class):
+            # The index does not know which criteria are used by __eq__ of the fragment class,
+            # compare every fragment to all molecules with the same match_hash instead
+            pooling_method = 1
         self.pooling_method = pooling_method
         self.yield_invalid = yield_invalid
         self.yield_overflow = yield_overflow
@@ -224,34 +271,225 @@ class MoleculeIterator():
         self.progress_callback_function = progress_callback_function
         self.iterator_class = iterator_class
         self.max_buffer_size=max_buffer_size
+        self.spill_to_disk = spill_to_disk
+        self.spill_dir = spill_dir
+        self.spill_handle = None
         self.min_mapping_qual = min_mapping_qual
+        # Settings shared by all fragments, obtained from the first fragment
+        self.fragment_settings = None
 
         self._clear_cache()
 
     def _clear_cache(self):
         """Clear cache containing non yielded molecules"""
-        self.waiting_fragments = 0
+        self.waiting_fragments = 0  # Fragments of the molecules in memory
         self.yielded_fragments = 0
         self.deleted_fragments = 0
-        self.check_ejection_iter = 0
+        self.spilled_fragments = 0  # Fragments of the molecules written to disk
+        # {match_hash: amount of molecules written to disk}, spilled molecules are
+        # stored as SpilledMolecule in molecules_per_cell at the place of the molecule
+        self.spilled_hash_groups = {}
+        # Amount of waiting fragments after which spilling is tried again when the last spill could not free enough memory
+        self.spill_retry_size = 0
+        self.read_header = None  # Header of the serialised reads
+        if self.spill_handle is not None:
+            self.spill_handle.close()
+            self.spill_handle = None
+        # Molecules are stored in dictionaries {creation index: molecule},
+        # these keep the molecules in order of creation and allow removal of a single molecule
+        self.molecule_counter = itertools.count()
+        # {contig: [(position after which the molecule can be yielded, creation index, hash), ..]}
+        self.ejection_heaps = collections.defaultdict(list)
         if self.pooling_method == 0:
-            self.molecules = []
+            self.molecules = {}
         elif self.pooling_method == 1:
             self.molecules_per_cell = collections.defaultdict(
-                list)  # {hash:[], :}
+                dict)  # {hash:{}, :}
+        elif self.pooling_method == 2:
+            self.molecules_per_cell = collections.defaultdict(dict)
+            self.molecule_index = MoleculeIndex()
         else:
             raise NotImplementedError()
 
+    def _store_molecule(self, molecule, hash_group):
+        """Store a new molecule in the buffer and schedule it for ejection"""
+        index = next(self.molecule_counter)
+        if self.pooling_method == 0:
+            self.molecules[index] = molecule
+        else:
+            self.molecules_per_cell[hash_group][index] = molecule
+            if self.pooling_method == 2:
+                self.molecule_index.add(molecule)
+        self._schedule_ejection(molecule, index, hash_group)
+
+    def _schedule_ejection(self, molecule, index, hash_group):
+        # The molecule can be yielded when the current position is beyond spanEnd + cache_size*0.5
+        eject_position = (molecule.spanEnd if molecule.spanEnd is not None else 0) + molecule.cache_size * 0.5
+        heapq.heappush(self.ejection_heaps[molecule.chromosome],
+                       (eject_position, index, hash_group))
+
+    def _get_stored_molecule(self, index, hash_group):
+        if self.pooling_method == 0:
+            return self.molecules[index]
+        return self.molecules_per_cell[hash_group][index]
+
+    def _remove_molecule(self, molecule, index, hash_group):
+        if self.pooling_method == 0:
+            del self.molecules[index]
+        else:
+            molecules = self.molecules_per_cell[hash_group]
+            del molecules[index]
+            if len(molecules) == 0:
+                del self.molecules_per_cell[hash_group]
+            if self.pooling_method == 2:
+                self.molecule_index.remove(molecule)
+        self.waiting_fragments -= len(molecule)
+        self.yielded_fragments += len(molecule)
+
+    def _create_fragment(self, reads):
+        if self.fragment_settings is None:
+            fragment = self.fragment_class(reads, **self.fragment_class_args)
+            self.fragment_settings = getattr(fragment, 'settings', None)
+            return fragment
+        return self.fragment_class(reads, settings=self.fragment_settings, **self.fragment_class_args)
+
+    def _serialise_molecule(self, molecule):
+        """Returns the molecule as bytes, the reads are stored as SAM strings"""
+        fragments = []
+        for fragment in molecule:
+            reads = []
+            for read in fragment.reads:
+                if read is None:
+                    reads.append(None)
+                    continue
+                if self.read_header is None:
+                    if read.header is None:
+                        raise ValueError('Reads without header cannot be serialised, set spill_to_disk=False')
+                    self.read_header = read.header
+                reads.append(read.to_string())
+            fragments.append(reads)
+        return pickle.dumps((molecule.overflow_fragments, fragments), protocol=pickle.HIGHEST_PROTOCOL)
+
+    def _deserialise_molecule(self, data):
+        """Rebuild a molecule serialised by _serialise_molecule, the fragments are created again
+        from the reads and added to the molecule in the original order"""
+        overflow_fragments, fragments = pickle.loads(data)
+        fragments = [
+            self._create_fragment([
+                None if read is None else pysam.AlignedSegment.fromstring(read, self.read_header)
+                for read in reads])
+            for reads in fragments]
+        molecule = self.molecule_class(fragments[0], **self.molecule_class_args)
+        for fragment in fragments[1:]:
+            molecule._add_fragment(fragment)
+        molecule.overflow_fragments = overflow_fragments
+        return molecule
+
+    def _spill_molecule(self, molecule):
+        """Write the reads of the molecule to the spill file, returns a SpilledMolecule"""
+        if self.spill_handle is None:
+            self.spill_handle = tempfile.TemporaryFile(dir=self.spill_dir)
+        data = self._serialise_molecule(molecule)
+        self.spill_handle.seek(0, 2)
+        offset = self.spill_handle.tell()
+        self.spill_handle.write(data)
+        return SpilledMolecule(molecule, offset, len(data))
+
+    def _load_molecule(self, spilled):
+        """Read a molecule back from the spill file"""
+        self.spill_handle.seek(spilled.offset)
+        return self._deserialise_molecule(self.spill_handle.read(spilled.length))
+
+    def _spill(self, keep_hash_group):
+        """Write the largest groups of molecules sharing a match_hash to disk until
+        at most half of max_buffer_size fragments are kept in memory.
+        The group of keep_hash_group, to which a fragment was just added, is kept in memory."""
+        groups = []
+        for hash_group, molecules in self.molecules_per_cell.items():
+            if hash_group == keep_hash_group:
+                continue
+            size = sum(len(molecule) for molecule in molecules.values() if not isinstance(molecule, SpilledMolecule))
+            if size > 0:
+                groups.append((size, hash_group))
+        groups.sort(key=lambda group: group[0], reverse=True)
+
+        for size, hash_group in groups:
+            if self.waiting_fragments <= self.max_buffer_size // 2:
+                break
+            molecules = self.molecules_per_cell[hash_group]
+            for index, molecule in molecules.items():
+                if isinstance(molecule, SpilledMolecule):
+                    continue
+                if self.pooling_method == 2:
+                    self.molecule_index.remove(molecule)
+                molecules[index] = self._spill_molecule(molecule)
+                self.spilled_hash_groups[hash_group] = self.spilled_hash_groups.get(hash_group, 0) + 1
+            self.waiting_fragments -= size
+            self.spilled_fragments += size
+
+    def _load_spilled_group(self, hash_group):
+        """Read all molecules with the supplied match_hash back from disk"""
+        molecules = self.molecules_per_cell[hash_group]
+        for index, spilled in molecules.items():
+            if not isinstance(spilled, SpilledMolecule):
+                continue
+            molecule = molecules[index] = self._load_molecule(spilled)
+            if self.pooling_method == 2:
+                self.molecule_index.add(molecule)
+            self.waiting_fragments += len(molecule)
+            self.spilled_fragments -= len(molecule)
+        del self.spilled_hash_groups[hash_group]
+
+    def _remove_spilled_molecule(self, spilled, index, hash_group):
+        """Remove a molecule which can be yielded from the spilled molecules, returns the molecule"""
+        molecules = self.molecules_per_cell[hash_group]
+        del molecules[index]
+        if len(molecules) == 0:
+            del self.molecules_per_cell[hash_group]
+        self.spilled_hash_groups[hash_group] -= 1
+        if self.spilled_hash_groups[hash_group] == 0:
+            del self.spilled_hash_groups[hash_group]
+        self.spilled_fragments -= len(spilled)
+        self.yielded_fragments += len(spilled)
+        return self._load_molecule(spilled)
+
+    def _eject(self, current_chrom, current_position):
+        """Yield all molecules which can be yielded given the current position
+
+        Only the molecules at the top of the ejection heaps are inspected.
+        Molecules which grew since they were scheduled are re-scheduled.
+        """
+        for contig in list(self.ejection_heaps.keys()):
+            heap = self.ejection_heaps[contig]
+            reschedule = []
+            while heap and (contig != current_chrom or heap[0][0] < current_position):
+                eject_position, index, hash_group = heapq.heappop(heap)
+                molecule = self._get_stored_molecule(index, hash_group)
+                if molecule.can_be_yielded(current_chrom, current_position):
+                    if isinstance(molecule, SpilledMolecule):
+                        molecule = self._remove_spilled_molecule(molecule, index, hash_group)
+                    else:
+                        self._remove_molecule(molecule, index, hash_group)
+                    molecule.__finalise__()
+                    yield molecule
+                else:
+                    reschedule.append((molecule, index, hash_group))
+            if len(heap) == 0:
+                del self.ejection_heaps[contig]
+            for molecule, index, hash_group in reschedule:
+                self._schedule_ejection(molecule, index, hash_group)
+
     def __repr__(self):
         return f"""Molecule Iterator, generates fragments from {self.fragment_class} into molecules based on {self.molecule_class}.
         Yielded {self.yielded_fragments} fragments, {self.waiting_fragments} fragments are waiting to be ejected. {self.deleted_fragments} fragments rejected.
+        {self.spilled_fragments} waiting fragments are written to disk.
         {self.get_molecule_cache_size()} molecules cached.
         Mate pair iterator: {str(self.matePairIterator)}"""
 
     def get_molecule_cache_size(self):
         if self.pooling_method == 0:
             return len(self.molecules)
-        elif self.pooling_method == 1:
+        elif self.pooling_method in (1, 2):
             return sum(len(cell_molecules) for cell,
                        cell_molecules in self.molecules_per_cell.items())
 
@@ -313,7 +551,7 @@ class MoleculeIterator():
             if self.perform_qflag:
                 qf.digest([R1, R2])
 
-            fragment = self.fragment_class([R1, R2], **self.fragment_class_args)
+            fragment = self._create_fragment([R1, R2])
 
             if not fragment.is_valid():
                 if self.yield_invalid:
@@ -331,18 +569,27 @@ class MoleculeIterator():
                 yield m
                 continue
 
+            if fragment.match_hash in self.spilled_hash_groups:
+                self._load_spilled_group(fragment.match_hash)
+
             added = False
             try:
                 if self.pooling_method == 0:
-                    for molecule in self.molecules:
+                    for molecule in self.molecules.values():
                         if molecule.add_fragment(fragment, use_hash=False):
                             added = True
                             break
                 elif self.pooling_method == 1:
-                    for molecule in self.molecules_per_cell[fragment.match_hash]:
+                    for molecule in self.molecules_per_cell[fragment.match_hash].values():
                         if molecule.add_fragment(fragment, use_hash=True):
                             added = True
                             break
+                elif self.pooling_method == 2:
+                    for molecule in self.molecule_index.get_candidates(fragment):
+                        if molecule.add_fragment(fragment, use_hash=True):
+                            self.molecule_index.update(molecule)
+                            added = True
+                            break
             except OverflowError:
                 # This means the fragment does belong to a molecule, but the molecule does not accept any more fragments.
                 if self.yield_overflow:
@@ -355,65 +602,264 @@ class MoleculeIterator():
                 continue
 
             if not added:
-                if self.pooling_method == 0:
-                    self.molecules.append(self.molecule_class(
-                        fragment, **self.molecule_class_args))
-                else:
-                    self.molecules_per_cell[fragment.match_hash].append(
-                        self.molecule_class(fragment, **self.molecule_class_args)
-                    )
+                self._store_molecule(
+                    self.molecule_class(fragment, **self.molecule_class_args),
+                    fragment.match_hash)
 
             self.waiting_fragments += 1
-            self.check_ejection_iter += 1
 
-            if self.max_buffer_size is not None and self.waiting_fragments>self.max_buffer_size:
-                raise MemoryError(f'max_buffer_size exceeded with {self.waiting_fragments} waiting fragments')
-
-            if self.check_eject_every is not None and self.check_ejection_iter > self.check_eject_every:
+            if self.max_buffer_size is not None and self.waiting_fragments>max(self.max_buffer_size, self.spill_retry_size):
+                if not self.spill_to_disk or self.pooling_method == 0:
+                    raise MemoryError(f'max_buffer_size exceeded with {self.waiting_fragments} waiting fragments')
+                self._spill(fragment.match_hash)
+                # The group receiving fragments can not be spilled. When it holds most of the
+                # waiting fragments, retrying every fragment would scan all molecules every time
+                self.spill_retry_size = 2 * self.waiting_fragments if self.waiting_fragments > self.max_buffer_size // 2 else 0
+            elif self.spill_retry_size and self.waiting_fragments <= self.max_buffer_size:
+                self.spill_retry_size = 0
+
+            if self.check_eject_every is not None:
                 current_chrom, _, current_position = fragment.get_span()
                 if current_chrom is None:
                     continue
-
-                self.check_ejection_iter = 0
-                if self.pooling_method == 0:
-                    to_pop = []
-                    for i, m in enumerate(self.molecules):
-                        if m.can_be_yielded(current_chrom, current_position):
-                            to_pop.append(i)
-                            self.waiting_fragments -= len(m)
-                            self.yielded_fragments += len(m)
-
-                    for i, j in enumerate(to_pop):
-                        m = self.molecules.pop(i - j)
-                        m.__finalise__()
-                        yield m
-                else:
-                    for hash_group, molecules in self.molecules_per_cell.items():
-
-                        to_pop = []
-                        for i, m in enumerate(molecules):
-                            if m.can_be_yielded(
-                                    current_chrom, current_position):
-                                to_pop.append(i)
-                                self.waiting_fragments -= len(m)
-                                self.yielded_fragments += len(m)
-
-                        for i, j in enumerate(to_pop):
-                            m = self.molecules_per_cell[hash_group].pop(i - j)
-                            m.__finalise__()
-                            yield m
+                yield from self._eject(current_chrom, current_position)
 
         # Yield remains
         if self.pooling_method == 0:
-            for m in self.molecules:
+            for m in self.molecules.values():
                 m.__finalise__()
-            yield from iter(self.molecules)
+            yield from iter(self.molecules.values())
         else:
 
             for hash_group, molecules in self.molecules_per_cell.items():
-                for i, m in enumerate(molecules):
+                for m in molecules.values():
+                    if isinstance(m, SpilledMolecule):
+                        m = self._load_molecule(m)
                     m.__finalise__()
                     yield m
         self._clear_cache()
 
 
+def get_molecule_bin_location(molecule):
+    """Obtain the location used to assign a molecule to a single bin
+
+    Returns:
+        location (tuple) : (contig, position) of the site of the molecule when the fragment class defines a site location,
+            otherwise the start of the molecule. None when the molecule has no location
+    """
+    if hasattr(molecule[0], 'get_site_location'):
+        site = molecule.get_cut_site()
+        if site is not None:
+            return site[0], site[1]
+    if molecule.chromosome is None or molecule.spanStart is None:
+        return None
+    return molecule.chromosome, molecule.spanStart
+
+
+MoleculeSummary = collections.namedtuple(
+    'MoleculeSummary', ['contig', 'position', 'strand', 'span_start', 'span_end', 'sample', 'umi', 'fragments'])
+
+
+def get_molecule_summary(molecule):
+    """Obtain a lightweight summary of a molecule, the default output of the ParallelMoleculeIterator
+
+    Returns:
+        summary (MoleculeSummary) : contig and position (see get_molecule_bin_location), strand, span_start, span_end,
+            sample, umi and the amount of fragments of the molecule
+    """
+    contig, position = get_molecule_bin_location(molecule) or (None, None)
+    return MoleculeSummary(contig, position, molecule.get_strand(), molecule.spanStart, molecule.spanEnd,
+                           molecule.sample, molecule.umi, len(molecule))
+
+
+_bin_worker_state = None
+
+
+def _init_bin_worker(alignments_path, iterator_args, molecule_summary_function):
+    # Opening the BAM file and loading its index takes longer than processing a bin
+    # without reads, the file is opened once per worker process
+    global _bin_worker_state
+    _bin_worker_state = (pysam.AlignmentFile(alignments_path), iterator_args, molecule_summary_function)
+
+
+def _get_bin_molecules(region):
+    """Worker of the ParallelMoleculeIterator, obtains the molecules located in a single bin
+
+    Returns:
+        molecules (list) : the output of molecule_summary_function for every molecule or serialised molecules
+            when molecule_summary_function is None
+    """
+    alignments, iterator_args, molecule_summary_function = _bin_worker_state
+    contig, bin_start, bin_end, fetch_start, fetch_end = region
+    molecules = []
+    molecule_iterator = MoleculeIterator(alignments, contig=contig, start=fetch_start, end=fetch_end, **iterator_args)
+    for molecule in molecule_iterator:
+        location = get_molecule_bin_location(molecule)
+        # Molecules located outside the bin are yielded by the worker of another bin
+        if location is None or location[0] != contig or not (bin_start <= location[1] < bin_end):
+            continue
+        if molecule_summary_function is not None:
+            molecules.append(molecule_summary_function(molecule))
+        else:
+            molecules.append(molecule_iterator._serialise_molecule(molecule))
+    return molecules
+
+
+def _limit_in_flight(regions, in_flight, stopped):
+    # The pool consumes the task iterator as fast as it can, the semaphore limits the
+    # amount of bins which are processed or waiting to be yielded
+    for region in regions:
+        in_flight.acquire()
+        if stopped.is_set():
+            return
+        yield region
+
+
+class ParallelMoleculeIterator(MoleculeIterator):
+    """Iterate over molecules in an indexed BAM file using multiple processes
+
+    The contigs are split into bins using blacklisted_binning_contigs, the molecules of every bin are
+    obtained by a MoleculeIterator in a worker process. Reads up to fragment_size outside of the bin are
+    fetched, a molecule is assigned to the bin containing its site (see get_molecule_bin_location).
+    The results are yielded per bin in the order of the contigs in the BAM header and the bin coordinates,
+    the order does not depend on the amount of processes.
+
+    By default a MoleculeSummary of every molecule is yielded (see get_molecule_summary), a different
+    summary is obtained by supplying molecule_summary_function which is applied to every molecule by the workers.
+    When molecule_summary_function is None the molecules themselves are yielded. These are rebuilt in the main
+    process from the reads, which takes longer than obtaining the molecules using a MoleculeIterator:
+    only use this when the processing of the molecules is done by the caller and cannot be done by the workers.
+
+    Molecules without a site or without a mapped location are not yielded, the reads are fetched per bin
+    so unmapped reads without a location are never processed.
+
+    Example:
+        >>> from singlecellmultiomics.molecule import ParallelMoleculeIterator, NlaIIIMolecule
+        >>> from singlecellmultiomics.fragment import NlaIIIFragment
+        >>> for summary in ParallelMoleculeIterator(
+        >>>         'mini_nla_test.bam',
+        >>>         molecule_class=NlaIIIMolecule,
+        >>>         fragment_class=NlaIIIFragment,
+        >>>         n_processes=4):
+        >>>     print(summary)
+        MoleculeSummary(contig='chr1', position=164834865, strand=0, span_start=164834728, span_end=164834868, sample='APKS1P25-NLAP2L2_57', umi='CCG', fragments=1)
+        ...
+    """
+
+    def __init__(self, alignments, *args,
+                 n_processes=None,
+                 bin_size=10_000_000,
+                 fragment_size=500,
+                 blacklist_path=None,
+                 molecule_summary_function=get_molecule_summary,
+                 max_bins_in_flight=None,
+                 **kwargs):
+        """Iterate over molecules in an indexed BAM file using multiple processes
+
+        Args:
+            alignments (str or pysam.AlignmentFile) : path to indexed BAM file or opened BAM file to extract molecules from
+
+            *args, **kwargs : arguments of the MoleculeIterator, these are sent to the worker processes and need to be picklable.
+                When contig, start and end are supplied only the molecules located in this region are yielded
+
+            n_processes (int) : amount of worker processes, the amount of CPUs when not supplied
+
+            bin_size (int) : size of the bins processed by a single worker
+
+            fragment_size (int) : amount of bases fetched outside of the bins, should be larger than the span of a molecule
+
+            blacklist_path (str) : path to BED file with regions to skip
+
+            molecule_summary_function (callable) : function applied to every molecule by the workers, its output is yielded.
+                It needs to be picklable. When None the molecules are yielded
+
+            max_bins_in_flight (int) : maximum amount of bins which are processed or of which the results are waiting
+                to be yielded, 4 times the amount of processes when not supplied
+
+        Yields:
+            summary (MoleculeSummary) or the output of molecule_summary_function or molecule (Molecule)
+        """
+        if isinstance(alignments, pysam.AlignmentFile):
+            self.alignments_path = alignments.filename.decode()
+        elif isinstance(alignments, str):
+            self.alignments_path = alignments
+        else:
+            raise ValueError('Supply the path to an indexed BAM file or a pysam.AlignmentFile')
+        self.n_processes = n_processes if n_processes is not None else multiprocessing.cpu_count()
+        self.bin_size = bin_size
+        self.fragment_size = fragment_size
+        self.blacklist_path = blacklist_path
+        self.molecule_summary_function = molecule_summary_function
+        self.max_bins_in_flight = max_bins_in_flight if max_bins_in_flight is not None else self.n_processes * 4
+
+        # The arguments of the MoleculeIterators of the workers, before initialisation of the molecule and fragment class arguments
+        iterator_args = inspect.signature(MoleculeIterator.__init__).bind(self, alignments, *args, **kwargs).arguments
+        iterator_args = {key: value for key, value in iterator_args.items() if key not in ('self', 'alignments')}
+        fetch_args = dict(iterator_args.pop('pysamArgs', {}))
+        self.contig = fetch_args.pop('contig', None)
+        self.start = fetch_args.pop('start', None)
+        self.end = fetch_args.pop('end', None)
+        self.iterator_args = {**iterator_args, **fetch_args}
+
+        MoleculeIterator.__init__(self, alignments, *args, **kwargs)
+
+    def get_regions(self):
+        """Obtain the regions processed by the workers, in the order the molecules are yielded
+
+        Returns:
+            regions (list) : [(contig, bin_start, bin_end, fetch_start, fetch_end), ..]
+        """
+        if self.contig is not None:
+            contig_whitelist = [self.contig]
+        else:
+            contig_whitelist = [contig for contig in get_contigs_with_reads(self.alignments_path)
+                                if contig not in self.skip_contigs]
+        regions = []
+        for contig, bin_start, bin_end, fetch_start, fetch_end in blacklisted_binning_contigs(
+                contig_length_resource=self.alignments_path,
+                bin_size=self.bin_size,
+                fragment_size=self.fragment_size,
+                blacklist_path=self.blacklist_path,
+                contig_whitelist=contig_whitelist):
+            fetch_start = max(fetch_start, 0)
+            if self.start is not None:
+                if bin_end <= self.start:
+                    continue
+                bin_start, fetch_start = max(bin_start, self.start), max(fetch_start, self.start)
+            if self.end is not None:
+                if bin_start >= self.end:
+                    continue
+                bin_end, fetch_end = min(bin_end, self.end), min(fetch_end, self.end)
+            regions.append((contig, bin_start, bin_end, fetch_start, fetch_end))
+        return regions
+
+    def __iter__(self):
+        self._clear_cache()
+        if self.molecule_summary_function is None:
+            with pysam.AlignmentFile(self.alignments_path) as alignments:
+                self.read_header = alignments.header
+
+        in_flight = threading.Semaphore(self.max_bins_in_flight)
+        stopped = threading.Event()
+        with multiprocessing.Pool(
+                self.n_processes,
+                initializer=_init_bin_worker,
+                initargs=(self.alignments_path, self.iterator_args, self.molecule_summary_function)) as workers:
+            try:
+                # imap yields the results in the order of the regions
+                for molecules in workers.imap(
+                        _get_bin_molecules,
+                        _limit_in_flight(self.get_regions(), in_flight, stopped)):
+                    for molecule in molecules:
+                        if self.molecule_summary_function is not None:
+                            yield molecule
+                            continue
+                        molecule = self._deserialise_molecule(molecule)
+                        molecule.__finalise__()
+                        self.yielded_fragments += len(molecule)
+                        yield molecule
+                    in_flight.release()
+            finally:
+                # Unblock the task feeding thread of the pool when the iteration is stopped early
+                stopped.set()
+                in_flight.release()
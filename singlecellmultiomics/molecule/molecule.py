@@ -209,6 +209,10 @@ class Molecule():
         self.min_max_mapping_quality = min_max_mapping_quality
         self.umi_counter = collections.Counter()  # Observations of umis
         self.max_associated_fragments = max_associated_fragments
+        # RT reactions per max_N_distance, cleared when a fragment is added
+        self.saved_rt_reactions = {}
+        self.rt_reaction_cache_hits = 0
+        self.rt_reaction_cache_misses = 0
         if fragments is not None:
             if isinstance(fragments, list):
                 for frag in fragments:
@@ -428,6 +432,7 @@ class Molecule():
 
 
         """
+        self.flush_tags()
         tags_obs = collections.defaultdict(collections.Counter)
         for tag, value in itertools.chain(
                 *[r.tags for r in self.iter_reads()]):
@@ -441,6 +446,9 @@ class Molecule():
     def write_tags(self):
         """ Write BAM tags to all reads associated to this molecule
 
+        The tags are kept in the fragments and are written to the reads by
+        write_pysam or flush_tags.
+
         This function sets the following tags:
             - mI : most common umi
             - DA : allele
@@ -570,28 +578,55 @@ class Molecule():
             reads( list [ pysam.AlignedSegment ] )
 
         """
-        # Set all associated reads to duplicate
-        for read in self.iter_reads():
-            read.is_duplicate = True
-
         if classifier is not None:
             features, reference_bases, CIGAR, alignment_start, alignment_end = self.get_base_calling_feature_matrix_spaced(
                 True, reference=reference, **feature_matrix_args)
 
             base_calling_probs = classifier.predict_proba(features)
-            predicted_sequence = [ 'ACGT'[i] for i in np.argmax( base_calling_probs ,1) ]
 
+        return self.deduplicate_to_single_CIGAR_spaced_from_probabilities(
+            target_bam, read_name, base_calling_probs, reference_bases, CIGAR, alignment_start, max_N_span=max_N_span)
 
-            reference_sequence = ''.join(
-                [base for chrom, pos, base in reference_bases])
-            #predicted_sequence[ features[:, [ x*8 for x in range(4) ] ].sum(1)==0 ] ='N'
-            predicted_sequence = ''.join(predicted_sequence)
+    def deduplicate_to_single_CIGAR_spaced_from_probabilities(
+            self,
+            target_bam,
+            read_name,
+            base_calling_probs,
+            reference_bases,
+            CIGAR,
+            alignment_start,
+            max_N_span=300):
+        """
+        Deduplicate all associated reads to a single pseudoread using base calling probabilities
+        predicted for the feature matrix obtained by get_base_calling_feature_matrix_spaced.
+        This allows predicting the base calling probabilities of multiple molecules at once.
 
-            phred_scores = np.rint(
-                -10 * np.log10(np.clip(1 - base_calling_probs.max(1),
-                                       0.000000001,
-                                       0.999999999)
-                               )).astype('B')
+        Args:
+            target_bam (pysam.AlignmentFile) : file to associate the read with
+            read_name (str) : name of the pseudoread
+            base_calling_probs (np.array) : base calling probabilities (ACGT) for every row of the feature matrix
+            reference_bases (list) : reference information as returned by get_base_calling_feature_matrix_spaced
+            CIGAR (list) : alignment as returned by get_base_calling_feature_matrix_spaced
+            alignment_start (int) : alignment start as returned by get_base_calling_feature_matrix_spaced
+        Returns:
+            reads( list [ pysam.AlignedSegment ] )
+        """
+        # Set all associated reads to duplicate
+        for read in self.iter_reads():
+            read.is_duplicate = True
+
+        predicted_sequence = [ 'ACGT'[i] for i in np.argmax( base_calling_probs ,1) ]
+
+        reference_sequence = ''.join(
+            [base for chrom, pos, base in reference_bases])
+        #predicted_sequence[ features[:, [ x*8 for x in range(4) ] ].sum(1)==0 ] ='N'
+        predicted_sequence = ''.join(predicted_sequence)
+
+        phred_scores = np.rint(
+            -10 * np.log10(np.clip(1 - base_calling_probs.max(1),
+                                   0.000000001,
+                                   0.999999999)
+                           )).astype('B')
 
         reads = []
 
@@ -818,6 +853,9 @@ class Molecule():
 
             COLUMN_OFFSET = 0
             features_per_block = 8 - (not USE_RT)
+            BASE_INDEX = np.full(256, -1, dtype=np.int64)  # ASCII -> block index
+            for block_index, base in enumerate('ACGTN'):
+                BASE_INDEX[ord(base)] = block_index
 
             origin_start = start
             origin_end = end
@@ -829,12 +867,12 @@ class Molecule():
                 (end - start + 1, (features_per_block * BASE_COUNT) + COLUMN_OFFSET))
 
             if return_ref_info:
-                ref_bases = {}
+                ref_bases = np.full(features.shape[0], ord('N'), dtype=np.uint8)
 
+            # Collect the aligned bases of all reads, the features are added in one go using np.add.at
+            rows, blocks, values = [], [], collections.defaultdict(list)
             for rt_id, fragments in self.get_rt_reactions().items():
-                # we need to keep track what positions where covered by this RT
-                # reaction
-                RT_reaction_coverage = set()  # (pos, base_call)
+                rt_rows, rt_blocks = [], []
                 for fragment in fragments:
                     for read in fragment:
                         if select_read_groups is not None:
@@ -847,75 +885,74 @@ class Molecule():
                         if read is None or read.reference_start > (
                                 end + 1) or read.reference_end < start:
                             continue
-                        for cycle, q_pos, ref_pos, ref_base in pysamiterators.ReadCycleIterator(
-                                read, matches_only=True, with_seq=True, reference=reference):
 
-                            row_index = ref_pos - start
-                            if row_index < 0 or row_index >= features.shape[0]:
+                        if return_ref_info:
+                            if reference is None:
+                                aligned_pairs = read.get_aligned_pairs(matches_only=True, with_seq=True)
+                            else:
+                                aligned_pairs = list(pysamiterators.iterators.ReferenceBackedGetAlignedPairs(
+                                    read, reference, matches_only=True, with_seq=True))
+                            if len(aligned_pairs) == 0:
                                 continue
+                            q_pos, ref_pos, ref_base = zip(*aligned_pairs)
+                            if reference is not None:
+                                # No base is returned for positions outside the reference
+                                ref_base = [base if base else 'N' for base in ref_base]
+                            q_pos, ref_pos = np.array(q_pos), np.array(ref_pos)
+                        else:
+                            aligned_pairs = read.get_aligned_pairs(matches_only=True)
+                            if len(aligned_pairs) == 0:
+                                continue
+                            q_pos, ref_pos = np.array(aligned_pairs).T
 
-                            query_base = read.seq[q_pos]
-                            # Base index block:
-                            block_index = 'ACGTN'.index(query_base)
-
-                            # Update rt_reactions
-                            if USE_RT:
-                                if not (
-                                        ref_pos, query_base) in RT_reaction_coverage:
-                                    features[row_index][RT_INDEX +
-                                                        COLUMN_OFFSET +
-                                                        features_per_block *
-                                                        block_index] += 1
-                                RT_reaction_coverage.add((ref_pos, query_base))
-
-                            # Update total phred score
-                            features[row_index][PHRED_INDEX +
-                                                COLUMN_OFFSET +
-                                                features_per_block *
-                                                block_index] += read.query_qualities[q_pos]
-
-                            # Update total reads
-
-                            features[row_index][RC_INDEX + COLUMN_OFFSET +
-                                                features_per_block * block_index] += 1
-
-                            # Update mate index
-                            features[row_index][MATE_INDEX +
-                                                COLUMN_OFFSET +
-                                                features_per_block *
-                                                block_index] += read.is_read2
-
-                            # Update fragment sizes:
-                            features[row_index][FS_INDEX +
-                                                COLUMN_OFFSET +
-                                                features_per_block *
-                                                block_index] += abs(fragment.span[1] -
-                                                                    fragment.span[2])
-
-                            # Update cycle
-                            features[row_index][CYCLE_INDEX +
-                                                COLUMN_OFFSET +
-                                                features_per_block *
-                                                block_index] += cycle
-
-                            # Update MQ:
-                            features[row_index][MQ_INDEX +
-                                                COLUMN_OFFSET +
-                                                features_per_block *
-                                                block_index] += read.mapping_quality
-
-                            # update strand:
-                            features[row_index][STRAND_INDEX +
-                                                COLUMN_OFFSET +
-                                                features_per_block *
-                                                block_index] += read.is_reverse
-
-                            if return_ref_info:
-                                row_index_in_output = ref_pos - origin_start
-                                if row_index_in_output < 0 or row_index_in_output >= origin_end - origin_start + 1:
-                                    continue
-
-                                ref_bases[ref_pos] = ref_base.upper()
+                        row_index = ref_pos - start
+                        in_range = (row_index >= 0) & (row_index < features.shape[0])
+                        if not in_range.any():
+                            continue
+                        q_pos, row_index = q_pos[in_range], row_index[in_range]
+
+                        # Base index block:
+                        block_index = BASE_INDEX[np.frombuffer(read.query_sequence.encode(), dtype=np.uint8)[q_pos]]
+                        if (block_index < 0).any():
+                            raise ValueError(f'Invalid base in {read.query_name}, only ACGTN are supported')
+
+                        # Obtain the sequencing cycle of every base
+                        cycle_offset = pysamiterators.iterators.getCycleOffset(read)
+                        if read.is_reverse:
+                            total_cycles = pysamiterators.iterators.getReadTotalCycles(read, cycle_offset)
+                            cycle = total_cycles - q_pos - cycle_offset - 1
+                        else:
+                            cycle = q_pos + cycle_offset
+
+                        rows.append(row_index)
+                        blocks.append(block_index)
+                        rt_rows.append(row_index)
+                        rt_blocks.append(block_index)
+                        values[PHRED_INDEX].append(np.asarray(read.query_qualities)[q_pos])
+                        values[MATE_INDEX].append(np.full(len(q_pos), read.is_read2))
+                        values[FS_INDEX].append(np.full(len(q_pos), abs(fragment.span[1] - fragment.span[2])))
+                        values[CYCLE_INDEX].append(cycle)
+                        values[MQ_INDEX].append(np.full(len(q_pos), read.mapping_quality))
+                        values[STRAND_INDEX].append(np.full(len(q_pos), read.is_reverse))
+
+                        if return_ref_info:
+                            ref_bases[row_index] = np.frombuffer(
+                                ''.join(ref_base).upper().encode(), dtype=np.uint8)[in_range]
+
+                # Every (position, base) is counted once per RT reaction
+                if USE_RT and len(rt_rows):
+                    covered = np.unique(np.concatenate(rt_rows) * BASE_COUNT + np.concatenate(rt_blocks))
+                    np.add.at(features, (covered // BASE_COUNT,
+                                         (covered % BASE_COUNT) * features_per_block + RT_INDEX + COLUMN_OFFSET), 1)
+
+            if len(rows):
+                rows = np.concatenate(rows)
+                block_columns = np.concatenate(blocks) * features_per_block + COLUMN_OFFSET
+                values[RC_INDEX] = [np.ones(len(rows))]
+                np.add.at(features,
+                          (np.tile(rows, len(values)),
+                           np.concatenate([block_columns + index for index in values])),
+                          np.concatenate([np.concatenate(index_values) for index_values in values.values()]))
 
             # Normalize all and return
 
@@ -961,9 +998,10 @@ class Molecule():
                                   1)] = x[slice_start:slice_end, :]
 
             if return_ref_info:
-                ref_info = [
-                    (self.chromosome, ref_pos, ref_bases.get(ref_pos, 'N'))
-                    for ref_pos in range(origin_start, origin_end + 1)]
+                ref_info = list(zip(
+                    itertools.repeat(self.chromosome),
+                    range(origin_start, origin_end + 1),
+                    ref_bases[NUC_RADIUS:NUC_RADIUS + origin_end - origin_start + 1].tobytes().decode()))
                 return features, ref_info
             return features
 
@@ -1465,6 +1503,7 @@ class Molecule():
         self.umi_counter[fragment.umi] += 1
         self.umi_hamming_distance = fragment.umi_hamming_distance
         self.saved_base_obs = None
+        self.saved_rt_reactions = {}
         self.update_umi()
         return True
 
@@ -1549,13 +1588,38 @@ class Molecule():
             self.cache_size *
             0.5)
 
-    def get_rt_reactions(self):
+    def get_rt_reactions(self, max_N_distance=0):
         """Obtain RT reaction dictionary
 
+        The dictionary is calculated once and stored until a fragment is added to the molecule,
+        do not modify the returned dictionary
+
+        Args:
+            max_N_distance (int) : maximum amount of N's in a random primer to match it to a random primer without N's
+
         returns:
             rt_dict (dict):  {(primer,pos) : [fragment, fragment..] }
         """
-        return molecule_to_random_primer_dict(self)
+        rt_reactions = self.saved_rt_reactions.get(max_N_distance)
+        if rt_reactions is not None:
+            self.rt_reaction_cache_hits += 1
+            return rt_reactions
+        self.rt_reaction_cache_misses += 1
+        rt_reactions = molecule_to_random_primer_dict(self, max_N_distance=max_N_distance)
+        self.saved_rt_reactions[max_N_distance] = rt_reactions
+        return rt_reactions
+
+    def get_cache_statistics(self):
+        """Obtain the amount of times the stored RT reactions were used (hits)
+        and the amount of times they had to be calculated (misses)
+
+        Returns:
+            statistics (dict) : {'rt_reaction_cache_hits': int, 'rt_reaction_cache_misses': int}
+        """
+        return {
+            'rt_reaction_cache_hits': self.rt_reaction_cache_hits,
+            'rt_reaction_cache_misses': self.rt_reaction_cache_misses
+        }
 
     def get_rt_reaction_fragment_sizes(self, max_N_distance=1):
         """Obtain all RT reaction fragment sizes
@@ -1563,8 +1627,7 @@ class Molecule():
             rt_sizes (list of ints)
         """
 
-        rt_reactions = molecule_to_random_primer_dict(
-            self, max_N_distance=max_N_distance)
+        rt_reactions = self.get_rt_reactions(max_N_distance=max_N_distance)
         amount_of_rt_reactions = len(rt_reactions)
 
         # this obtains the maximum fragment size:
@@ -1713,6 +1776,11 @@ class Molecule():
         for f in self:
             f.set_meta(tag, value)
 
+    def flush_tags(self):
+        """Write the tags set using set_meta and write_tags to the associated reads"""
+        for f in self:
+            f.flush_tags()
+
     def __getitem__(self, index):
         """Obtain a fragment belonging to this molecule.
 
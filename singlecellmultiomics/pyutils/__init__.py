@@ -1,2 +1,3 @@
 from .pyutils import *
 from .handlelimiter import *
+from .bufferedwriter import *
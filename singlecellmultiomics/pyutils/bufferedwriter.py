@@ -0,0 +1,216 @@
+# Buffered writer for many (gzipped) files at the same time
+import collections
+import concurrent.futures
+import gzip
+import queue
+import threading
+
+
+class BufferedHandleLimiter(object):
+    """Writes to many files at the same time, a replacement for HandleLimiter.
+
+    The data written to every path is buffered in memory. A buffer is flushed
+    when it exceeds flush_size bytes, when the total amount of buffered data
+    exceeds buffer_size the least recently written buffers are flushed (evicted).
+    Flushed blocks are compressed and written by a background thread, every
+    flush of a gzipped file appends a single gzip member. At most maxHandles
+    files are opened at the same time.
+
+    Example:
+        >>> writer = BufferedHandleLimiter(maxHandles=32)
+        >>> writer.write('./cell_1.fastq.gz', '@read\\nACGT\\n+\\nAAAA\\n', method=1)
+        >>> writer.close()
+        >>> writer.get_statistics()
+    """
+
+    def __init__(
+            self,
+            maxHandles=32,
+            compressionLevel=1,
+            buffer_size=128_000_000,
+            flush_size=1_000_000,
+            max_queued_flushes=16):
+        """
+        Args:
+            maxHandles (int) : maximum amount of simultaneously opened files
+
+            compressionLevel (int) : gzip compression level
+
+            buffer_size (int) : maximum total amount of buffered characters
+
+            flush_size (int) : flush the buffer of a file when it contains this amount of characters
+
+            max_queued_flushes (int) : maximum amount of blocks waiting to be written by the background thread
+        """
+        self.maxHandles = maxHandles
+        self.compressionLevel = compressionLevel
+        self.buffer_size = buffer_size
+        self.flush_size = flush_size
+
+        # path -> [method, [strings], buffered characters], ordered from least to most recently written
+        self.buffers = collections.OrderedDict()
+        self.buffered = 0
+        self.seen = set()  # Which files have been flushed before
+
+        self.statistics = collections.Counter()
+        self.flush_queue = queue.Queue(max_queued_flushes)
+        self.error = None
+        self.thread = threading.Thread(target=self._flush_worker, daemon=True)
+        self.thread.start()
+
+    def write(self, path, string, method=None, forceAppend=False):  # 0= plain, 1:gzip
+        if self.error is not None:
+            raise self.error
+        buffer = self.buffers.get(path)
+        if buffer is None:
+            buffer = self.buffers[path] = [method, [], 0]
+            if forceAppend:
+                self.seen.add(path)
+        else:
+            self.buffers.move_to_end(path)
+        buffer[1].append(string)
+        buffer[2] += len(string)
+        self.buffered += len(string)
+
+        if buffer[2] >= self.flush_size:
+            self.flush(path)
+        while self.buffered > self.buffer_size:
+            self.flush(next(iter(self.buffers)))
+            self.statistics['evictions'] += 1
+
+    def flush(self, path):
+        """Send the buffer of path to the background writer"""
+        method, strings, size = self.buffers.pop(path)
+        self.buffered -= size
+        append = path in self.seen
+        self.seen.add(path)
+        self.flush_queue.put((path, method, ''.join(strings), append))
+        self.statistics['flushes'] += 1
+
+    def _flush_worker(self):
+        handles = collections.OrderedDict()  # path -> opened file
+        try:
+            while True:
+                task = self.flush_queue.get()
+                if task is None:
+                    break
+                path, method, data, append = task
+                data = data.encode('UTF-8')
+                self.statistics['bytes_in'] += len(data)
+                if method == 1:
+                    data = gzip.compress(data, self.compressionLevel)
+
+                handle = handles.pop(path, None)
+                if handle is None or not append:
+                    if handle is not None:
+                        handle.close()
+                    if len(handles) >= self.maxHandles:
+                        handles.popitem(last=False)[1].close()
+                    handle = open(path, 'ab' if append else 'wb')
+                    self.statistics['opened_handles'] += 1
+                handles[path] = handle
+                handle.write(data)
+                self.statistics['bytes_written'] += len(data)
+        except Exception as e:
+            self.error = e
+            # Keep consuming the queue to not block the writing thread
+            while self.flush_queue.get() is not None:
+                pass
+        finally:
+            for handle in handles.values():
+                handle.close()
+
+    def get_statistics(self):
+        """
+        Returns:
+            statistics (dict) : flushes, evictions (flushes because of the buffer_size limit),
+                bytes_in (uncompressed), bytes_written, opened_handles and files
+        """
+        statistics = {key: self.statistics[key] for key in
+                      ('flushes', 'evictions', 'bytes_in', 'bytes_written', 'opened_handles')}
+        statistics['files'] = len(self.seen | set(self.buffers))
+        return statistics
+
+    def close(self):
+        if self.thread is None:
+            return
+        for path in list(self.buffers):
+            self.flush(path)
+        self.flush_queue.put(None)
+        self.thread.join()
+        self.thread = None
+        if self.error is not None:
+            raise self.error
+
+
+class ParallelGzipWriter(object):
+    """Writes a gzipped text file, blocks of the text are compressed by a pool of threads.
+
+    Every block is written as a separate gzip member, the file can be read
+    by any gzip reader and files can be concatenated using cat.
+
+    Example:
+        >>> with ParallelGzipWriter('./R1.fastq.gz', threads=4) as writer:
+        >>>     writer.write('@read\\nACGT\\n+\\nAAAA\\n')
+    """
+
+    def __init__(self, path, compressionLevel=1, threads=2, block_size=1_000_000):
+        """
+        Args:
+            path (str) : path to write the gzipped file to, an existing file is overwritten
+
+            compressionLevel (int) : gzip compression level
+
+            threads (int) : amount of compression threads
+
+            block_size (int) : amount of characters compressed at once
+        """
+        self.path = path
+        self.compressionLevel = compressionLevel
+        self.block_size = block_size
+        self.handle = open(path, 'wb')
+        self.pool = concurrent.futures.ThreadPoolExecutor(threads)
+        # Compressed blocks are written in order, at most max_pending blocks are compressed at the same time
+        self.pending = collections.deque()
+        self.max_pending = threads * 2
+        self.buffer = []
+        self.buffered = 0
+        self.blocks = 0
+
+    def write(self, string):
+        self.buffer.append(string)
+        self.buffered += len(string)
+        if self.buffered >= self.block_size:
+            self._compress_buffer()
+
+    def _compress_buffer(self):
+        data = ''.join(self.buffer).encode('UTF-8')
+        self.buffer = []
+        self.buffered = 0
+        self.pending.append(self.pool.submit(gzip.compress, data, self.compressionLevel))
+        self.blocks += 1
+        while len(self.pending) > self.max_pending:
+            self.handle.write(self.pending.popleft().result())
+
+    def flush(self):
+        if self.buffered or self.blocks == 0:
+            # An empty file still contains a (empty) gzip member
+            self._compress_buffer()
+        while len(self.pending):
+            self.handle.write(self.pending.popleft().result())
+        self.handle.flush()
+
+    def close(self):
+        if self.handle.closed:
+            return
+        try:
+            self.flush()
+        finally:
+            self.pool.shutdown()
+            self.handle.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
@@ -17,6 +17,8 @@ def readIsDuplicate(read):
 
 
 class CellReadCount(StatisticHistogram):
+    merge_attributes = ('read_counts', 'molecule_counts')
+
     def __init__(self, args):
         StatisticHistogram.__init__(self, args)
         self.read_counts = collections.Counter()
@@ -41,7 +43,7 @@ class CellReadCount(StatisticHistogram):
         pd.DataFrame({'reads':self.read_counts, 'umis':self.molecule_counts}).to_csv(path)
 
     def __repr__(self):
-        return f'The average amount of reads is {np.mean(self.read_counts.values())}'
+        return f'The average amount of reads is {np.mean(list(self.read_counts.values()))}'
 
     def plot(self, target_path, title=None):
         fig, ax = plt.subplots()
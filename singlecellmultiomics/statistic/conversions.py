@@ -12,6 +12,8 @@ matplotlib.use('Agg')
 
 
 class ConversionMatrix(StatisticHistogram):
+    merge_attributes = ('conversion_obs', 'base_obs', 'stranded_base_conversions', 'processed_reads')
+
     def __init__(self, args, process_reads=200_000):
         StatisticHistogram.__init__(self, args)
         self.conversion_obs = collections.defaultdict(collections.Counter)
@@ -0,0 +1,112 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+import pysam
+from copy import deepcopy
+from multiprocessing import Pool
+
+
+def _process_contig(task):
+    statistics, bam_path, contig, threads = task
+    engine = StatisticEngine(statistics)
+    engine.process_file(bam_path, contig=contig, threads=threads)
+    return engine.statistics, engine.processed_reads
+
+
+class StatisticEngine():
+    """Reads a BAM file once and supplies every read to all registered statistics
+
+    The work can be split by contig over multiple processes, the statistics
+    of every contig are merged afterwards using Statistic.merge
+
+    Example:
+        >>> engine = StatisticEngine([ReadCount(args), MappingQualityHistogram(args)])
+        >>> engine.process_file('tagged.bam', n_processes=8)
+        >>> rc, mq = engine.statistics
+    """
+
+    def __init__(self, statistics):
+        """
+        Args:
+            statistics (list) : statistic objects with a processRead and merge method
+        """
+        self.statistics = list(statistics)
+        self.processed_reads = 0
+
+    def process_read(self, read):
+        for statistic in self.statistics:
+            statistic.processRead(read)
+        self.processed_reads += 1
+
+    def process_reads(self, reads, head=None):
+        """Process iterable of reads
+
+        Args:
+            reads (iterable) : pysam.AlignedSegment objects
+
+            head (int) : stop after this amount of reads
+        """
+        process_functions = [statistic.processRead for statistic in self.statistics]
+        for i, read in enumerate(reads):
+            if head is not None and i >= head:
+                break
+            for process in process_functions:
+                process(read)
+            self.processed_reads += 1
+
+    def merge(self, other):
+        """Merge the statistics of an engine which processed a different part of the data"""
+        for statistic, other_statistic in zip(self.statistics, other.statistics):
+            statistic.merge(other_statistic)
+        self.processed_reads += other.processed_reads
+
+    @staticmethod
+    def get_contigs(bam_path):
+        """Obtain the contigs with reads in the bam file, '*' is used for reads without coordinate"""
+        with pysam.AlignmentFile(bam_path) as alignments:
+            contigs = [stat.contig for stat in alignments.get_index_statistics() if stat.total > 0]
+            if alignments.nocoordinate > 0:
+                contigs.append('*')
+        return contigs
+
+    def process_file(self, bam_path, contig=None, head=None, threads=1, n_processes=1):
+        """Process all reads in a bam file
+
+        Args:
+            bam_path (str) : path to bam file
+
+            contig (str) : only process reads of this contig, '*' for reads without coordinate
+
+            head (int) : stop after this amount of reads, only used when n_processes is 1
+
+            threads (int) : decompression threads used for every opened bam file
+
+            n_processes (int) : split the work by contig over this amount of processes,
+                                requires an indexed bam file
+        """
+        if n_processes > 1 and contig is None and head is None:
+            with pysam.AlignmentFile(bam_path) as alignments:
+                indexed = alignments.has_index()
+            if indexed:
+                self.process_file_by_contig(bam_path, threads=threads, n_processes=n_processes)
+                return
+
+        with pysam.AlignmentFile(bam_path, threads=threads) as alignments:
+            if contig is None:
+                reads = alignments.fetch(until_eof=True)
+            else:
+                reads = alignments.fetch(contig)
+            self.process_reads(reads, head=head)
+
+    def process_file_by_contig(self, bam_path, threads=1, n_processes=4):
+        """Process every contig of an indexed bam file in a separate task
+
+        Every task starts with a copy of the current statistics, these should
+        not have processed reads yet. The results are merged in contig order.
+        """
+        tasks = [(deepcopy(self.statistics), bam_path, contig, threads)
+                 for contig in self.get_contigs(bam_path)]
+        with Pool(n_processes) as workers:
+            for statistics, processed_reads in workers.imap(_process_contig, tasks):
+                for statistic, contig_statistic in zip(self.statistics, statistics):
+                    statistic.merge(contig_statistic)
+                self.processed_reads += processed_reads
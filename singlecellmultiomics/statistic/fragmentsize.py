@@ -15,6 +15,8 @@ def readIsDuplicate(read):
 
 
 class FragmentSizeHistogram(StatisticHistogram):
+    merge_attributes = ('histogram', 'histogramReject', 'histogramAccept')
+
     def __init__(self, args):
         StatisticHistogram.__init__(self, args)
         self.histogram = collections.Counter()
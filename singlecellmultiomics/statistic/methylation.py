@@ -11,6 +11,8 @@ matplotlib.use('Agg')
 
 
 class MethylationContextHistogram(StatisticHistogram):
+    merge_attributes = ('context_obs',)
+
     def __init__(self, args):
         StatisticHistogram.__init__(self, args)
         self.context_obs = collections.Counter()  # (bismark_call_tag)=> observations
@@ -4,7 +4,7 @@ import string
 import numpy as np
 import pandas as pd
 import matplotlib.pyplot as plt
-from .statistic import StatisticHistogram
+from .statistic import Statistic
 import singlecellmultiomics.pyutils as pyutils
 import collections
 
@@ -88,10 +88,11 @@ for ci in range(1, 97):
     index2well[96][ci] = (row, column)
 
 
-class PlateStatistic(object):
+class PlateStatistic(Statistic):
+    merge_attributes = ('rawFragmentCount', 'usableCount', 'moleculeCount', 'skipReasons')
 
     def __init__(self, args):
-        self.args = args
+        Statistic.__init__(self, args)
 
         self.rawFragmentCount = collections.defaultdict(
             collections.Counter)  # (library, mux) -> cell -> counts
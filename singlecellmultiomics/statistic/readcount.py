@@ -3,7 +3,9 @@
 
 import numpy as np
 import pandas as pd
+import array
 import collections
+import hashlib
 import matplotlib.pyplot as plt
 from .statistic import Statistic
 import singlecellmultiomics.pyutils as pyutils
@@ -13,6 +15,9 @@ matplotlib.use('Agg')
 
 
 class ReadCount(Statistic):
+    merge_attributes = ('totalMappedReads', 'unmappedReads', 'totalDedupReads',
+                        'totalAssignedSiteReads', 'rejectionReasons')
+
     def __init__(self, args):
         Statistic.__init__(self, args)
         self.totalMappedReads = collections.Counter()
@@ -142,3 +147,75 @@ class ReadCount(Statistic):
         # self.totalAssignedSiteReads['R?']>0:
         yield 'AssignedSiteReads', self.totalAssignedSiteReads
         yield 'Deduplicated reads', self.totalDedupReads
+
+
+class UniqueReadNameCount(Statistic):
+    """
+    Counts the unique query names of mapped and deduplicated (RC:i:1) reads,
+    for every mate. Reads which are aligned to multiple locations are counted once.
+
+    The query names are stored as 64 bit hashes which are kept unique with numpy,
+    the statistic can be merged with the counts of other contigs of the same file.
+    """
+    categories = [(selection, mate)
+                  for selection in ('mapped', 'dedup')
+                  for mate in ('R1', 'R2')]
+
+    def __init__(self, args, compact_size=5_000_000):
+        Statistic.__init__(self, args)
+        self.compact_size = compact_size
+        self.unique_hashes = {category: np.zeros(0, dtype=np.uint64)
+                              for category in self.categories}
+        self.pending_hashes = {category: array.array('Q')
+                               for category in self.categories}
+
+    @staticmethod
+    def hash_name(name):
+        return int.from_bytes(
+            hashlib.blake2b(name.encode(), digest_size=8).digest(), 'little')
+
+    def add(self, category, name_hash):
+        pending = self.pending_hashes[category]
+        pending.append(name_hash)
+        if len(pending) >= self.compact_size:
+            self.compact(category)
+
+    def compact(self, category):
+        self.unique_hashes[category] = np.union1d(
+            self.unique_hashes[category],
+            np.frombuffer(self.pending_hashes[category], dtype=np.uint64))
+        self.pending_hashes[category] = array.array('Q')
+
+    def processRead(self, read):
+        if read.is_unmapped:
+            return
+        if read.is_read1:
+            mate = 'R1'
+        elif read.is_read2:
+            mate = 'R2'
+        else:
+            return
+
+        name_hash = self.hash_name(read.query_name)
+        self.add(('mapped', mate), name_hash)
+        if read.has_tag('RC') and read.get_tag('RC') == 1:
+            self.add(('dedup', mate), name_hash)
+
+    def merge(self, other):
+        for category in self.categories:
+            other.compact(category)
+            self.compact(category)
+            self.unique_hashes[category] = np.union1d(
+                self.unique_hashes[category], other.unique_hashes[category])
+
+    def get_count(self, selection, mate):
+        self.compact((selection, mate))
+        return len(self.unique_hashes[(selection, mate)])
+
+    def __repr__(self):
+        return ', '.join(f'{selection} {mate}: {self.get_count(selection, mate)}'
+                         for selection, mate in self.categories)
+
+    def __iter__(self):
+        for selection, mate in self.categories:
+            yield f'{selection} {mate}', self.get_count(selection, mate)
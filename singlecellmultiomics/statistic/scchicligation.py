@@ -2,7 +2,7 @@
 # -*- coding: utf-8 -*-
 from matplotlib.ticker import MaxNLocator
 import matplotlib.pyplot as plt
-from .statistic import StatisticHistogram
+from .statistic import Statistic
 import singlecellmultiomics.pyutils as pyutils
 import collections
 import pandas as pd
@@ -12,8 +12,11 @@ matplotlib.rcParams['figure.dpi'] = 160
 matplotlib.use('Agg')
 
 
-class ScCHICLigation():
+class ScCHICLigation(Statistic):
+    merge_attributes = ('per_cell_a_obs', 'per_cell_ta_obs')
+
     def __init__(self, args):
+        Statistic.__init__(self, args)
         # cell -> { A_start: count, total_cuts: count }
         self.per_cell_a_obs = collections.defaultdict(collections.Counter)
         # cell -> { TA_start: count, total_cuts: count }
@@ -7,6 +7,33 @@ import numpy as np
 import singlecellmultiomics.pyutils as pyutils
 
 
+def merge_counts(target, source):
+    """
+    Add the counts in source to target
+
+    Parameters
+    ----------
+    target : Counter, (nested) dictionary of counts or number
+    source : object of the same structure as target
+
+    Returns
+    ----------
+    merged : target, or the sum when target is a number
+    """
+    if isinstance(target, collections.Counter):
+        # Counter.update adds the counts, also the negative ones
+        target.update(source)
+    elif isinstance(target, dict):
+        for key, value in source.items():
+            if key in target:
+                target[key] = merge_counts(target[key], value)
+            else:
+                target[key] = value
+    else:
+        return target + source
+    return target
+
+
 class Statistic(object):
 
     """
@@ -18,9 +45,29 @@ class Statistic(object):
 
     """
 
+    # Attributes which contain counts, these are added when statistics are merged
+    merge_attributes = ()
+
     def __init__(self, args):
         self.args = args
 
+    def merge(self, other):
+        """
+        Add the observations of a statistic of the same class which
+        processed other reads, for example a different contig
+
+        Parameters
+        ----------
+        other : Statistic
+
+        Returns
+        ----------
+        None
+        """
+        for attribute in self.merge_attributes:
+            setattr(self, attribute, merge_counts(
+                getattr(self, attribute), getattr(other, attribute)))
+
     def processRead(self, read):
         """
         Update the statistic with information from READ
@@ -40,6 +87,8 @@ class Statistic(object):
 
 
 class StatisticHistogram(Statistic):
+    merge_attributes = ('histogram',)
+
     def __init__(self, args):
         Statistic.__init__(self, args)
         self.histogram = collections.Counter()
@@ -6,6 +6,8 @@ import singlecellmultiomics.pyutils as pyutils
 
 
 class TrimmingStats(StatisticHistogram):
+    merge_attributes = ('totalFragmentsTrimmed',)
+
     def __init__(self, args):
         StatisticHistogram.__init__(self, args)
         self.totalFragmentsTrimmed = 0
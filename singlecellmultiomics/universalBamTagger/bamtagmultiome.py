@@ -5,7 +5,7 @@ import pysam
 from singlecellmultiomics.molecule import MoleculeIterator, ReadIterator
 import singlecellmultiomics
 import singlecellmultiomics.molecule
-from singlecellmultiomics.molecule.consensus import calculate_consensus
+from singlecellmultiomics.molecule.consensus import BatchedConsensusWriter
 import singlecellmultiomics.fragment
 from singlecellmultiomics.bamProcessing.bamFunctions import sorted_bam_file, get_reference_from_pysam_alignmentFile, write_program_tag, MapabilityReader, verify_and_fix_bam
 
@@ -18,9 +18,9 @@ from pysamiterators import MatePairIteratorIncludingNonProper, MatePairIterator
 from singlecellmultiomics.universalBamTagger.tagging import generate_tasks
 from singlecellmultiomics.bamProcessing.bamBinCounts import blacklisted_binning_contigs
 from singlecellmultiomics.utils.binning import bp_chunked
-from singlecellmultiomics.universalBamTagger.tagging import run_tagging_tasks
+from singlecellmultiomics.universalBamTagger.tagging import run_tagging_tasks, split_task
 from multiprocessing import Pool
-from singlecellmultiomics.bamProcessing import merge_bams, get_contigs_with_reads
+from singlecellmultiomics.bamProcessing import merge_sorted_bams, get_contigs_with_reads
 from singlecellmultiomics.fastaProcessing import CachedFastaNoHandle
 from singlecellmultiomics.utils.prefetch import UnitialisedClass
 from typing import Generator
@@ -32,6 +32,7 @@ import colorama
 import pkg_resources
 import pickle
 from datetime import datetime
+from collections import Counter
 
 
 available_consensus_models = pkg_resources.resource_listdir('singlecellmultiomics','molecule/consensus_model')
@@ -118,6 +119,16 @@ argparser.add_argument(
     '-temp_folder',
     default='./scmo',
     help="Temp folder")
+argparser.add_argument(
+    '-max_time_per_segment',
+    type=int,
+    default=None,
+    help="Maximum time in seconds spent on tagging a single segment when using --multiprocess. Segments taking longer are split into smaller segments and retried")
+argparser.add_argument(
+    '-segment_retry_depth',
+    type=int,
+    default=2,
+    help="Amount of times a timed out segment is split and retried, segments which still time out are written to a .failed_regions.bed file next to the output bam")
 
 
 fragment_settings = argparser.add_argument_group('Fragment settings')
@@ -218,6 +229,11 @@ cg.add_argument(
     type=int,
     help='consensus model k radius',
     default=3)
+cg.add_argument(
+    '-consensus_batch_size',
+    type=int,
+    help='Amount of molecules for which the consensus is predicted at once',
+    default=100)
 
 
 cg.add_argument('--no_source_reads', action='store_true',
@@ -248,7 +264,7 @@ def tag_multiome_multi_processing(
         molecule_iterator_args: dict = None,
         ignore_bam_issues: bool = False,  # @todo add ignore_bam_issues
         head: int = None,  # @todo add head
-        no_source_reads: bool = False,  # @todo add no_source_reads
+        no_source_reads: bool = False,
         # One extra parameter is the fragment size:
         fragment_size: int = None,
         # And the blacklist is optional:
@@ -257,9 +273,21 @@ def tag_multiome_multi_processing(
         bp_per_segment: int = None,
         temp_folder: str = '/tmp/scmo',
         max_time_per_segment: int = None,
+        consensus_model = None,
+        consensus_model_args: dict = None,
+        segment_retry_depth: int = 2,
+        segment_split_factor: int = 4,
+        segment_timeout_multiplier: float = 2,
         use_pool: bool = True
 
     ):
+    """ Tag molecules in input_bam_path using multiple processes
+
+    The genome is split into segments of bp_per_segment, which are grouped into jobs of bp_per_job.
+    When max_time_per_segment is set, segments which take longer to process are split into
+    segment_split_factor smaller segments and retried with a timeout multiplied by segment_timeout_multiplier,
+    up to segment_retry_depth times. Segments which still time out are written to {out_bam_path}.failed_regions.bed
+    """
 
     assert bp_per_job is not None
     assert fragment_size is not None
@@ -282,7 +310,10 @@ def tag_multiome_multi_processing(
 
     iteration_args = {
         'molecule_iterator_args': molecule_iterator_args,
-        'molecule_iterator_class': MoleculeIterator
+        'molecule_iterator_class': MoleculeIterator,
+        'consensus_model': consensus_model,
+        'consensus_model_args': consensus_model_args,
+        'no_source_reads': no_source_reads
     }
 
     # Define the regions to be processed and group into segments to perform tagging on
@@ -303,24 +334,17 @@ def tag_multiome_multi_processing(
                            temp_folder=temp_folder,
                            max_time_per_segment=max_time_per_segment)
 
-    # Create header bam:
-    temp_header_bam_path = f'{uuid.uuid4()}_header.bam'
     with pysam.AlignmentFile(input_bam_path) as input_bam:
         input_header = input_bam.header.as_dict()
 
-        # Write provenance information to BAM header
-        write_program_tag(
-            input_header,
-            program_name='bamtagmultiome',
-            command_line=" ".join(
-                sys.argv),
-            version=singlecellmultiomics.__version__,
-            description=f'SingleCellMultiOmics molecule processing, executed at {datetime.now().strftime("%d/%m/%Y %H:%M:%S")}')
-
-        with pysam.AlignmentFile(temp_header_bam_path, 'wb', header=input_header) as out:
-            pass
-
-        pysam.index(temp_header_bam_path)
+    # Write provenance information to BAM header
+    write_program_tag(
+        input_header,
+        program_name='bamtagmultiome',
+        command_line=" ".join(
+            sys.argv),
+        version=singlecellmultiomics.__version__,
+        description=f'SingleCellMultiOmics molecule processing, executed at {datetime.now().strftime("%d/%m/%Y %H:%M:%S")}')
 
 
     # Prefetch the genomic resources with the defined genomic interval reducing I/O load during processing of the region
@@ -329,19 +353,63 @@ def tag_multiome_multi_processing(
     # @todo : Obtain auto blacklisted regions if applicable
     # @todo : Progress indication
 
-    if use_pool:
-        with Pool() as workers:
-            tagged_bam_generator = list((bam for bam, meta in workers.imap_unordered(run_tagging_tasks, tasks) if
-                                         bam is not None))
-            # Changing this to generator and casting to list later makes this not work. I don't understand it
-    else:
-        tagged_bam_generator = [bam for bam, meta in (run_tagging_tasks(task) for task in tasks) if
-                                bam is not None]
-
-    tagged_bam_generator = [temp_header_bam_path] + tagged_bam_generator
+    tagged_bam_generator = []
+    timeout_tasks = []
+    read_groups = dict()
+    cache_statistics = Counter()
 
-    # merge the results and clean up:
-    merge_bams(list(tagged_bam_generator), out_bam_path)
+    def run_tasks(tasks, workers):
+        if workers is not None:
+            results = list(workers.imap_unordered(run_tagging_tasks, tasks))
+            # Changing this to generator and casting to list later makes this not work. I don't understand it
+        else:
+            results = [run_tagging_tasks(task) for task in tasks]
+        for bams, meta in results:
+            tagged_bam_generator.extend(bams)
+            timeout_tasks.extend(meta['timeout_tasks'])
+            read_groups.update(meta['read_groups'])
+            cache_statistics.update(meta['cache_statistics'])
+
+    workers = Pool() if use_pool else None
+    try:
+        run_tasks(tasks, workers)
+
+        # Segments which took too long are split into smaller segments and retried with a longer timeout:
+        for depth in range(1, segment_retry_depth + 1):
+            if len(timeout_tasks) == 0 or max_time_per_segment is None:
+                break
+            retry_timeout = max_time_per_segment * (segment_timeout_multiplier ** depth)
+            retry_tasks = [
+                ((input_bam_path, temp_folder, retry_timeout), [sub_task])
+                for task in timeout_tasks
+                for sub_task in split_task(task,
+                                           bin_size=int((task['end'] - task['start']) / segment_split_factor),
+                                           fragment_size=fragment_size,
+                                           timeout_time=retry_timeout)
+            ]
+            print(f'{len(timeout_tasks)} segments timed out, retrying as {len(retry_tasks)} smaller segments '
+                  f'with a timeout of {retry_timeout} seconds')
+            timeout_tasks = []
+            run_tasks(retry_tasks, workers)
+    finally:
+        if workers is not None:
+            workers.terminate()
+
+    if len(timeout_tasks) > 0:
+        failed_regions_path = f'{out_bam_path}.failed_regions.bed'
+        print(f'{colorama.Style.BRIGHT}{colorama.Fore.RED}{len(timeout_tasks)} segments could not be processed '
+              f'within the time limit, these are listed in {failed_regions_path}{colorama.Style.RESET_ALL}')
+        with open(failed_regions_path, 'w') as o:
+            for task in sorted(timeout_tasks, key=lambda task: (task['contig'], task['start'])):
+                o.write(f"{task['contig']}\t{task['start']}\t{task['end']}\n")
+
+    print_cache_statistics(cache_statistics)
+
+    if len(read_groups):
+        input_header['RG'] = list(read_groups.values())
+
+    # The outputs of the workers are coordinate sorted, merge the results and clean up:
+    merge_sorted_bams(tagged_bam_generator, out_bam_path, header=input_header)
 
 
 
@@ -375,7 +443,12 @@ def tag_multiome_single_thread(
                                                             if k != 'alignments'})
 
     read_groups = dict()  # Store unique read groups in this dict
+    cache_statistics = Counter()
     with sorted_bam_file(out_bam_path, header=input_header, read_groups=read_groups) as out:
+        if consensus_model is not None:
+            # The consensus of multiple molecules is predicted at once, the writer also writes the source reads
+            consensus_writer = BatchedConsensusWriter(consensus_model, out, write_source_reads=not no_source_reads,
+                                                      **consensus_model_args)
         try:
             for i, molecule in enumerate(molecule_iterator_exec):
 
@@ -403,21 +476,30 @@ def tag_multiome_single_thread(
 
                 # Calculate molecule consensus
                 if consensus_model is not None:
-                    calculate_consensus(molecule,
-                                        consensus_model,
-                                        i,
-                                        out,
-                                        **consensus_model_args)
+                    consensus_writer.add(molecule, i)
 
                 # Write the reads to the output file
-                if not no_source_reads:
+                elif not no_source_reads:
                     molecule.write_pysam(out)
+
+                cache_statistics.update(molecule.get_cache_statistics())
+
+            if consensus_model is not None:
+                consensus_writer.flush()
         except Exception as e:
             write_status(out_bam_path,'FAIL, The file is not complete')
             raise e
 
         # Reached the end of the generator
         write_status(out_bam_path,'Reached end. All ok!')
+    print_cache_statistics(cache_statistics)
+
+def print_cache_statistics(cache_statistics):
+    """Print the summed Molecule.get_cache_statistics() of the written molecules"""
+    hits = cache_statistics.get('rt_reaction_cache_hits', 0)
+    misses = cache_statistics.get('rt_reaction_cache_misses', 0)
+    if hits + misses > 0:
+        print(f'RT reaction cache: {hits} hits, {misses} misses ({100 * hits / (hits + misses):.1f}% hits)')
 
 def write_status(output_path, message):
     status_path = output_path.replace('.bam','.status.txt')
@@ -610,8 +692,10 @@ def run_multiome_tagging(args):
 
         transcriptome_features = singlecellmultiomics.features.FeatureContainer()
         print("Loading exons", end='\r')
+        # When using multiprocessing the GTF files are compiled into an index once, which is sliced for every segment
         transcriptome_features.preload_GTF(
             args.exons,
+            index_path=(f'{args.temp_folder}/{os.path.basename(args.exons)}.exon_index' if args.multiprocess else None),
             select_feature_type=['exon'],
             identifierFields=(
                 'exon_id',
@@ -624,6 +708,7 @@ def run_multiome_tagging(args):
             print("Loading introns", end='\r')
             transcriptome_features.preload_GTF(
                 args.introns,
+                index_path=(f'{args.temp_folder}/{os.path.basename(args.introns)}.intron_index' if args.multiprocess else None),
                 select_feature_type=['intron'],
                 identifierFields=['transcript_id'],
                 store_all=True,
@@ -640,7 +725,7 @@ def run_multiome_tagging(args):
     bp_per_job = 10_000_000
     bp_per_segment = 999_999_999 #@todo make this None or so
     fragment_size = 500
-    max_time_per_segment = None
+    max_time_per_segment = args.max_time_per_segment
 
     ### Method specific configuration ###
     if args.method == 'qflag':
@@ -873,6 +958,7 @@ def run_multiome_tagging(args):
 
     #####
     consensus_model_path = None
+    consensus_model = None
 
     if args.consensus:
         # Load from path if available:
@@ -902,12 +988,15 @@ def run_multiome_tagging(args):
             else:
                 mask_variants = pysam.VariantFile(args.consensus_mask_variants)
             print("Fitting consensus model, this may take a long time")
-            consensus_model = singlecellmultiomics.molecule.train_consensus_model(
-                molecule_iterator,
-                mask_variants=mask_variants,
-                n_train=args.consensus_n_train,
-                skip_already_covered_bases=skip_already_covered_bases
-                )
+            with pysam.AlignmentFile(args.bamin) as training_alignments:
+                consensus_model = singlecellmultiomics.molecule.train_consensus_model(
+                    molecule_iterator(training_alignments, **{k:v for k, v in molecule_iterator_args.items()
+                                                             if k != 'alignments'}),
+                    mask_variants=mask_variants,
+                    n_train=args.consensus_n_train,
+                    skip_already_covered_bases=skip_already_covered_bases,
+                    NUC_RADIUS=args.consensus_k_rad
+                    )
             # Write the consensus model to disk
             consensus_model_path = os.path.abspath(
                 os.path.dirname(args.o)) + '/consensus_model.pickle.gz'
@@ -1023,6 +1112,8 @@ def run_multiome_tagging(args):
 
 
 
+    consensus_model_args = {'consensus_k_rad': args.consensus_k_rad, 'batch_size': args.consensus_batch_size}
+
     if args.multiprocess:
 
         print("Tagging using multi-processing")
@@ -1030,7 +1121,9 @@ def run_multiome_tagging(args):
                                       molecule_iterator_args=molecule_iterator_args,ignore_bam_issues=args.ignore_bam_issues,
                                       head=args.head, no_source_reads=args.no_source_reads,
                                       fragment_size=fragment_size, blacklist_path=args.blacklist,bp_per_job=bp_per_job,
-                                      bp_per_segment=bp_per_segment, temp_folder=args.temp_folder, max_time_per_segment=max_time_per_segment)
+                                      bp_per_segment=bp_per_segment, temp_folder=args.temp_folder, max_time_per_segment=max_time_per_segment,
+                                      consensus_model=consensus_model, consensus_model_args=consensus_model_args,
+                                      segment_retry_depth=args.segment_retry_depth)
     else:
         # Alignments are passed as pysam handle:
         if args.blacklist is not None:
@@ -1040,8 +1133,8 @@ def run_multiome_tagging(args):
             args.o,
             molecule_iterator = molecule_iterator,
             molecule_iterator_args = molecule_iterator_args,
-            consensus_model = None ,
-            consensus_model_args={},
+            consensus_model = consensus_model,
+            consensus_model_args = consensus_model_args,
             ignore_bam_issues=False,
             head=args.head,
             no_source_reads=args.no_source_reads
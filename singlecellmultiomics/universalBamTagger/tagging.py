@@ -1,9 +1,12 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
+from collections import Counter
 from datetime import datetime
 from os import remove
 from pysam import AlignmentFile
-from singlecellmultiomics.bamProcessing import sorted_bam_file
+from singlecellmultiomics.bamProcessing import ReorderingBamWriter
+from singlecellmultiomics.bamProcessing.bamBinCounts import blacklisted_binning
+from singlecellmultiomics.molecule.consensus import BatchedConsensusWriter
 from uuid import uuid4
 from copy import copy
 from typing import Generator
@@ -23,6 +26,10 @@ def prefetch(contig, start, end, fetch_start,fetch_end,molecule_iterator_args):
                     value = value.prefetch(contig,start,end)
                 if key == 'mappability_reader':
                     value = value.prefetch(contig,start,end)
+                if key == 'allele_resolver' and value is not None:
+                    value = value.prefetch(contig,
+                                           start if fetch_start is None else fetch_start,
+                                           end if fetch_end is None else fetch_end)
                 new_args[key] = value
             new_kwarg_dict[iterator_arg] = new_args
         else:
@@ -32,7 +39,8 @@ def prefetch(contig, start, end, fetch_start,fetch_end,molecule_iterator_args):
 def run_tagging_task(alignments, output,
                     contig=None, start =None, end=None, fetch_start=None, fetch_end=None,
                     molecule_iterator_class=None,  molecule_iterator_args={},
-                    read_groups=None, timeout_time=None, enable_prefetch=True ):
+                    read_groups=None, timeout_time=None, enable_prefetch=True,
+                    consensus_model=None, consensus_model_args=None, no_source_reads=False ):
     """ Run tagging task for the supplied region
 
     Args:
@@ -48,8 +56,13 @@ def run_tagging_task(alignments, output,
         molecule_iterator_class (class) : Class of the molecule iterator (not initialised, will be constructed using **molecule_iterator_args )
         molecule_iterator_args  (dict) : Arguments for the molecule iterator
 
+        consensus_model : Classifier used to create consensus reads, see BatchedConsensusWriter
+        consensus_model_args (dict) : Arguments for the BatchedConsensusWriter
+        no_source_reads (bool) : Do not write the reads of the molecules, only the consensus reads
+
     Returns:
-        statistics : {'molecules_written':molecules_written}
+        statistics : {'total_molecules_written':molecules_written, 'time_start':time_start,
+            'cache_statistics': summed Molecule.get_cache_statistics() of the written molecules}
 
     Raises:
         TimeoutError when the molecule_iterator_class decides tagging is taking too long
@@ -86,7 +99,12 @@ def run_tagging_task(alignments, output,
         if (datetime.now()-time_start).total_seconds() > timeout_time:
             raise TimeoutError()
 
+    if consensus_model is not None:
+        consensus_writer = BatchedConsensusWriter(consensus_model, output, write_source_reads=not no_source_reads,
+                                                  **(consensus_model_args or {}))
+
     total_molecules_written = 0
+    cache_statistics = Counter()
     for i,molecule in enumerate(
             molecule_iterator_class(alignments,  # Input alignments
                             contig=contig, start=fetch_start, end=fetch_end, # Region
@@ -125,11 +143,19 @@ def run_tagging_task(alignments, output,
                 if not rgid in read_groups:
                     read_groups[rgid] = fragment.get_read_group(True)[1]
 
-        molecule.write_pysam(output)
+        if consensus_model is not None:
+            consensus_writer.add(molecule, f'{start}_{i}')
+        elif not no_source_reads:
+            molecule.write_pysam(output)
         total_molecules_written+=1
+        cache_statistics.update(molecule.get_cache_statistics())
+
+    if consensus_model is not None:
+        consensus_writer.flush()
 
     return {'total_molecules_written':total_molecules_written,
-            'time_start':time_start}
+            'time_start':time_start,
+            'cache_statistics':dict(cache_statistics)}
 
 
 
@@ -139,6 +165,11 @@ def run_tagging_tasks(args: tuple):
     Args:
         args (tuple): (alignments_path, temp_dir, timeout_time), arglist
 
+    Returns:
+        target_files (list) : coordinate sorted bam files, these can be merged using merge_sorted_bams
+
+        meta (dict) : {'timeout_tasks', 'total_molecules', 'read_groups', 'cache_statistics'}
+
     """
 
     (alignments_path, temp_dir, timeout_time), arglist = args
@@ -147,35 +178,56 @@ def run_tagging_tasks(args: tuple):
 
     timeout_tasks = []
     total_molecules = 0
+    cache_statistics = Counter()
     read_groups = dict()
 
     with AlignmentFile(alignments_path) as alignments:
-        with sorted_bam_file(target_file, origin_bam=alignments, mode='wbu',
-            fast_compression=True, read_groups=read_groups) as output:
+        # The tasks are sorted by coordinate, the molecules are written almost sorted
+        with ReorderingBamWriter(target_file, header=alignments.header, mode='wbu') as output:
             for task  in arglist:
-                try:
+                # Tasks can carry their own timeout, this is used when a timed out task is retried
+                task = copy(task)
+                task_timeout_time = task.pop('timeout_time', timeout_time)
+                if task_timeout_time is None:
                     statistics = run_tagging_task(alignments, output, read_groups=read_groups, **task)
                     total_molecules += statistics.get('total_molecules_written',0)
+                    cache_statistics.update(statistics.get('cache_statistics',{}))
+                    continue
+
+                # When the task times out the molecules written so far should not end up in the output,
+                # as the task will be retried. Write to a temporary file first:
+                task_file = f"{target_file}.task.bam"
+                try:
+                    with AlignmentFile(task_file, 'wbu', header=alignments.header) as task_output:
+                        statistics = run_tagging_task(alignments, task_output, read_groups=read_groups,
+                                                      timeout_time=task_timeout_time, **task)
+                    with AlignmentFile(task_file, check_sq=False) as task_reads:
+                        for read in task_reads:
+                            output.write(read)
+                    total_molecules += statistics.get('total_molecules_written',0)
+                    cache_statistics.update(statistics.get('cache_statistics',{}))
                 except TimeoutError:
                     timeout_tasks.append( task )
+                finally:
+                    try:
+                        remove(task_file)
+                    except FileNotFoundError:
+                        pass
 
 
     meta = {
         'timeout_tasks' : timeout_tasks,
         'total_molecules' : total_molecules,
+        'read_groups' : read_groups,
+        'cache_statistics' : dict(cache_statistics)
     }
 
     if total_molecules>0:
-        return target_file, meta
+        return output.paths, meta
     else:
-        # Clean up ?
-        try:
-            remove(target_file)
-            remove(f'{target_file}.bai')
-        except Exception as e:
-                pass
-
-        return None, meta
+        for path in output.paths:
+            remove(path)
+        return [], meta
 
 
 def generate_tasks(input_bam_path: str, temp_folder: str, job_gen: Generator, iteration_args: dict,
@@ -194,3 +246,29 @@ def generate_tasks(input_bam_path: str, temp_folder: str, job_gen: Generator, it
                 **iteration_args
 
             } for contig, start, end, fetch_start, fetch_end in job]) for job in job_gen)
+
+
+def split_task(task: dict, bin_size: int, fragment_size: int, timeout_time: int = None) -> list:
+    """ Split a (timed out) tagging task into smaller tasks
+
+    Args:
+        task (dict) : task as generated by generate_tasks
+        bin_size (int) : size of the new segments
+        fragment_size (int) : reads are fetched this amount of bp around every segment, limited to the fetch bounds of the original task
+        timeout_time (int) : timeout in seconds for the new tasks
+
+    Returns:
+        tasks (list)
+    """
+    tasks = []
+    for start, end in blacklisted_binning(task['start'], task['end'], max(1, bin_size)):
+        sub_task = copy(task)
+        sub_task.update({
+            'start': start,
+            'end': end,
+            'fetch_start': max(task['fetch_start'], start - fragment_size),
+            'fetch_end': min(task['fetch_end'], end + fragment_size),
+            'timeout_time': timeout_time
+        })
+        tasks.append(sub_task)
+    return tasks
@@ -29,6 +29,7 @@ import pickle
 from singlecellmultiomics.alleleTools import alleleTools
 import uuid
 import collections
+import functools
 import glob
 c = 1_000  # !!! PLEASE USE PYTHON 3.6 OR HIGHER !!!
 complement = str.maketrans('ATGC', 'TACG')
@@ -448,11 +449,115 @@ class TranscriptIterator(MoleculeIterator_OLD):
                    self.assignment_radius) * self.assignment_radius
 
 
+# Query names consisting of these characters are only modified by fqSafe by removing the @
+# which is part of the instrument tag
+_safe_tagged_query_name_regex = re.compile('[a-zA-Z0-9-_:;@]*')
+
+
+@functools.lru_cache(maxsize=256)
+def _query_name_layout(tags):
+    """Check if the tags of a query name can be handled by QueryNameFlagger.tag_read
+
+    Args:
+        tags (tuple) : tags in the order in which they occur in the query name
+
+    Returns:
+        phred_tags (tuple) : phred encoded tags which can be present after adding the
+            molecule identifier and sample tags, None when the tags can not be handled
+    """
+    tag_definitions = singlecellmultiomics.modularDemultiplexer.baseDemultiplexMethods.TagDefinitions
+    if len(set(tags)) != len(tags) or 'LY' not in tags or 'BI' in tags or any(
+            tag not in tags for tag in ('Is', 'RN', 'Fc', 'La', 'Ti', 'CX', 'CY')) or any(
+            tag not in tag_definitions for tag in tags):
+        return None
+    return tuple(tag for tag in dict.fromkeys(tags + ('ah', 'MI', 'QM', 'BK', 'SM'))
+                 if tag_definitions[tag].isPhred)
+
+
+@functools.lru_cache(maxsize=4096)
+def _query_name_prefix_tags(library, cell, corrected_index, index_sequence, flowcell, lane):
+    """Obtain the tags which only depend on the library, cell, sequencing index and lane of a read
+
+    Returns:
+        ah (int or None), SM (str), RG (str)
+    """
+    ah = None
+    if corrected_index is not None and index_sequence is not None:
+        ah = hamming_distance(index_sequence, corrected_index)
+    sample = f'{library}_{"BULK" if cell is None else cell}'
+    return ah, sample, f'{flowcell}.{lane}.{sample}'
+
+
 class QueryNameFlagger(DigestFlagger):
     def __init__(self, **kwargs):
         self.assignedReadGroups = set()
         DigestFlagger.__init__(self, **kwargs)
 
+    def tag_read(self, read):
+        """Tag a read using the tags encoded in the query name.
+
+        Equivalent to tagging the read using TaggedRecord.tagPysamRead, the
+        query name is split once and the tags which depend only on the
+        library, cell and lane are cached.
+
+        Returns:
+            tagged (bool) : False when the query name is not handled, the read is not modified
+        """
+        query_name = read.query_name.strip()
+        if _safe_tagged_query_name_regex.fullmatch(query_name) is None or query_name.count(
+                ':') != query_name.count(';') + 1:
+            return False
+        fields = query_name.replace(';', ':').split(':')
+        keys = tuple(fields[0::2])
+        phred_tags = _query_name_layout(keys)
+        if phred_tags is None:
+            return False
+        if '@' in query_name:
+            fields = query_name.replace('@', '').replace(';', ':').split(':')
+            if tuple(fields[0::2]) != keys:
+                return False
+        tags = dict(zip(keys, fields[1::2]))
+
+        # Molecule identifier, see TaggedRecord.tagPysamRead
+        molecule_identifier = ''
+        molecule_quality = ''
+        qt_missing = False
+        for tag, quality_tag in (('BC', 'QT'), ('RX', 'RQ')):
+            if tag in tags:
+                molecule_identifier += tags[tag]
+                if quality_tag in tags:
+                    molecule_quality += tags[quality_tag]
+                elif quality_tag == 'QT':
+                    qt_missing = True
+
+        corrected_index = tags.get('aA')
+        ah, sample, read_group = _query_name_prefix_tags(
+            tags['LY'], tags.get('bi'), corrected_index, tags.get('aa'), tags['Fc'], tags['La'])
+        if corrected_index is None:
+            tags['BK'] = True
+        else:
+            if ah is not None:
+                tags['ah'] = ah
+            tags['MI'] = molecule_identifier + corrected_index
+            if not qt_missing:
+                tags['QM'] = molecule_quality + 'o' * len(corrected_index)
+        tags['SM'] = sample
+
+        if not qt_missing and 'QM' in tags and len(tags['QM']) != len(tags['MI']):
+            raise ValueError('QM and MI tag length not matching')
+
+        read.query_name = '{Is}:{RN}:{Fc}:{La}:{Ti}:{CX}:{CY}'.format(**tags)
+        for tag in phred_tags:
+            if tag in tags:
+                tags[tag] = singlecellmultiomics.modularDemultiplexer.baseDemultiplexMethods.fastqHeaderSafeQualitiesToPhred(
+                    tags[tag], method=3)
+        tags['RG'] = read_group
+
+        for tag, value in tags.items():
+            read.set_tag(tag, value)
+        self.assignedReadGroups.add(read_group)
+        return True
+
     def digest(self, reads):
         for read in reads:
             if read is None:
@@ -462,7 +567,7 @@ class QueryNameFlagger(DigestFlagger):
             if read.query_name.startswith('UMI'):  # Old format
                 import tagBamFile  # this is not included anymore
                 tagBamFile.recodeRead(read)
-            else:
+            elif not self.tag_read(read):
                 tr = singlecellmultiomics.modularDemultiplexer.baseDemultiplexMethods.TaggedRecord(
                     singlecellmultiomics.modularDemultiplexer.baseDemultiplexMethods.TagDefinitions
                 )
@@ -193,7 +193,8 @@ def recall_variants(args):
                    'allele_resolver':unphased_allele_resolver,
                     'max_associated_fragments':20,
                 },
-                max_buffer_size=max_buffer_size
+                max_buffer_size=max_buffer_size,
+                spill_to_disk=False # Skip loci with too many waiting fragments
             )
 
             reference_called_molecules = [] # molecule, phase
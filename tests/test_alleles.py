@@ -4,6 +4,7 @@ import unittest
 import itertools
 import pysam
 import os
+import shutil
 from singlecellmultiomics.alleleTools import AlleleResolver
 import pysam
 
@@ -53,6 +54,53 @@ class TestAlleleResolver(unittest.TestCase):
         except Exception as e:
             raise
 
+    def test_allele_cache_and_prefetch(self):
+
+        test_vcf_path = './data/cached_alleles.vcf'
+        vcf_string = """##fileformat=VCFv4.0
+##reference=example.fa
+##contig=<ID=1,length=42>
+##contig=<ID=2,length=42>
+##INFO=<ID=DP,Number=1,Type=Integer,Description="Total Depth">
+##FORMAT=<ID=GT,Number=1,Type=String,Description="Genotype">
+#CHROM\tPOS\tID\tREF\tALT\tQUAL\tFILTER\tINFO\tFORMAT\tSAMPLE_A\tSAMPLE_B
+1\t18\t.\tA\tT\t42\tPASS\tDP=4\tGT\t1/1\t1/1
+1\t20\t.\tA\tT\t42\tPASS\tDP=4\tGT\t0/0\t1/1
+1\t22\t.\tG\tA\t42\tPASS\tDP=4\tGT\t0/0\t1/1
+1\t40\t.\tA\tC\t42\tPASS\tDP=4\tGT\t./.\t1/1
+2\t5\t.\tC\tG\t42\tPASS\tDP=4\tGT\t1/1\t0/0
+"""
+        with open(test_vcf_path,'w') as f:
+            f.write(vcf_string)
+        indexed_path = pysam.tabix_index(test_vcf_path, preset='vcf', force=True)
+        cache_dir = f'{os.path.abspath(indexed_path)}_allele_cache/'
+
+        try:
+            # The first resolver writes the cache, the second one reads it
+            for i in range(2):
+                ar = AlleleResolver(vcffile=indexed_path, use_cache=True, lazyLoad=True)
+                self.assertIsNone( ar.getAllelesAt('1',17,'A') )
+                self.assertIsNone( ar.getAllelesAt('1',19,'C') )
+                self.assertEqual( ar.getAllelesAt('1',19,'A'), set(['SAMPLE_A']) )
+                self.assertEqual( ar.getAllelesAt('1',21,'A'), set(['SAMPLE_B'] ) )
+                self.assertEqual( ar.getAllelesAt('1',39,'C'), set(['SAMPLE_B'] ) )
+                self.assertTrue( os.path.exists(f'{cache_dir}/1.npz') )
+
+            # Only the variants in the prefetched region are available
+            prefetched = ar.prefetch('1', 20, 30)
+            self.assertEqual( len(prefetched.allele_tables['1']), 2 )
+            self.assertIsNone( prefetched.getAllelesAt('1',19,'A') )
+            self.assertEqual( prefetched.getAllelesAt('1',21,'A'), set(['SAMPLE_B'] ) )
+
+            # Prefetching from a resolver which did not load the contig yet
+            prefetched = AlleleResolver(vcffile=indexed_path, use_cache=True, lazyLoad=True).prefetch('2', 0, 10)
+            self.assertEqual( prefetched.getAllelesAt('2',4,'G'), set(['SAMPLE_A'] ) )
+            self.assertIsNone( prefetched.getAllelesAt('1',21,'A') )
+        finally:
+            shutil.rmtree(cache_dir, ignore_errors=True)
+            for path in (indexed_path, indexed_path + '.tbi'):
+                os.remove(path)
+
 
 if __name__ == '__main__':
     unittest.main()
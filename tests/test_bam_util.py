@@ -5,7 +5,7 @@ import singlecellmultiomics.molecule
 import singlecellmultiomics.fragment
 import pysam
 import pysamiterators.iterators
-from singlecellmultiomics.bamProcessing import sorted_bam_file,write_program_tag,verify_and_fix_bam
+from singlecellmultiomics.bamProcessing import sorted_bam_file,write_program_tag,verify_and_fix_bam,ReorderingBamWriter,merge_sorted_bams
 from singlecellmultiomics.bamProcessing.bamExtractSamples import extract_samples
 import os
 import sys
@@ -196,6 +196,44 @@ class TestSorted(unittest.TestCase):
             pass
 
 
+    def test_reordering_writer_merge(self):
+        write_paths = ['./data/write_test_reorder_a.bam', './data/write_test_reorder_b.bam']
+        merged_path = './data/write_test_reorder_merged.bam'
+        with pysam.AlignmentFile('./data/mini_nla_test.bam') as f:
+            # A small buffer results in reads which cannot be written in order:
+            writers = [ReorderingBamWriter(path, header=f.header, buffer_size=5) for path in write_paths]
+            for i,molecule in enumerate(singlecellmultiomics.molecule.MoleculeIterator(
+                alignments=f,
+                molecule_class=singlecellmultiomics.molecule.NlaIIIMolecule,
+                fragment_class=singlecellmultiomics.fragment.NlaIIIFragment,
+                fragment_class_args={'umi_hamming_distance':0},
+                pooling_method=0,
+                yield_invalid=True
+            )):
+                molecule.write_pysam(writers[i%2])
+            for writer in writers:
+                writer.close()
+            self.assertTrue( any(writer.overflow_reads>0 for writer in writers) )
+
+            paths = [path for writer in writers for path in writer.paths]
+            for path in paths:
+                with pysam.AlignmentFile(path) as sorted_file:
+                    positions = [(read.reference_id, read.reference_start) for read in sorted_file]
+                    self.assertEqual(positions, sorted(positions))
+
+            merge_sorted_bams(paths, merged_path, header=f.header)
+
+        self.assertTrue( os.path.exists(merged_path+'.bai') )
+        self.assertFalse( any(os.path.exists(path) for path in paths) )
+        with pysam.AlignmentFile(merged_path) as f:
+            self.assertEqual(f.header.to_dict()['HD']['SO'], 'coordinate')
+            positions = [(read.reference_id, read.reference_start) for read in f]
+            self.assertEqual(positions, sorted(positions))
+            self.assertEqual(sum(1 for read in f.fetch('chr1') if read.is_read1), 293)
+
+        os.remove(merged_path)
+        os.remove(merged_path+'.bai')
+
     def  test_sample_extraction(self):
 
         output_path= './data/write_test_extract.bam'
@@ -2,6 +2,8 @@
 # -*- coding: utf-8 -*-
 import unittest
 import itertools
+import os
+import tempfile
 
 import singlecellmultiomics.barcodeFileParser.barcodeFileParser as barcodeFileParser
 
@@ -102,6 +104,37 @@ class TestBarcodeParser(unittest.TestCase):
         self.assertEqual(barcode,'AAA')
         self.assertEqual(hd,1)
 
+    def test_lazy_cached_expansion(self):
+
+        with tempfile.TemporaryDirectory() as barcode_dir:
+            with open(os.path.join(barcode_dir, 'test.bc'), 'w') as f:
+                f.write('1 AAAA\n2 CCCC\n3 GGGG\n')
+            with open(os.path.join(barcode_dir, 'other.bc'), 'w') as f:
+                f.write('TTTT\n')
+
+            b = barcodeFileParser.BarcodeParser(barcode_dir, hammingDistanceExpansion=1)
+            self.assertEqual(len(b.loaded_aliases), 0)
+            self.assertEqual(b.getIndexCorrectedBarcodeAndHammingDistance('AAAT','test'), ('1', 'AAAA', 1))
+            self.assertEqual(b.loaded_aliases, {'test'})
+            self.assertTrue(os.path.exists(b.get_cache_path('test')))
+
+            # The second parser uses the cache
+            cached = barcodeFileParser.BarcodeParser(barcode_dir, hammingDistanceExpansion=1)
+            self.assertTrue(cached.read_cached('test'))
+            self.assertEqual(cached.barcodes['test'], b.barcodes['test'])
+            self.assertEqual(cached.extendedBarcodes['test'], b.extendedBarcodes['test'])
+
+            eager = barcodeFileParser.BarcodeParser(barcode_dir, hammingDistanceExpansion=1, lazy=False, cache=False)
+            self.assertEqual(eager.loaded_aliases, {'test', 'other'})
+            self.assertEqual(eager.extendedBarcodes['test'], b.extendedBarcodes['test'])
+
+            # A changed barcode file is not loaded from the cache
+            with open(os.path.join(barcode_dir, 'test.bc'), 'a') as f:
+                f.write('4 TTTT\n')
+            changed = barcodeFileParser.BarcodeParser(barcode_dir, hammingDistanceExpansion=1)
+            self.assertFalse(changed.read_cached('test'))
+            self.assertEqual(changed.getIndexCorrectedBarcodeAndHammingDistance('TTTA','test'), ('4', 'TTTT', 1))
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,90 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+import unittest
+import gzip
+import os
+import random
+import tempfile
+from singlecellmultiomics.pyutils import BufferedHandleLimiter, ParallelGzipWriter
+
+"""
+These tests check if the buffered writer writes the same data as written to it
+"""
+
+
+class TestBufferedHandleLimiter(unittest.TestCase):
+
+    def test_write_many_files(self):
+        rng = random.Random(1)
+        with tempfile.TemporaryDirectory() as tmp:
+            paths = [os.path.join(tmp, f'cell_{i}.fastq.gz') for i in range(20)]
+            plain_path = os.path.join(tmp, 'plain.txt')
+            # Existing files are overwritten
+            with open(paths[0], 'w') as f:
+                f.write('old')
+
+            expected = {path: [] for path in paths + [plain_path]}
+            writer = BufferedHandleLimiter(maxHandles=3, buffer_size=2000, flush_size=500)
+            for i in range(2000):
+                path = rng.choice(paths)
+                record = f'@read_{i}\n{"ACGT" * rng.randint(1, 10)}\n+\n'
+                writer.write(path, record, method=1)
+                expected[path].append(record)
+                if i % 10 == 0:
+                    writer.write(plain_path, f'{i}\n', method=0)
+                    expected[plain_path].append(f'{i}\n')
+            writer.close()
+
+            for path in paths:
+                with gzip.open(path, 'rt') as f:
+                    self.assertEqual(f.read(), ''.join(expected[path]))
+            with open(plain_path) as f:
+                self.assertEqual(f.read(), ''.join(expected[plain_path]))
+
+            statistics = writer.get_statistics()
+            self.assertTrue(statistics['evictions'] > 0)
+            self.assertTrue(statistics['flushes'] < 2200)
+            self.assertEqual(statistics['files'], 21)
+            self.assertEqual(statistics['bytes_in'], sum(len(''.join(v)) for v in expected.values()))
+
+    def test_write_error(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            writer = BufferedHandleLimiter()
+            writer.write(os.path.join(tmp, 'missing', 'cell.fastq.gz'), 'data', method=1)
+            with self.assertRaises(FileNotFoundError):
+                writer.close()
+
+
+class TestParallelGzipWriter(unittest.TestCase):
+
+    def test_write_blocks(self):
+        rng = random.Random(1)
+        records = [f'@read_{i}\n{"ACGT" * rng.randint(1, 10)}\n+\n' for i in range(5000)]
+        with tempfile.TemporaryDirectory() as tmp:
+            paths = [os.path.join(tmp, f'part_{i}.fastq.gz') for i in range(2)]
+            for path, part in zip(paths, (records[:3000], records[3000:])):
+                with ParallelGzipWriter(path, threads=3, block_size=1000) as writer:
+                    for record in part:
+                        writer.write(record)
+                self.assertTrue(writer.blocks > 10)
+                with gzip.open(path, 'rt') as f:
+                    self.assertEqual(f.read(), ''.join(part))
+
+            # Files can be concatenated:
+            joined = os.path.join(tmp, 'joined.fastq.gz')
+            with open(joined, 'wb') as out:
+                for path in paths:
+                    with open(path, 'rb') as f:
+                        out.write(f.read())
+            with gzip.open(joined, 'rt') as f:
+                self.assertEqual(f.read(), ''.join(records))
+
+            # An empty file is a valid gzip file:
+            empty = os.path.join(tmp, 'empty.fastq.gz')
+            ParallelGzipWriter(empty).close()
+            with gzip.open(empty, 'rt') as f:
+                self.assertEqual(f.read(), '')
+
+
+if __name__ == '__main__':
+    unittest.main()
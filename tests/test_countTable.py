@@ -1,6 +1,9 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
 import unittest
+import os
+import numpy as np
+import pandas as pd
 from types import SimpleNamespace
 import singlecellmultiomics.bamProcessing.bamToCountTable
 
@@ -247,6 +250,65 @@ class TestCountTable(unittest.TestCase):
 
         self.assertEqual( df.sum(1).sum(), 765 )
         self.assertEqual( df.loc[:,['A3-P15-1-1_25']].sum(skipna=True).sum(skipna=True), 12.0 )
+    def test_parallel_sparse_counting(self):
+        """ Test if counting per contig into a sparse table yields the same table """
+        arguments = dict(
+                alignmentfiles=['./data/mini_nla_test.bam'],
+                o=None,
+                head=None,
+                bin=100,
+                sliding=25,
+                binTag='DS',
+                byValue=None,
+                bedfile=None,
+                showtags=False,
+                featureTags=None,
+                joinedFeatureTags='reference_name',
+                sampleTags='SM',
+                minMQ=0,
+                filterXA=False,
+                dedup=False,
+                divideMultimapping=False,
+                contig=None,
+                blacklist=None,
+                filterMP=False,
+                keepOverBounds=False,
+                doNotDivideFragments=False,
+                splitFeatures=False,
+                feature_delimiter=',',
+                 noNames=False)
+
+        df = singlecellmultiomics.bamProcessing.bamToCountTable.create_count_table(
+            SimpleNamespace(**arguments), return_df=True)
+        df_parallel = singlecellmultiomics.bamProcessing.bamToCountTable.create_count_table(
+            SimpleNamespace(**arguments, t=2), return_df=True)
+        self.assertTrue( df.sort_index().sort_index(axis=1).equals(
+            df_parallel.sort_index().sort_index(axis=1)) )
+
+        path = './data/sparse_count_table_test.npz'
+        singlecellmultiomics.bamProcessing.bamToCountTable.create_count_table(
+            SimpleNamespace(**dict(arguments, o=path), t=2))
+        matrix, samples, features = singlecellmultiomics.bamProcessing.bamToCountTable.read_sparse_count_table(path)
+        os.remove(path)
+        self.assertEqual( list(features.names), ['reference_name', 'start', 'end'] )
+        sparse_df = pd.DataFrame(matrix.toarray().T, index=features, columns=samples)
+        self.assertTrue( np.allclose(
+            df.fillna(0).loc[sparse_df.index, sparse_df.columns].values, sparse_df.values) )
+
+    def test_sparse_count_table_merge(self):
+        """ Test if observations are summed when the sparse count table is compacted and merged """
+        SparseCountTable = singlecellmultiomics.bamProcessing.bamToCountTable.SparseCountTable
+        a = SparseCountTable(compact_size=2)
+        b = SparseCountTable()
+        for table, sample, feature, value in [
+                (a, 'cell1', 'f1', 1), (a, 'cell1', 'f1', 1), (a, 'cell2', 'f2', 0.5),
+                (b, 'cell3', 'f2', 1), (b, 'cell2', 'f2', 0.5), (b, 'cell1', 'f3', 2)]:
+            table[sample][feature] += value
+        a.merge(b)
+        self.assertEqual( a.to_dict(), {'cell1': {'f1': 2, 'f3': 2},
+                                        'cell2': {'f2': 1},
+                                        'cell3': {'f2': 1}} )
+        self.assertEqual( a.to_matrix().shape, (3, 3) )
 
 if __name__ == '__main__':
     unittest.main()
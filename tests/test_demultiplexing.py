@@ -5,8 +5,17 @@ from singlecellmultiomics.fastqProcessing.fastqIterator import FastqRecord
 from singlecellmultiomics.barcodeFileParser.barcodeFileParser import BarcodeParser
 from singlecellmultiomics.modularDemultiplexer.demultiplexModules.CELSeq2 import CELSeq2_c8_u6_NH
 from singlecellmultiomics.modularDemultiplexer.demultiplexModules.scCHIC import SCCHIC_384w_c8_u3_cs2
-from singlecellmultiomics.modularDemultiplexer.baseDemultiplexMethods import UmiBarcodeDemuxMethod
+from singlecellmultiomics.modularDemultiplexer.baseDemultiplexMethods import UmiBarcodeDemuxMethod, NonMultiplexable, phredToFastqHeaderSafeQualities
+from singlecellmultiomics.modularDemultiplexer.demultiplexingStrategyLoader import DemultiplexingStrategyLoader
+from singlecellmultiomics.fastqProcessing.fastqHandle import FastqHandle, UnalignedBamHandle
+from singlecellmultiomics.universalBamTagger.universalBamTagger import QueryNameFlagger
+import pysam
 import pkg_resources
+import gzip
+import io
+import os
+import random
+import tempfile
 
 class TestUmiBarcodeDemux(unittest.TestCase):
 
@@ -177,5 +186,175 @@ class TestUmiBarcodeDemux(unittest.TestCase):
         self.assertEqual( demultiplexed_record[0].tags['bi'], 0)
 
 
+def write_test_library(paths, n, barcode_folder, seed=0):
+    """Write a paired NLAIII384C8U3 library, every fifth read pair has an invalid barcode"""
+    with open(os.path.join(barcode_folder, 'maya_384NLA.bc')) as f:
+        barcodes = [line.strip() for line in f][:16]
+    rng = random.Random(seed)
+    seq = lambda n: ''.join(rng.choice('ACGT') for _ in range(n))
+    with gzip.open(paths[0], 'wt') as r1, gzip.open(paths[1], 'wt') as r2:
+        for i in range(n):
+            barcode = rng.choice(barcodes) if i % 5 else seq(8)
+            r1.write(f'@NS500414:628:H7YVNBGXC:1:11101:{i}:1046 1:N:0:GTGAAA\n{seq(3)}{barcode}CATG{seq(40)}\n+\n{"E"*55}\n')
+            r2.write(f'@NS500414:628:H7YVNBGXC:1:11101:{i}:1046 2:N:0:GTGAAA\n{seq(50)}\n+\n{"E"*50}\n')
+
+
+class ListHandle():
+    # Collects the records written by the demultiplexer
+    def __init__(self):
+        self.written = []
+
+    def write(self, records):
+        self.written.append([str(record) for record in records])
+
+
+class TestParallelDemultiplexing(unittest.TestCase):
+
+    def test_parallel_demultiplexing(self):
+        barcode_folder = pkg_resources.resource_filename('singlecellmultiomics','modularDemultiplexer/barcodes/')
+        index_folder = pkg_resources.resource_filename('singlecellmultiomics','modularDemultiplexer/indices/')
+        dmx = DemultiplexingStrategyLoader(
+            barcodeParser=BarcodeParser(barcode_folder),
+            indexParser=BarcodeParser(index_folder))
+        strategies = dmx.getSelectedStrategiesFromStringList(['NLAIII384C8U3', 'CS2C8U6'], verbose=False)
+
+        with tempfile.TemporaryDirectory() as tmp:
+            paths = [os.path.join(tmp, f'test_R{i}.fastq.gz') for i in (1, 2)]
+            write_test_library(paths, 250, barcode_folder)
+
+            results = []
+            for n_processes in (1, 3):
+                target, rejects, log = ListHandle(), ListHandle(), io.StringIO()
+                processed, yields = dmx.demultiplex(
+                    paths, strategies=strategies, library='test',
+                    targetFile=target, rejectHandle=rejects, log_handle=log,
+                    maxReadPairs=230, n_processes=n_processes, chunk_size=17)
+                results.append((processed, yields, target.written, rejects.written, log.getvalue()))
+
+        serial, parallel = results
+        self.assertEqual(serial[0], 230)
+        self.assertEqual(sum(serial[1].values()), len(serial[2]))
+        self.assertTrue(len(serial[2]) > 0 and len(serial[3]) > 0)
+        self.assertEqual(serial, parallel)
+
+    def test_sequential_library_detection(self):
+        barcode_folder = pkg_resources.resource_filename('singlecellmultiomics','modularDemultiplexer/barcodes/')
+        index_folder = pkg_resources.resource_filename('singlecellmultiomics','modularDemultiplexer/indices/')
+        dmx = DemultiplexingStrategyLoader(
+            barcodeParser=BarcodeParser(barcode_folder),
+            indexParser=BarcodeParser(index_folder))
+
+        with tempfile.TemporaryDirectory() as tmp:
+            libraries = {}
+            for lib in ('libA', 'libB'):
+                paths = [os.path.join(tmp, f'{lib}_R{i}.fastq.gz') for i in (1, 2)]
+                write_test_library(paths, 1000, barcode_folder, seed=len(libraries))
+                libraries[lib] = {'L001': {'R1': [paths[0]], 'R2': [paths[1]]}}
+
+            _, exhaustive = dmx.detectLibYields(libraries, testReads=1000, minAutoDetectPct=5)
+            _, sequential = dmx.detectLibYields(
+                libraries, testReads=1000, minAutoDetectPct=5, sequential=True, round_size=50)
+            _, parallel = dmx.detectLibYields(
+                libraries, testReads=1000, minAutoDetectPct=5, sequential=True, round_size=50, n_processes=2)
+
+        for lib in libraries:
+            self.assertEqual(exhaustive[lib]['processedReadPairs'], 1000)
+            self.assertTrue(sequential[lib]['processedReadPairs'] < 1000)
+            for result in (exhaustive, sequential):
+                self.assertEqual(
+                    dmx.selectedStrategiesBasedOnYield(result[lib]['processedReadPairs'], result[lib]['strategyYields'], minAutoDetectPct=5),
+                    ['NLAIII384C8U3'])
+            lower, upper = sequential[lib]['confidenceIntervals']['NLAIII384C8U3']
+            self.assertTrue(lower <= 80 <= upper)
+            self.assertEqual(sequential[lib], parallel[lib])
+
+
+class TestDemultiplexingShortcuts(unittest.TestCase):
+
+    def test_rejection_reason_order(self):
+        barcode_folder = pkg_resources.resource_filename('singlecellmultiomics','modularDemultiplexer/barcodes/')
+        index_folder = pkg_resources.resource_filename('singlecellmultiomics','modularDemultiplexer/indices/')
+        dmx = DemultiplexingStrategyLoader(
+            barcodeParser=BarcodeParser(barcode_folder),
+            indexParser=BarcodeParser(index_folder),
+            indexFileAlias='illumina_merged_ThruPlex48S_RP')
+        nla, = dmx.getSelectedStrategiesFromStringList(['NLAIII384C8U3'], verbose=False)
+
+        def get_reads(barcode, index):
+            return [FastqRecord(f'@NS500414:628:H7YVNBGXC:1:11101:15963:1046 {mate}:N:0:{index}', sequence, '+', 'E' * len(sequence))
+                    for mate, sequence in ((1, f'ATC{barcode}CATGAAAAAAAAAA'), (2, 'ACGTACGTACGTACGT'))]
+
+        self.assertEqual(nla.demultiplex(get_reads('ACACACTA', 'GTGAAA'))[0].tags['bi'], 0)
+        # Both the barcode and the index are invalid, the index is reported
+        for barcode in ('ACACACTA', 'TTTTTTTT'):
+            with self.assertRaisesRegex(NonMultiplexable, 'Could not obtain index'):
+                nla.demultiplex(get_reads(barcode, 'AAAAAA'))
+        with self.assertRaisesRegex(NonMultiplexable, 'bc:TTTTTTTT_not_matching'):
+            nla.demultiplex(get_reads('TTTTTTTT', 'GTGAAA'))
+
+    def test_header_safe_qualities(self):
+        qualities = ''.join(chr(i) for i in range(20, 33 + 52))
+        self.assertEqual(
+            phredToFastqHeaderSafeQualities(qualities),
+            ''.join('abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ'[max(0, ord(q) - 33)] for q in qualities))
+        with self.assertRaises(IndexError):
+            phredToFastqHeaderSafeQualities('AAA~')
+
+
+class TestOutputFormats(unittest.TestCase):
+
+    def test_unaligned_bam_and_tag_comments(self):
+        barcode_folder = pkg_resources.resource_filename('singlecellmultiomics','modularDemultiplexer/barcodes/')
+        index_folder = pkg_resources.resource_filename('singlecellmultiomics','modularDemultiplexer/indices/')
+        dmx = DemultiplexingStrategyLoader(
+            barcodeParser=BarcodeParser(barcode_folder),
+            indexParser=BarcodeParser(index_folder))
+        strategies = dmx.getSelectedStrategiesFromStringList(['NLAIII384C8U3'], verbose=False)
+
+        with tempfile.TemporaryDirectory() as tmp:
+            paths = [os.path.join(tmp, f'test_R{i}.fastq.gz') for i in (1, 2)]
+            write_test_library(paths, 100, barcode_folder)
+
+            bam_reads = []
+            for n_processes in (1, 2):
+                handle = UnalignedBamHandle(os.path.join(tmp, f'dmx_{n_processes}'), True)
+                dmx.demultiplex(paths, strategies=strategies, library='test',
+                                targetFile=handle, n_processes=n_processes, chunk_size=7)
+                handle.close()
+                with pysam.AlignmentFile(os.path.join(tmp, f'dmx_{n_processes}.bam'), check_sq=False) as f:
+                    bam_reads.append([read.to_string() for read in f])
+            self.assertEqual(len(bam_reads[0]), 160)
+            self.assertEqual(bam_reads[0], bam_reads[1])
+
+            handle = FastqHandle(os.path.join(tmp, 'dmx_tags_'), True, tag_comments=True)
+            target = ListHandle()
+            dmx.demultiplex(paths, strategies=strategies, library='test', targetFile=handle)
+            handle.close()
+            dmx.demultiplex(paths, strategies=strategies, library='test', targetFile=target)
+            with gzip.open(os.path.join(tmp, 'dmx_tags_R1.fastq.gz'), 'rt') as f:
+                comment_headers = f.read().split('\n')[0::4][:-1]
+
+        header = pysam.AlignmentHeader.from_dict({'HD': {'VN': '1.6'}})
+        flagger = QueryNameFlagger()
+        bam_r1 = bam_reads[0][0::2]
+        self.assertEqual(len(comment_headers), len(bam_r1))
+        for (r1, _), bam_read, comment_header in zip(target.written, bam_r1, comment_headers):
+            # Tag a read with the tags stored in the read name:
+            read = pysam.AlignedSegment(header)
+            read.query_name = r1.split('\n')[0][1:]
+            flagger.digest([read])
+            bam_read = pysam.AlignedSegment.fromstring(bam_read, header)
+            self.assertEqual(read.query_name, bam_read.query_name)
+            expected = sorted(tag for tag in read.get_tags() if tag[0] != 'RG')
+            self.assertEqual(sorted(bam_read.get_tags()), expected)
+
+            name, comment = comment_header[1:].split('\t', 1)
+            self.assertEqual(name, bam_read.query_name)
+            tags = [sam_tag.split(':', 2) for sam_tag in comment.split('\t')]
+            self.assertEqual(
+                sorted((tag, int(value) if tag_type == 'i' else value) for tag, tag_type, value in tags),
+                expected)
+
+
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,83 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+import unittest
+import gzip
+import os
+import tempfile
+from singlecellmultiomics.fastqProcessing.fastqIterator import FastqIterator, FastqRecord
+
+"""
+These tests check if the block based FastqIterator splits the records correctly
+"""
+
+
+def get_records(n, mate):
+    return [FastqRecord(f'@read:{i} {mate}:N:0:GTGAAA', 'ACGT' * (i % 7 + 1), '+', 'E' * 4 * (i % 7 + 1))
+            for i in range(n)]
+
+
+def write_fastq(path, records, newline='\n', final_newline=True):
+    text = newline.join(newline.join(record) for record in records)
+    if final_newline:
+        text += newline
+    with (gzip.open(path, 'wt', newline='') if path.endswith('.gz') else open(path, 'w', newline='')) as f:
+        f.write(text)
+
+
+class TestFastqIterator(unittest.TestCase):
+
+    def test_block_boundaries(self):
+        r1, r2 = get_records(101, 1), get_records(101, 2)
+        with tempfile.TemporaryDirectory() as tmp:
+            paths = [os.path.join(tmp, 'R1.fastq.gz'), os.path.join(tmp, 'R2.fastq')]
+            write_fastq(paths[0], r1)
+            write_fastq(paths[1], r2, final_newline=False)
+            for block_size in (1, 7, 64, 1_000_000):
+                for threaded in (True, False):
+                    pairs = list(FastqIterator(*paths, block_size=block_size, threaded=threaded))
+                    self.assertEqual(pairs, list(zip(r1, r2)))
+
+            batches = list(FastqIterator(*paths, block_size=100).iter_batches())
+            self.assertTrue(len(batches) > 1)
+            self.assertEqual(sum(batches, []), list(zip(r1, r2)))
+
+    def test_crlf(self):
+        records = get_records(10, 1)
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, 'R1.fastq')
+            write_fastq(path, records, newline='\r\n')
+            self.assertEqual([r for r, in FastqIterator(path, block_size=9)], records)
+
+    def test_different_record_amounts(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            paths = [os.path.join(tmp, 'R1.fastq'), os.path.join(tmp, 'R2.fastq')]
+            write_fastq(paths[0], get_records(10, 1))
+            write_fastq(paths[1], get_records(9, 2))
+            with self.assertRaises(ValueError):
+                list(FastqIterator(*paths))
+
+    def test_truncated(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, 'R1.fastq.gz')
+            write_fastq(path, get_records(100, 1))
+            with open(path, 'rb') as f:
+                data = f.read()
+            with open(path, 'wb') as f:
+                f.write(data[:len(data) // 2])
+            for threaded in (True, False):
+                with self.assertRaises(EOFError):
+                    list(FastqIterator(path, threaded=threaded))
+
+            path = os.path.join(tmp, 'R1.fastq')
+            # The last record lacks the plus and quality line
+            write_fastq(path, get_records(3, 1))
+            with open(path) as f:
+                lines = f.read().split('\n')
+            with open(path, 'w') as f:
+                f.write('\n'.join(lines[:-3]))
+            with self.assertRaises(ValueError):
+                list(FastqIterator(path))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -2,8 +2,10 @@
 # -*- coding: utf-8 -*-
 import unittest
 import itertools
+import os
+from shutil import rmtree
 
-from singlecellmultiomics.features import FeatureContainer
+from singlecellmultiomics.features import FeatureContainer, FeatureIndex, compile_GTF_index
 
 """
 These tests check if the feature container is working correctly
@@ -162,6 +164,56 @@ class TestFeatureContainer(unittest.TestCase):
         #printFormatted("[BRIGHT]Test for finding closest feature")
         self.expect(  f.findNearestFeature('chr1', 0, None ), '1')
 
+class TestFeatureIndex(unittest.TestCase):
+
+    gtf_path = './data/test_feature_index.gtf'
+    index_path = './data/test_feature_index.index'
+
+    def setUp(self):
+        with open(self.gtf_path,'w') as o:
+            o.write('#comment\n')
+            for i, (contig, start, end, strand) in enumerate([
+                    ('chr1', 100, 200, '+'),
+                    ('chr1', 150, 5000, '-'),
+                    ('chr1', 1000, 1100, '+'),
+                    ('chr1', 6000, 6100, '+'),
+                    ('chr2', 10, 20, '-')]):
+                o.write(f'{contig}\ttest\texon\t{start}\t{end}\t.\t{strand}\t.\tgene_id "G{i%2}"; exon_id "E{i}";\n')
+            o.write(f'chr1\ttest\tgene\t100\t5000\t.\t+\t.\tgene_id "G0";\n')
+
+    def tearDown(self):
+        os.remove(self.gtf_path)
+        if os.path.exists(self.index_path):
+            rmtree(self.index_path)
+
+    def test_index_matches_gtf(self):
+        kwargs = {'select_feature_type':['exon'], 'identifierFields':('exon_id','gene_id'), 'store_all':True}
+
+        gtf_features = FeatureContainer()
+        gtf_features.preload_GTF(self.gtf_path, **kwargs)
+        index_features = FeatureContainer()
+        index_features.preload_GTF(self.gtf_path, index_path=self.index_path, **kwargs)
+
+        for contig, start, end in [('chr1', 0, 10_000), ('chr1', 1050, 1060), ('chr1', 5500, 5999), ('chr2', 0, 15), ('chr3', 0, 100)]:
+            a = gtf_features.prefetch(contig, start, end)
+            b = index_features.prefetch(contig, start, end)
+            self.assertEqual(a.features, b.features)
+            self.assertEqual(a.findFeaturesAt(contig, start), b.findFeaturesAt(contig, start))
+
+        self.assertEqual( len(index_features.prefetch('chr1', 1050, 1060)), 2)
+        self.assertEqual( FeatureIndex.open(self.index_path).contigs, ['chr1','chr2'] )
+
+    def test_index_is_reused(self):
+        compile_GTF_index(self.gtf_path, self.index_path, select_feature_type=['exon'])
+        modified = os.path.getmtime(f'{self.index_path}/meta.pickle')
+        compile_GTF_index(self.gtf_path, self.index_path, select_feature_type=['exon'], contig='chr1')
+        self.assertEqual(modified, os.path.getmtime(f'{self.index_path}/meta.pickle'))
+
+        # Different arguments result in a new index:
+        compile_GTF_index(self.gtf_path, self.index_path, select_feature_type=['gene'])
+        self.assertEqual( list(FeatureIndex.open(self.index_path).fetch('chr1', 4000, 4000)),
+            [(99, 4999, 'G0', '+', 'type:gene,gene_id:G0')] )
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -54,6 +54,33 @@ class TestFragment(unittest.TestCase):
                 if frag.is_mapped:
                     self.assertIn( frag.get_strand(), [0,1])
 
+    def test_shared_settings(self):
+        """Test if the fragments of a molecule iterator share their settings"""
+        for fragment_class in (singlecellmultiomics.fragment.NlaIIIFragment,
+                               singlecellmultiomics.fragment.CHICFragment):
+            with pysam.AlignmentFile('./data/mini_nla_test.bam') as f:
+                fragments = [fragment
+                             for molecule in singlecellmultiomics.molecule.MoleculeIterator(
+                                 f, fragment_class=fragment_class,
+                                 fragment_class_args={'umi_hamming_distance': 0, 'max_fragment_size': 500},
+                                 yield_invalid=True)
+                             for fragment in molecule]
+            self.assertTrue(len(fragments) > 100)
+            self.assertEqual(len({id(fragment.settings) for fragment in fragments}), 1)
+            for fragment in fragments:
+                self.assertFalse(hasattr(fragment, '__dict__'))
+                self.assertEqual(fragment.umi_hamming_distance, 0)
+                self.assertEqual(fragment.max_fragment_size, 500)
+                self.assertEqual(fragment.assignment_radius, 1_000)
+                self.assertEqual(fragment.invert_strand, fragment_class is singlecellmultiomics.fragment.CHICFragment)
+
+            # Fragments created with the shared settings equal fragments created with their own settings
+            R1, R2 = fragments[0].reads
+            fragment = fragment_class([R1, R2], umi_hamming_distance=0, max_fragment_size=500)
+            self.assertIsNot(fragment.settings, fragments[0].settings)
+            self.assertEqual(repr(fragment), repr(fragments[0]))
+            self.assertEqual(fragment.match_hash, fragments[0].match_hash)
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -14,6 +14,22 @@ from singlecellmultiomics.fragment import CHICFragment
 These tests check if the Molecule module is working correctly
 """
 
+try:
+    from singlecellmultiomics.bamProcessing.structureTensor import SingleEndTranscriptTensorable
+except ImportError:
+    # structureTensor requires imageio and matplotlib
+    SingleEndTranscriptTensorable = None
+
+
+class SpanOnlyFragment(singlecellmultiomics.fragment.Fragment):
+    # Overrides __eq__ like SingleEndTranscriptTensorable: the UMI, sample and strand are not compared
+    def umi_eq(self, umi):
+        return True
+
+    def __eq__(self, other):
+        return min(abs(self.span[1] - other.span[1]), abs(self.span[2] - other.span[2])) <= self.assignment_radius
+
+
 class TestMolecule(unittest.TestCase):
 
     def test_chic_cigar_dedup(self):
@@ -154,6 +170,9 @@ class TestMolecule(unittest.TestCase):
             # Test tags:
             a = molecules[0]
             a.write_tags()
+            # The tags are written to the reads when the molecule is written or flushed
+            self.assertFalse(a[0][0].has_tag('TF'))
+            a.flush_tags()
             self.assertEqual(a[0][0].get_tag('TF') , 2)
 
         os.remove('test.sam')
@@ -336,6 +355,161 @@ class TestMolecule(unittest.TestCase):
     def test_molecule_pooling_nlaIIIoptim_umi_mismatch(self):
         self._pool_test(1,1)
 
+    def test_molecule_pooling_indexed_exact_umi(self):
+        self._pool_test(2,0)
+
+    def test_molecule_pooling_indexed_umi_mismatch(self):
+        self._pool_test(2,1)
+
+    def _get_molecule_read_names(self, pooling_method, fragment_class, **kwargs):
+        with pysam.AlignmentFile('./data/mini_nla_test.bam') as f:
+            return [
+                tuple(read.query_name for read in molecule.iter_reads())
+                for molecule in singlecellmultiomics.molecule.MoleculeIterator(
+                    alignments=f,
+                    molecule_class=singlecellmultiomics.molecule.Molecule,
+                    fragment_class=fragment_class,
+                    pooling_method=pooling_method,
+                    **kwargs)
+            ]
+
+    def test_molecule_pooling_indexed_equals_hash_pooling(self):
+        for fragment_class, kwargs in [
+                (singlecellmultiomics.fragment.Fragment, {}),
+                (singlecellmultiomics.fragment.Fragment, {'check_eject_every':10}),
+                (singlecellmultiomics.fragment.Fragment, {'fragment_class_args':{'umi_hamming_distance':0, 'assignment_radius':200}}),
+                (singlecellmultiomics.fragment.NlaIIIFragment, {}),
+                (singlecellmultiomics.fragment.FragmentWithoutUMI, {}) ]:
+            self.assertEqual(
+                self._get_molecule_read_names(1, fragment_class, **kwargs),
+                self._get_molecule_read_names(2, fragment_class, **kwargs))
+
+    def test_molecule_pooling_indexed_unknown_eq(self):
+        """Fragment classes overriding __eq__ without declaring the index criteria are pooled using a linear scan"""
+        from singlecellmultiomics.molecule.index import MoleculeIndex
+        self.assertFalse(MoleculeIndex.supports(SpanOnlyFragment))
+        for fragment_class in (singlecellmultiomics.fragment.Fragment, singlecellmultiomics.fragment.NlaIIIFragment,
+                               singlecellmultiomics.fragment.CHICFragment, singlecellmultiomics.fragment.FragmentWithoutUMI):
+            self.assertTrue(MoleculeIndex.supports(fragment_class))
+
+        fragment_classes = [SpanOnlyFragment]
+        if SingleEndTranscriptTensorable is not None:
+            fragment_classes.append(SingleEndTranscriptTensorable)
+        for fragment_class in fragment_classes:
+            self.assertEqual(
+                self._get_molecule_read_names(1, fragment_class),
+                self._get_molecule_read_names(2, fragment_class))
+
+    def test_molecule_ejection(self):
+        """Molecules should be ejected while iterating, without changing the result"""
+        for pooling_method in (0, 1, 2):
+            eager = self._get_molecule_read_names(pooling_method,
+                singlecellmultiomics.fragment.NlaIIIFragment, check_eject_every=1)
+            buffered = self._get_molecule_read_names(pooling_method,
+                singlecellmultiomics.fragment.NlaIIIFragment, check_eject_every=None)
+            self.assertEqual(sorted(eager), sorted(buffered))
+
+        max_buffered = 0
+        with pysam.AlignmentFile('./data/mini_nla_test.bam') as f:
+            it = singlecellmultiomics.molecule.MoleculeIterator(
+                alignments=f,
+                molecule_class=singlecellmultiomics.molecule.NlaIIIMolecule,
+                fragment_class=singlecellmultiomics.fragment.NlaIIIFragment,
+                molecule_class_args={'cache_size':100})
+            for i, molecule in enumerate(it):
+                max_buffered = max(max_buffered, it.get_molecule_cache_size())
+        self.assertTrue(max_buffered < i)
+
+    def test_spill_to_disk(self):
+        """Molecules written to disk when max_buffer_size is exceeded should be identical to molecules kept in memory"""
+        def get_molecules(pooling_method, fragment_class_args, **kwargs):
+            with pysam.AlignmentFile('./data/mini_nla_test.bam') as f:
+                it = singlecellmultiomics.molecule.MoleculeIterator(
+                    alignments=f,
+                    molecule_class=singlecellmultiomics.molecule.NlaIIIMolecule,
+                    fragment_class=singlecellmultiomics.fragment.NlaIIIFragment,
+                    fragment_class_args=fragment_class_args,
+                    pooling_method=pooling_method,
+                    **kwargs)
+                molecules = []
+                max_spilled = 0
+                for molecule in it:
+                    molecules.append((repr(molecule), tuple(read.query_name for read in molecule.iter_reads())))
+                    max_spilled = max(max_spilled, it.spilled_fragments)
+                return molecules, max_spilled
+
+        for pooling_method in (1, 2):
+            for fragment_class_args, kwargs in (
+                    ({}, {}),
+                    ({'umi_hamming_distance': 1}, {}),
+                    # Spilled molecules are yielded without being merged back:
+                    ({}, {'check_eject_every': 1, 'molecule_class_args': {'cache_size': 100}})):
+                in_memory, _ = get_molecules(pooling_method, fragment_class_args, **kwargs)
+                spilled, max_spilled = get_molecules(pooling_method, fragment_class_args, max_buffer_size=4, **kwargs)
+                self.assertTrue(max_spilled > 0)
+                self.assertEqual(in_memory, spilled)
+
+        with self.assertRaises(MemoryError):
+            get_molecules(1, {}, max_buffer_size=4, spill_to_disk=False)
+
+    def test_spill_single_group(self):
+        """A group of molecules receiving fragments can not be spilled, spilling should not be retried for every fragment"""
+        spill_calls = []
+        class CountingMoleculeIterator(singlecellmultiomics.molecule.MoleculeIterator):
+            def _spill(self, keep_hash_group):
+                spill_calls.append(self.waiting_fragments)
+                super()._spill(keep_hash_group)
+
+        results = []
+        for max_buffer_size in (None, 4):
+            with pysam.AlignmentFile('./data/mini_nla_test.bam') as f:
+                # The match_hash of all Fragments is None, all molecules are in a single group
+                results.append([repr(molecule) for molecule in CountingMoleculeIterator(
+                    f, fragment_class=singlecellmultiomics.fragment.Fragment, max_buffer_size=max_buffer_size)])
+        self.assertEqual(results[0], results[1])
+        # Spilling is retried when the amount of waiting fragments has doubled:
+        self.assertTrue(0 < len(spill_calls) < 10)
+        self.assertTrue(all(b >= 2 * a for a, b in zip(spill_calls, spill_calls[1:])))
+
+    def test_parallel_molecule_iterator(self):
+        """The ParallelMoleculeIterator should yield the same molecules as the MoleculeIterator in a deterministic order"""
+        kwargs = {'molecule_class': singlecellmultiomics.molecule.NlaIIIMolecule,
+                  'fragment_class': singlecellmultiomics.fragment.NlaIIIFragment}
+        get_key = lambda molecule: (molecule.get_cut_site(), tuple(sorted(
+            (read.query_name, read.is_read1) for read in molecule.iter_reads())))
+
+        with pysam.AlignmentFile('./data/mini_nla_test.bam') as f:
+            serial = [get_key(molecule) for molecule in singlecellmultiomics.molecule.MoleculeIterator(f, **kwargs)]
+
+        # Use small bins to obtain molecules located close to bin borders:
+        it = singlecellmultiomics.molecule.ParallelMoleculeIterator(
+            './data/mini_nla_test.bam', contig='chr1', start=164_834_000, end=164_836_000,
+            bin_size=200, n_processes=2, molecule_summary_function=None, **kwargs)
+        self.assertTrue(len(it.get_regions()) > 5)
+        parallel = [(get_key(molecule), len(molecule)) for molecule in it]
+        self.assertEqual(sorted(serial), sorted(key for key, _ in parallel))
+        self.assertEqual(parallel, [(get_key(molecule), len(molecule)) for molecule in it])
+
+        # Only the output of molecule_summary_function is sent back by the workers:
+        summaries = list(singlecellmultiomics.molecule.ParallelMoleculeIterator(
+            './data/mini_nla_test.bam', contig='chr1', start=164_834_000, end=164_836_000,
+            bin_size=200, n_processes=1, molecule_summary_function=len, **kwargs))
+        self.assertEqual(summaries, [size for _, size in parallel])
+
+        # By default a MoleculeSummary is yielded for every molecule:
+        with pysam.AlignmentFile('./data/mini_nla_test.bam') as f:
+            serial_summaries = [singlecellmultiomics.molecule.get_molecule_summary(molecule)
+                                for molecule in singlecellmultiomics.molecule.MoleculeIterator(f, **kwargs)]
+        it = singlecellmultiomics.molecule.ParallelMoleculeIterator(
+            './data/mini_nla_test.bam', max_bins_in_flight=2, n_processes=2, **kwargs)
+        parallel_summaries = list(it)
+        self.assertEqual(sorted(serial_summaries), sorted(parallel_summaries))
+
+        # Stopping the iteration early should not block:
+        for i, _ in enumerate(it):
+            if i == 2:
+                break
+
     def test_max_associated_fragments(self):
 
         for i in range(1,3):
@@ -424,6 +598,38 @@ class TestMolecule(unittest.TestCase):
         for sample, truth in hand_curated_truth.items():
             self.assertEqual( obtained_rt_count.get(sample,0),truth.get('rt_count',-1) )
 
+    def test_rt_reaction_cache(self):
+        with pysam.AlignmentFile('./data/mini_nla_test.bam') as f:
+            molecules = list(singlecellmultiomics.molecule.MoleculeIterator(
+                alignments=f,
+                molecule_class=singlecellmultiomics.molecule.NlaIIIMolecule,
+                fragment_class=singlecellmultiomics.fragment.NlaIIIFragment))
+            molecule = max(molecules, key=len)
+            self.assertTrue(len(molecule) > 1)
+
+            for max_N_distance in (0, 1):
+                rt_reactions = molecule.get_rt_reactions(max_N_distance=max_N_distance)
+                self.assertEqual(
+                    dict(rt_reactions),
+                    dict(singlecellmultiomics.molecule.molecule_to_random_primer_dict(molecule, max_N_distance=max_N_distance)))
+            self.assertEqual(molecule.get_cache_statistics(),
+                             {'rt_reaction_cache_hits': 0, 'rt_reaction_cache_misses': 2})
+
+            molecule.write_tags()
+            molecule.get_rt_reaction_fragment_sizes()
+            self.assertEqual(molecule.get_cache_statistics(),
+                             {'rt_reaction_cache_hits': 2, 'rt_reaction_cache_misses': 2})
+
+            # Adding a fragment clears the stored RT reactions
+            fragments = molecule.fragments
+            rebuilt = singlecellmultiomics.molecule.NlaIIIMolecule(fragments[0])
+            rt_reactions = rebuilt.get_rt_reactions()
+            self.assertEqual(sum(len(frags) for frags in rt_reactions.values()), 1)
+            for fragment in fragments[1:]:
+                rebuilt._add_fragment(fragment)
+            self.assertEqual(dict(rebuilt.get_rt_reactions()), dict(molecule.get_rt_reactions()))
+            self.assertEqual(rebuilt.get_cache_statistics()['rt_reaction_cache_misses'], 2)
+
 
     def test_feature_molecule(self):
         import singlecellmultiomics.features
@@ -447,6 +653,66 @@ class TestMolecule(unittest.TestCase):
                 hit_count+=1
         self.assertEqual(hit_count,2)
 
+    def test_base_calling_feature_matrix(self):
+        # The checksums were obtained using the per-base implementation of the feature matrix
+        import hashlib
+        with pysam.AlignmentFile('./data/mini_nla_test.bam') as f:
+            molecules = list(singlecellmultiomics.molecule.MoleculeIterator(
+                alignments=f,
+                molecule_class=singlecellmultiomics.molecule.NlaIIIMolecule,
+                fragment_class=singlecellmultiomics.fragment.NlaIIIFragment))
+
+        for feature_matrix_args, checksum in [
+                ({}, 'a1c8dfd0d8a7932b18c4b39788e40fb659e4e783'),
+                ({'NUC_RADIUS':0, 'USE_RT':False}, '0b9f2dfcdf87b14b06275efaf007f57078aac6fc')]:
+            h = hashlib.sha1()
+            for molecule in molecules:
+                X, ref_info = molecule.get_base_calling_feature_matrix(return_ref_info=True, **feature_matrix_args)
+                h.update(X.tobytes())
+                h.update(repr(ref_info).encode())
+            self.assertEqual(h.hexdigest(), checksum)
+
+    def test_batched_consensus(self):
+        from singlecellmultiomics.molecule.consensus import calculate_consensus, BatchedConsensusWriter
+
+        def get_molecules():
+            return singlecellmultiomics.molecule.MoleculeIterator(
+                alignments=pysam.AlignmentFile('./data/mini_nla_test.bam'),
+                molecule_class=singlecellmultiomics.molecule.NlaIIIMolecule,
+                fragment_class=singlecellmultiomics.fragment.NlaIIIFragment)
+
+        classifier = singlecellmultiomics.molecule.train_consensus_model(
+            get_molecules(), n_train=2000, skip_already_covered_bases=False, NUC_RADIUS=1)
+
+        written = {}
+        for batch_size in (1, 7):
+            write_path = f'./data/consensus_batch_test_{batch_size}.bam'
+            with pysam.AlignmentFile('./data/mini_nla_test.bam') as f, \
+                 pysam.AlignmentFile(write_path, 'wb', header=f.header) as out:
+                with BatchedConsensusWriter(classifier, out, batch_size=batch_size, consensus_k_rad=1) as writer:
+                    for i, molecule in enumerate(get_molecules()):
+                        molecule.write_tags()
+                        writer.add(molecule, i)
+            with pysam.AlignmentFile(write_path) as f:
+                written[batch_size] = [read.to_string() for read in f]
+            os.remove(write_path)
+
+        # Compare to the consensus calculated for every molecule separately
+        write_path = './data/consensus_batch_test.bam'
+        with pysam.AlignmentFile('./data/mini_nla_test.bam') as f, \
+             pysam.AlignmentFile(write_path, 'wb', header=f.header) as out:
+            for i, molecule in enumerate(get_molecules()):
+                molecule.write_tags()
+                calculate_consensus(molecule, classifier, i, out, consensus_k_rad=1)
+                molecule.write_pysam(out)
+        with pysam.AlignmentFile(write_path) as f:
+            expected = [read.to_string() for read in f]
+        os.remove(write_path)
+
+        self.assertTrue( any(read.startswith('c_') for read in expected) )
+        self.assertEqual(written[1], expected)
+        self.assertEqual(written[7], expected)
+
     """
     def test_classification_consensus(self):
         with pysam.AlignmentFile('./data/mini_nla_test.bam') as f, pysam.AlignmentFile('./data/consensus_write_test.bam','wb',header=f.header) as target_bam:
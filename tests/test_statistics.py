@@ -0,0 +1,76 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+import unittest
+import argparse
+import pysam
+from singlecellmultiomics.statistic import *
+
+"""
+These tests check if the statistics can be gathered in a single pass and merged
+"""
+
+def get_statistics():
+    args = argparse.Namespace()
+    return [ReadCount(args),
+            FragmentSizeHistogram(args),
+            MappingQualityHistogram(args),
+            OversequencingHistogram(args),
+            CellReadCount(args),
+            TagHistogram(args),
+            PlateStatistic(args),
+            UniqueReadNameCount(args)]
+
+
+class TestStatisticEngine(unittest.TestCase):
+
+    def test_single_pass(self):
+        engine = StatisticEngine(get_statistics())
+        engine.process_file('./data/mini_nla_test.bam')
+        self.assertEqual(engine.processed_reads, 566)
+
+        rc = engine.statistics[0]
+        self.assertEqual(rc.totalMappedReads['R1'], 292)
+        self.assertEqual(rc.totalMappedReads['R2'], 271)
+
+        unique_read_names = engine.statistics[-1]
+        with pysam.AlignmentFile('./data/mini_nla_test.bam') as alignments:
+            names = set(read.query_name for read in alignments if read.is_read1 and not read.is_unmapped)
+        self.assertEqual(unique_read_names.get_count('mapped', 'R1'), len(names))
+
+    def test_merge(self):
+        with pysam.AlignmentFile('./data/mini_nla_test.bam') as alignments:
+            reads = list(alignments)
+
+        complete = StatisticEngine(get_statistics())
+        complete.process_reads(reads)
+
+        # Process the reads in two parts, with a small compaction size for the read names
+        parts = []
+        for part in (reads[:200], reads[200:]):
+            engine = StatisticEngine(get_statistics())
+            engine.statistics[-1].compact_size = 50
+            engine.process_reads(part)
+            parts.append(engine)
+        parts[0].merge(parts[1])
+
+        self.assertEqual(parts[0].processed_reads, complete.processed_reads)
+        for merged, statistic in zip(parts[0].statistics, complete.statistics):
+            if isinstance(statistic, UniqueReadNameCount):
+                self.assertEqual(dict(merged), dict(statistic))
+                continue
+            for attribute in statistic.merge_attributes:
+                self.assertEqual(getattr(merged, attribute), getattr(statistic, attribute))
+
+    def test_process_by_contig(self):
+        complete = StatisticEngine(get_statistics())
+        complete.process_file('./data/mini_nla_test.bam')
+
+        by_contig = StatisticEngine(get_statistics())
+        by_contig.process_file('./data/mini_nla_test.bam', n_processes=2)
+        self.assertEqual(by_contig.processed_reads, complete.processed_reads)
+        self.assertEqual(dict(by_contig.statistics[0]), dict(complete.statistics[0]))
+        self.assertEqual(dict(by_contig.statistics[-1]), dict(complete.statistics[-1]))
+
+
+if __name__ == '__main__':
+    unittest.main()
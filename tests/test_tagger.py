@@ -5,7 +5,14 @@ import itertools
 import pysam
 import os
 import singlecellmultiomics.universalBamTagger.universalBamTagger as ut
+import singlecellmultiomics.molecule
+import singlecellmultiomics.fragment
 import singlecellmultiomics.universalBamTagger.bamtagmultiome as tm
+from singlecellmultiomics.universalBamTagger.tagging import split_task, run_tagging_task
+from singlecellmultiomics.barcodeFileParser.barcodeFileParser import BarcodeParser
+from singlecellmultiomics.fastqProcessing.fastqIterator import FastqRecord
+from singlecellmultiomics.modularDemultiplexer.demultiplexingStrategyLoader import DemultiplexingStrategyLoader
+import pkg_resources
 
 """
 These tests check if the tagger is working correctly
@@ -52,6 +59,65 @@ class TestMultiomeTaggingCHIC(unittest.TestCase):
         os.remove(write_path)
         os.remove(write_path+'.bai')
 
+    def test_write_to_read_grouped_multi_timeout(self):
+        write_path = './data/write_test_chic_rg.bam'
+        tm.run_multiome_tagging_cmd(f'./data/chic_test_region.bam -method chic --multiprocess -max_time_per_segment 1000 -o {write_path}'.split(' '))
+
+        with pysam.AlignmentFile(write_path) as f:
+            i = sum(1 for read in f if read.is_read1)
+            self.assertEqual(i, 17)
+
+        self.assertFalse( os.path.exists(write_path+'.failed_regions.bed') )
+        os.remove(write_path)
+        os.remove(write_path+'.bai')
+
+    def test_write_to_read_grouped_multi_failed_segments(self):
+        # Every segment with reads times out, also after splitting and retrying
+        write_path = './data/write_test_chic_rg.bam'
+        tm.run_multiome_tagging_cmd(f'./data/chic_test_region.bam -method chic --multiprocess -max_time_per_segment 0 -segment_retry_depth 1 -o {write_path}'.split(' '))
+
+        with pysam.AlignmentFile(write_path) as f:
+            # Partially processed segments should not be written
+            i = sum(1 for read in f if read.is_read1)
+            self.assertEqual(i, 0)
+
+        with open(write_path+'.failed_regions.bed') as f:
+            failed = [line.strip().split('\t') for line in f]
+        self.assertTrue( len(failed)>0 )
+        for contig, start, end in failed:
+            self.assertTrue( int(start) < int(end) )
+
+        os.remove(write_path)
+        os.remove(write_path+'.bai')
+        os.remove(write_path+'.failed_regions.bed')
+
+    def test_split_task(self):
+        task = {'contig':'chr1', 'start':1000, 'end':2000, 'fetch_start':800, 'fetch_end':2100, 'timeout_time':10}
+        sub_tasks = split_task(task, bin_size=250, fragment_size=500, timeout_time=20)
+        self.assertEqual( [(t['start'],t['end']) for t in sub_tasks], [(1000,1250),(1250,1500),(1500,1750),(1750,2000)] )
+        # Fetch coordinates should not exceed the fetch coordinates of the original task
+        self.assertEqual( [(t['fetch_start'],t['fetch_end']) for t in sub_tasks], [(800,1750),(800,2000),(1000,2100),(1250,2100)] )
+        self.assertTrue( all(t['timeout_time']==20 and t['contig']=='chr1' for t in sub_tasks) )
+        # The original task is not changed
+        self.assertEqual( task['timeout_time'], 10 )
+
+    def test_tagging_cache_statistics(self):
+        written = []
+        class ListOutput():
+            def write(self, read):
+                written.append(read)
+
+        with pysam.AlignmentFile('./data/mini_nla_test.bam') as alignments:
+            statistics = run_tagging_task(alignments, ListOutput(),
+                molecule_iterator_class=singlecellmultiomics.molecule.MoleculeIterator,
+                molecule_iterator_args={
+                    'molecule_class':singlecellmultiomics.molecule.NlaIIIMolecule,
+                    'fragment_class':singlecellmultiomics.fragment.NlaIIIFragment})
+        self.assertTrue( len(written) > 0 )
+        # The RT reactions of every written molecule are calculated once by write_tags
+        self.assertEqual( statistics['cache_statistics']['rt_reaction_cache_misses'], statistics['total_molecules_written'] )
+        self.assertEqual( statistics['cache_statistics']['rt_reaction_cache_hits'], 0 )
+
 class TestMultiomeTaggingNLA(unittest.TestCase):
 
     def test_write_to_read_grouped_sorted(self):
@@ -190,5 +256,63 @@ class TestMultiomeTaggingNLA(unittest.TestCase):
         os.remove(write_path+'.bai')
 
 
+    def test_consensus_no_source_reads_multi_process(self):
+        read_counts = {}
+        for name, extra_args in (('single', ''), ('multi', ' --multiprocess')):
+            write_path = f'./data/write_test_consensus_{name}.bam'
+            tm.run_multiome_tagging_cmd(f'./data/mini_nla_test.bam -method nla --consensus -consensus_n_train 2000 -consensus_k_rad 1 --no_source_reads{extra_args} -o {write_path}'.split(' '))
+            with pysam.AlignmentFile(write_path) as f:
+                # Molecules without a cut site are not written when using multiple processes
+                reads = [read for read in f if not read.has_tag('RR') or not 'no_cut_site_found' in read.get_tag('RR').split(',')] \
+                    if name == 'single' else list(f)
+                self.assertTrue( len(reads) > 0 )
+                self.assertTrue( all(read.query_name.startswith('c_') for read in reads) )
+                read_counts[name] = len(reads)
+            os.remove(write_path)
+            os.remove(write_path+'.bai')
+            os.remove('./data/consensus_model.pickle.gz')
+        self.assertEqual(read_counts['single'], read_counts['multi'])
+
+class TaggedRecordQueryNameFlagger(ut.QueryNameFlagger):
+    # Always uses TaggedRecord.tagPysamRead
+    def tag_read(self, read):
+        return False
+
+
+class TestQueryNameFlagger(unittest.TestCase):
+
+    def test_fast_path_equivalence(self):
+        dmx = DemultiplexingStrategyLoader(
+            barcodeParser=BarcodeParser(pkg_resources.resource_filename('singlecellmultiomics','modularDemultiplexer/barcodes/')),
+            indexParser=BarcodeParser(pkg_resources.resource_filename('singlecellmultiomics','modularDemultiplexer/indices/')),
+            indexFileAlias='illumina_merged_ThruPlex48S_RP')
+        reads = [
+            FastqRecord('@NS500414:628:H7YVNBGXC:1:11101:15963:1046 1:N:0:GTGAAA', 'ATCACACACTATAGTCATTCAGGAGCAGGTTCTTCAGG', '+', 'AAAAA#EEEEEEEEEEEAEEEEEEEAEEEEEEEEEEE/'),
+            FastqRecord('@NS500414:628:H7YVNBGXC:1:11101:15963:1046 2:N:0:GTGAAA', 'ACCCCAGATCAACGTTGGACNTCNNCNTTNTNCTCNGC', '+', '6AAAAEEAEE/AEEEEEEEE#EE##<#6E#A#EEE#EA')]
+        nla, = dmx.getSelectedStrategiesFromStringList(['NLAIII384C8U3'], verbose=False)
+        query_names = [record.asFastq().split('\n')[0][1:] for record in nla.demultiplex(reads, library='test')]
+        # Without index, without @ and with characters removed by fqSafe:
+        query_names += [query_names[0].replace(';aA:GTGAAA', ''), query_names[0].replace('@', ''), query_names[0] + '.']
+
+        header = pysam.AlignmentHeader.from_dict({'HD': {'VN': '1.6'}})
+        fast, slow = ut.QueryNameFlagger(), TaggedRecordQueryNameFlagger()
+        for query_name in query_names:
+            fast_read, slow_read = pysam.AlignedSegment(header), pysam.AlignedSegment(header)
+            for read, flagger in ((fast_read, fast), (slow_read, slow)):
+                read.query_name = query_name
+                read.set_tag('NM', 1)
+                flagger.digest([read])
+            self.assertEqual(fast_read.to_string(), slow_read.to_string())
+            self.assertEqual(fast_read.get_tags(with_value_type=True), slow_read.get_tags(with_value_type=True))
+        self.assertEqual(fast.assignedReadGroups, slow.assignedReadGroups)
+
+        read = pysam.AlignedSegment(header)
+        read.query_name = query_names[-1]
+        self.assertFalse(fast.tag_read(read))
+        read.query_name = query_names[0]
+        self.assertTrue(fast.tag_read(read))
+        self.assertTrue(read.has_tag('MI') and read.has_tag('RG'))
+
+
 if __name__ == '__main__':
     unittest.main()